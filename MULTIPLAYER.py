@@ -4,6 +4,9 @@ import cv2
 import numpy as np
 import random
 
+from engine import Game, GRID_WIDTH, GRID_HEIGHT
+from pieces import ROTATIONS
+
 # === Pygame Init ===
 pygame.init()
 pygame.font.init()
@@ -38,23 +41,6 @@ p2_playfield = pygame.Rect(p2_hold.left - 50 - playfield_size[0], 100, *playfiel
 pause_button = pygame.Rect(SCREEN_WIDTH - 100, 20, 60, 40)
 menu_rect = pygame.Rect(SCREEN_WIDTH // 2 - 150, SCREEN_HEIGHT // 2 - 100, 300, 250)
 
-# === Tetromino Shapes ===
-SHAPES = {
-    'I': [[1, 1, 1, 1]],
-    'O': [[1, 1],
-          [1, 1]],
-    'T': [[0, 1, 0],
-          [1, 1, 1]],
-    'S': [[0, 1, 1],
-          [1, 1, 0]],
-    'Z': [[1, 1, 0],
-          [0, 1, 1]],
-    'J': [[1, 0, 0],
-          [1, 1, 1]],
-    'L': [[0, 0, 1],
-          [1, 1, 1]]
-}
-
 # === Colors ===
 COLORS = {
     'I': (0, 255, 255),    # Cyan
@@ -80,230 +66,20 @@ COLOR_GRADIENTS = {
 # === Game Constants ===
 BLOCK_SIZE = 30
 PREVIEW_BLOCK_SIZE = 20  # Smaller size for preview blocks
-GRID_WIDTH = 10
-GRID_HEIGHT = 20
-FALL_SPEED = 0.5  # seconds per cell
-LOCK_DELAY = 0.1  # seconds before piece locks
 
 # === Player Class ===
-class Player:
-    def __init__(self, playfield_rect):
+class Player(Game):
+    """An engine Game drawn into a playfield on screen"""
+    def __init__(self, playfield_rect, seed=None):
+        super().__init__(seed)
         self.playfield_rect = playfield_rect
-        self.grid = [[0 for _ in range(GRID_WIDTH)] for _ in range(GRID_HEIGHT)]
-        self.current_piece = None
-        self.next_pieces = []
-        self.held_piece = None
-        self.can_hold = True
-        self.score = 0
-        self.combo = 0
-        self.fall_time = 0
-        self.lock_time = 0
-        self.game_over = False
-        self.shadow_y = 0
-        self.pending_garbage = 0  # Number of garbage lines to receive
-        self.garbage_send_buffer = 0  # Accumulated garbage to send
-        
-    def new_piece(self):
-        # Initialize next pieces if empty
-        if not self.next_pieces:
-            for _ in range(3):  # Keep 3 pieces in queue
-                self.next_pieces.append(random.choice(list(SHAPES.keys())))
-                
-        self.current_piece = {
-            'shape': self.next_pieces[0],
-            'rotation': 0,
-            'x': GRID_WIDTH // 2 - len(SHAPES[self.next_pieces[0]][0]) // 2,
-            'y': 0
-        }
-        self.next_pieces.pop(0)  # Remove the used piece
-        self.next_pieces.append(random.choice(list(SHAPES.keys())))  # Add new piece
-        self.can_hold = True
-        
-        if self.check_collision():
-            self.game_over = True
-
-    def hold_piece(self):
-        if not self.can_hold:
-            return
-            
-        if self.held_piece is None:
-            self.held_piece = self.current_piece['shape']
-            self.new_piece()
-        else:
-            self.held_piece, self.current_piece['shape'] = self.current_piece['shape'], self.held_piece
-            self.current_piece['rotation'] = 0
-            self.current_piece['x'] = GRID_WIDTH // 2 - len(SHAPES[self.current_piece['shape']][0]) // 2
-            self.current_piece['y'] = 0
-            
-        self.can_hold = False
-
-    def rotate_piece(self):
-        shape = SHAPES[self.current_piece['shape']]
-        rotated = list(zip(*shape[::-1]))  # Rotate 90 degrees clockwise
-        old_rotation = self.current_piece['rotation']
-        self.current_piece['rotation'] = (self.current_piece['rotation'] + 1) % 4
-        
-        # Try rotation, if collision occurs, try wall kicks
-        if self.check_collision():
-            # Wall kick attempts
-            kicks = [(1, 0), (-1, 0), (0, -1), (1, -1), (-1, -1)]
-            for dx, dy in kicks:
-                self.current_piece['x'] += dx
-                self.current_piece['y'] += dy
-                if not self.check_collision():
-                    return
-                self.current_piece['x'] -= dx
-                self.current_piece['y'] -= dy
-            
-            # If all kicks fail, revert rotation
-            self.current_piece['rotation'] = old_rotation
-
-    def move_piece(self, dx, dy):
-        self.current_piece['x'] += dx
-        self.current_piece['y'] += dy
-        if self.check_collision():
-            self.current_piece['x'] -= dx
-            self.current_piece['y'] -= dy
-            if dy > 0:  # If moving downward and collision occurs
-                self.lock_time = LOCK_DELAY  # Immediately trigger lock
-            return False
-        return True
-
-    def check_collision(self):
-        shape = SHAPES[self.current_piece['shape']]
-        for _ in range(self.current_piece['rotation']):
-            shape = list(zip(*shape[::-1]))
-            
-        for y, row in enumerate(shape):
-            for x, cell in enumerate(row):
-                if cell:
-                    board_x = self.current_piece['x'] + x
-                    board_y = self.current_piece['y'] + y
-                    if (board_x < 0 or board_x >= GRID_WIDTH or 
-                        board_y >= GRID_HEIGHT or 
-                        (board_y >= 0 and self.grid[board_y][board_x])):
-                        return True
-        return False
-
-    def lock_piece(self):
-        shape = SHAPES[self.current_piece['shape']]
-        for _ in range(self.current_piece['rotation']):
-            shape = list(zip(*shape[::-1]))
-            
-        for y, row in enumerate(shape):
-            for x, cell in enumerate(row):
-                if cell:
-                    board_x = self.current_piece['x'] + x
-                    board_y = self.current_piece['y'] + y
-                    if board_y >= 0:
-                        self.grid[board_y][board_x] = self.current_piece['shape']
-
-    def add_garbage_lines(self, num_lines):
-        if num_lines <= 0:
-            return
-            
-        # Move all existing blocks up by num_lines
-        for y in range(num_lines, GRID_HEIGHT):
-            self.grid[y - num_lines] = self.grid[y][:]
-        
-        # Add garbage lines at the bottom
-        for y in range(GRID_HEIGHT - num_lines, GRID_HEIGHT):
-            # Create a garbage line with a random hole
-            hole_pos = random.randint(0, GRID_WIDTH - 1)
-            self.grid[y] = ['G' for _ in range(GRID_WIDTH)]
-            self.grid[y][hole_pos] = 0  # Create a hole in the garbage line
-            
-        # Check if the new garbage lines cause game over
-        if self.check_collision():
-            self.game_over = True
-
-    def clear_lines(self):
-        lines_cleared = 0
-        y = GRID_HEIGHT - 1
-        while y >= 0:
-            if all(self.grid[y]):
-                lines_cleared += 1
-                for y2 in range(y, 0, -1):
-                    self.grid[y2] = self.grid[y2-1][:]
-                self.grid[0] = [0] * GRID_WIDTH
-            else:
-                y -= 1
-                
-        if lines_cleared > 0:
-            self.combo += 1
-            points = {1: 100, 2: 300, 3: 500, 4: 800}
-            self.score += points.get(lines_cleared, 0) * self.combo
-            
-            # Calculate garbage to send based on lines cleared
-            garbage_to_send = 0
-            if lines_cleared == 2:
-                garbage_to_send = 1
-            elif lines_cleared == 3:
-                garbage_to_send = 2
-            elif lines_cleared == 4:
-                garbage_to_send = 4
-                
-            self.garbage_send_buffer += garbage_to_send
-        else:
-            self.combo = 0
-
-    def update(self, dt):
-        if self.game_over:
-            return
-            
-        if self.current_piece is None:
-            self.new_piece()
-            
-        self.fall_time += dt
-        if self.fall_time >= FALL_SPEED:
-            self.fall_time = 0
-            if not self.move_piece(0, 1):
-                self.lock_time += dt
-                if self.lock_time >= LOCK_DELAY:
-                    self.lock_piece()
-                    self.clear_lines()
-                    self.new_piece()
-                    self.lock_time = 0
-            else:
-                self.lock_time = 0
-
-    def get_shadow_position(self):
-        if not self.current_piece:
-            return None
-            
-        # Create a copy of the current piece to test drop position
-        shadow_piece = {
-            'shape': self.current_piece['shape'],
-            'rotation': self.current_piece['rotation'],
-            'x': self.current_piece['x'],
-            'y': self.current_piece['y']
-        }
-        
-        # Drop the shadow piece until it collides
-        while True:
-            shadow_piece['y'] += 1
-            # Check collision with the shadow piece
-            shape = SHAPES[shadow_piece['shape']]
-            for _ in range(shadow_piece['rotation']):
-                shape = list(zip(*shape[::-1]))
-                
-            for y, row in enumerate(shape):
-                for x, cell in enumerate(row):
-                    if cell:
-                        board_x = shadow_piece['x'] + x
-                        board_y = shadow_piece['y'] + y
-                        if (board_x < 0 or board_x >= GRID_WIDTH or 
-                            board_y >= GRID_HEIGHT or 
-                            (board_y >= 0 and self.grid[board_y][board_x])):
-                            return shadow_piece['y'] - 1  # Return the last valid position
-        return None
 
     def draw(self, surface):
         # Draw grid
         for y in range(GRID_HEIGHT):
             for x in range(GRID_WIDTH):
-                if self.grid[y][x]:
-                    color = self.grid[y][x]
+                if self.board.cell(x, y):
+                    color = self.board.cell(x, y)
                     rect = pygame.Rect(
                         self.playfield_rect.x + x * BLOCK_SIZE,
                         self.playfield_rect.y + y * BLOCK_SIZE,
@@ -312,45 +88,34 @@ class Player:
                     )
                     draw_block(surface, rect, color)
 
+        if self.game_over:
+            return
+        cells = self.cells()
+
         # Draw shadow piece
-        if self.current_piece:
-            shadow_y = self.get_shadow_position()
-            if shadow_y is not None:
-                shape = SHAPES[self.current_piece['shape']]
-                for _ in range(self.current_piece['rotation']):
-                    shape = list(zip(*shape[::-1]))
-                    
-                for y, row in enumerate(shape):
-                    for x, cell in enumerate(row):
-                        if cell:
-                            rect = pygame.Rect(
-                                self.playfield_rect.x + (self.current_piece['x'] + x) * BLOCK_SIZE,
-                                self.playfield_rect.y + (shadow_y + y) * BLOCK_SIZE,
-                                BLOCK_SIZE - 1,
-                                BLOCK_SIZE - 1
-                            )
-                            # Draw semi-transparent shadow
-                            shadow_surface = pygame.Surface((BLOCK_SIZE - 1, BLOCK_SIZE - 1), pygame.SRCALPHA)
-                            shadow_surface.fill((*COLORS[self.current_piece['shape']], 100))
-                            surface.blit(shadow_surface, rect)
-                            pygame.draw.rect(surface, (255, 255, 255), rect, 1)
+        shadow_y = self.ghost_y()
+        shadow_surface = pygame.Surface((BLOCK_SIZE - 1, BLOCK_SIZE - 1), pygame.SRCALPHA)
+        shadow_surface.fill((*COLORS[self.piece], 100))
+        for x, y in cells:
+            rect = pygame.Rect(
+                self.playfield_rect.x + (self.x + x) * BLOCK_SIZE,
+                self.playfield_rect.y + (shadow_y + y) * BLOCK_SIZE,
+                BLOCK_SIZE - 1,
+                BLOCK_SIZE - 1
+            )
+            # Draw semi-transparent shadow
+            surface.blit(shadow_surface, rect)
+            pygame.draw.rect(surface, (255, 255, 255), rect, 1)
 
         # Draw current piece
-        if self.current_piece:
-            shape = SHAPES[self.current_piece['shape']]
-            for _ in range(self.current_piece['rotation']):
-                shape = list(zip(*shape[::-1]))
-                
-            for y, row in enumerate(shape):
-                for x, cell in enumerate(row):
-                    if cell:
-                        rect = pygame.Rect(
-                            self.playfield_rect.x + (self.current_piece['x'] + x) * BLOCK_SIZE,
-                            self.playfield_rect.y + (self.current_piece['y'] + y) * BLOCK_SIZE,
-                            BLOCK_SIZE - 1,
-                            BLOCK_SIZE - 1
-                        )
-                        draw_block(surface, rect, self.current_piece['shape'])
+        for x, y in cells:
+            rect = pygame.Rect(
+                self.playfield_rect.x + (self.x + x) * BLOCK_SIZE,
+                self.playfield_rect.y + (self.y + y) * BLOCK_SIZE,
+                BLOCK_SIZE - 1,
+                BLOCK_SIZE - 1
+            )
+            draw_block(surface, rect, self.piece)
 
 def draw_block(surface, rect, color, is_preview=False):
     # Create gradient effect
@@ -376,8 +141,9 @@ def draw_block(surface, rect, color, is_preview=False):
     surface.blit(highlight_surface, highlight_rect)
 
 # === Game State ===
-p1 = Player(p1_playfield)
-p2 = Player(p2_playfield)
+match_seed = random.getrandbits(32)
+p1 = Player(p1_playfield, match_seed)
+p2 = Player(p2_playfield, match_seed)
 paused = False
 show_help = False
 game_over = False
@@ -452,7 +218,7 @@ def draw_playfield():
         (p1_hold, "Hold", None), (p2_hold, "Hold", None),
         (p1_score_box, "Score:", p1.score), (p2_score_box, "Score:", p2.score),
         (p1_combo_box, "Combo:", p1.combo), (p2_combo_box, "Combo:", p2.combo),
-        (p1_garbage_box, "Garbage:", p1.garbage_send_buffer), (p2_garbage_box, "Garbage:", p2.garbage_send_buffer),
+        (p1_garbage_box, "Garbage:", p1.garbage_sent), (p2_garbage_box, "Garbage:", p2.garbage_sent),
     ]:
         draw_text(label, (box.x, box.y - 25), font_small)
         overlay = pygame.Surface(box.size, pygame.SRCALPHA)
@@ -472,9 +238,9 @@ def draw_playfield():
         
         # Draw each next piece
         for i, piece in enumerate(player.next_pieces):
-            shape = SHAPES[piece]
-            piece_height = len(shape)
-            piece_width = len(shape[0])
+            cells = ROTATIONS[piece][0]
+            piece_height = 1 + max(y for _, y in cells)
+            piece_width = 1 + max(x for x, _ in cells)
             
             # Calculate position to center the piece in its section
             section_height = rect.height // 3
@@ -482,16 +248,14 @@ def draw_playfield():
             x_offset = rect.x + (rect.width - piece_width * PREVIEW_BLOCK_SIZE) // 2
             
             # Draw the piece
-            for y, row in enumerate(shape):
-                for x, cell in enumerate(row):
-                    if cell:
-                        block_rect = pygame.Rect(
-                            x_offset + x * PREVIEW_BLOCK_SIZE,
-                            y_offset + y * PREVIEW_BLOCK_SIZE,
-                            PREVIEW_BLOCK_SIZE - 1,
-                            PREVIEW_BLOCK_SIZE - 1
-                        )
-                        draw_block(screen, block_rect, piece, is_preview=True)
+            for x, y in cells:
+                block_rect = pygame.Rect(
+                    x_offset + x * PREVIEW_BLOCK_SIZE,
+                    y_offset + y * PREVIEW_BLOCK_SIZE,
+                    PREVIEW_BLOCK_SIZE - 1,
+                    PREVIEW_BLOCK_SIZE - 1
+                )
+                draw_block(screen, block_rect, piece, is_preview=True)
 
     pygame.draw.rect(screen, CYAN, pause_button, 2)
     draw_text("Menu", pause_button.center, font_small, center=True)
@@ -547,6 +311,24 @@ def draw_game_over():
     pygame.draw.rect(screen, CYAN, btn_exit_game, 2)
     draw_text("Exit Game", btn_exit_game.center, font_small, center=True)
 
+# Keys and the engine action each one triggers, per player
+P1_KEYS = {
+    pygame.K_LEFT: 'left',
+    pygame.K_RIGHT: 'right',
+    pygame.K_DOWN: 'soft_drop',
+    pygame.K_UP: 'rotate',
+    pygame.K_SPACE: 'hard_drop',
+    pygame.K_c: 'hold'
+}
+P2_KEYS = {
+    pygame.K_a: 'left',
+    pygame.K_d: 'right',
+    pygame.K_s: 'soft_drop',
+    pygame.K_w: 'rotate',
+    pygame.K_f: 'hard_drop',
+    pygame.K_v: 'hold'
+}
+
 # === Main Game Loop ===
 running = True
 last_time = pygame.time.get_ticks()
@@ -557,6 +339,7 @@ while running:
     last_time = current_time
     
     clock.tick(60)
+    p1_inputs, p2_inputs = [], []
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
             running = False
@@ -575,58 +358,28 @@ while running:
                     elif event.key == pygame.K_q:
                         pygame.quit()
                         sys.exit()
-                else:
-                    # Player 1 controls
-                    if event.key == pygame.K_LEFT:
-                        p1.move_piece(-1, 0)
-                    elif event.key == pygame.K_RIGHT:
-                        p1.move_piece(1, 0)
-                    elif event.key == pygame.K_DOWN:
-                        p1.move_piece(0, 1)
-                    elif event.key == pygame.K_UP:
-                        p1.rotate_piece()
-                    elif event.key == pygame.K_SPACE:
-                        while p1.move_piece(0, 1):
-                            pass
-                    elif event.key == pygame.K_c:
-                        p1.hold_piece()
-                        
-                    # Player 2 controls
-                    elif event.key == pygame.K_a:
-                        p2.move_piece(-1, 0)
-                    elif event.key == pygame.K_d:
-                        p2.move_piece(1, 0)
-                    elif event.key == pygame.K_s:
-                        p2.move_piece(0, 1)
-                    elif event.key == pygame.K_w:
-                        p2.rotate_piece()
-                    elif event.key == pygame.K_f:
-                        while p2.move_piece(0, 1):
-                            pass
-                    elif event.key == pygame.K_v:
-                        p2.hold_piece()
+                elif event.key in P1_KEYS:
+                    p1_inputs.append(P1_KEYS[event.key])
+                elif event.key in P2_KEYS:
+                    p2_inputs.append(P2_KEYS[event.key])
         else:
             if event.type == pygame.MOUSEBUTTONDOWN:
                 if btn_main_menu.collidepoint(event.pos):
-                    p1 = Player(p1_playfield)
-                    p2 = Player(p2_playfield)
+                    match_seed = random.getrandbits(32)
+                    p1 = Player(p1_playfield, match_seed)
+                    p2 = Player(p2_playfield, match_seed)
                     game_over = False
                 elif btn_exit_game.collidepoint(event.pos):
                     pygame.quit()
                     sys.exit()
 
     if not paused and not game_over:
-        p1.update(dt)
-        p2.update(dt)
-        
-        # Send garbage between players
-        if p1.garbage_send_buffer > 0:
-            p2.add_garbage_lines(p1.garbage_send_buffer)
-            p1.garbage_send_buffer = 0
-        if p2.garbage_send_buffer > 0:
-            p1.add_garbage_lines(p2.garbage_send_buffer)
-            p2.garbage_send_buffer = 0
-            
+        # Each player's line clears push garbage onto the other's board
+        p1_garbage = p1.step(p1_inputs, dt)
+        p2_garbage = p2.step(p2_inputs, dt)
+        p2.receive_garbage(p1_garbage)
+        p1.receive_garbage(p2_garbage)
+
         game_over = p1.game_over or p2.game_over
 
     draw_video_background()
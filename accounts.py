@@ -0,0 +1,77 @@
+import hashlib
+import hmac
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Player accounts, kept in SQLite keyed by username (so a login is one index lookup) with salted
+# scrypt password hashes. scrypt is deliberately slow and memory hungry, so every check runs on a
+# small worker pool and callers get a Future; the server's handler threads and event loop never
+# wait on it.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    username TEXT PRIMARY KEY,
+    salt BLOB NOT NULL,
+    hash BLOB NOT NULL,
+    n INTEGER NOT NULL,  -- scrypt cost parameters the hash was made with
+    r INTEGER NOT NULL,
+    p INTEGER NOT NULL,
+    created_at REAL
+);
+"""
+
+SCRYPT_N = 2 ** 14  # ~16 MB and a few tens of ms per hash
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+MAX_USERNAME = 20
+
+def hash_password(password, salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p, maxmem=2 * 128 * r * n, dklen=32)
+
+def valid_username(username):
+    return isinstance(username, str) and 0 < len(username) <= MAX_USERNAME and username.isprintable() \
+        and ':' not in username and username == username.strip()
+
+class AccountStore:
+    """login() registers unknown usernames and checks the password of known ones"""
+    def __init__(self, path='accounts.db', workers=2):
+        self.path = path
+        self.local = threading.local()  # One SQLite connection per pool thread
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='accounts')
+        db = self.connection()
+        db.execute('PRAGMA journal_mode=WAL')  # Several server processes may share the file
+        db.executescript(SCHEMA)
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path)
+        return db
+
+    def login(self, username, password):
+        """Future resolving to 'ok', 'created' (new account) or 'wrong_password'"""
+        return self.pool.submit(self.check, username, password)
+
+    def check(self, username, password):
+        db = self.connection()
+        row = db.execute('SELECT salt, hash, n, r, p FROM accounts WHERE username = ?', (username,)).fetchone()
+        if row is None:
+            salt = os.urandom(SALT_BYTES)
+            digest = hash_password(password, salt)
+            try:
+                with db:
+                    db.execute('INSERT INTO accounts (username, salt, hash, n, r, p, created_at) '
+                               "VALUES (?, ?, ?, ?, ?, ?, strftime('%s', 'now'))",
+                               (username, salt, digest, SCRYPT_N, SCRYPT_R, SCRYPT_P))
+                return 'created'
+            except sqlite3.IntegrityError:
+                # Someone registered the name while we were hashing; check against theirs
+                row = db.execute('SELECT salt, hash, n, r, p FROM accounts WHERE username = ?',
+                                 (username,)).fetchone()
+        salt, stored, n, r, p = row
+        if hmac.compare_digest(hash_password(password, salt, n, r, p), stored):
+            return 'ok'
+        return 'wrong_password'
@@ -0,0 +1,202 @@
+import numpy as np
+
+from engine import ACTIONS, GARBAGE_FOR_LINES, GRID_HEIGHT, GRID_WIDTH, LINE_SCORES, NEXT_COUNT, WALL_KICKS
+from pieces import GOLDEN, PIECE_TYPES, ROTATIONS, SHAPES
+from protocol import CODE_PIECES, PIECE_CODES
+
+# Many games advanced together, for bots and for checking games on the server. BatchGame keeps N
+# boards in one (N, height, width) array and every per-game value in a length-N array; step()
+# takes one action per game and applies it to all of them with array operations - a Python loop
+# runs per action type and per wall kick, never per game. The rules are engine.Game's, and
+# bench_engine.py checks the two play the same games.
+#
+# Pieces come from the same seeded 7-bag as pieces.SevenBag, whose shuffle is a hash of (seed, bag
+# number), so thousands of games can deal their next piece in one vectorized call and a batch game
+# deals exactly what a real match with the same seed does.
+
+CELLS = np.array([[ROTATIONS[piece][rotation] for rotation in range(4)] for piece in PIECE_TYPES])  # (7, 4, 4, 2)
+SPAWN_X = np.array([GRID_WIDTH // 2 - len(SHAPES[piece][0]) // 2 for piece in PIECE_TYPES])
+CELL_CODES = np.array([PIECE_CODES[piece] for piece in PIECE_TYPES], dtype=np.uint8)
+LINE_SCORE_TABLE = np.array([LINE_SCORES.get(lines, 0) for lines in range(5)])
+GARBAGE_TABLE = np.array([GARBAGE_FOR_LINES.get(lines, 0) for lines in range(5)])
+ACTION_CODES = {action: i for i, action in enumerate(ACTIONS)}
+# Action code -> (dx, dy) for the actions that are plain moves
+MOVE_CODES = {ACTION_CODES['left']: (-1, 0), ACTION_CODES['right']: (1, 0), ACTION_CODES['soft_drop']: (0, 1),
+              ACTION_CODES['gravity']: (0, 1)}
+
+def mix(values):
+    """pieces.mix over a uint64 array"""
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+def deal(seeds, positions):
+    """Index into PIECE_TYPES of piece number positions[i] of the game seeded seeds[i]"""
+    seeds = np.asarray(seeds, dtype=np.uint64)
+    positions = np.asarray(positions, dtype=np.int64)
+    bags = (positions // len(PIECE_TYPES)).astype(np.uint64)
+    golden = np.uint64(GOLDEN)
+    # pieces.bag_keys, with uint64 wrapping in place of its masks
+    keys = mix(mix(seeds * golden + bags)[:, None] + np.arange(len(PIECE_TYPES), dtype=np.uint64) * golden)
+    order = np.argsort(keys, axis=1, kind='stable')  # Sorting random keys shuffles the bag
+    return order[np.arange(len(positions)), positions % len(PIECE_TYPES)]
+
+class BatchGame:
+    """len(seeds) independent games, stepped together"""
+    def __init__(self, seeds):
+        count = len(seeds)
+        self.count = count
+        self.boards = np.zeros((count, GRID_HEIGHT, GRID_WIDTH), dtype=np.uint8)  # Protocol cell codes
+        self.seeds = np.zeros(count, dtype=np.uint64)
+        self.position = np.zeros(count, dtype=np.int64)  # Next piece each game deals
+        self.piece = np.zeros(count, dtype=np.int64)  # Index into PIECE_TYPES
+        self.rotation = np.zeros(count, dtype=np.int64)
+        self.x = np.zeros(count, dtype=np.int64)
+        self.y = np.zeros(count, dtype=np.int64)
+        self.hold = np.full(count, -1, dtype=np.int64)  # -1 when nothing is held
+        self.can_hold = np.ones(count, dtype=bool)
+        self.score = np.zeros(count, dtype=np.int64)
+        self.combo = np.zeros(count, dtype=np.int64)
+        self.lines = np.zeros(count, dtype=np.int64)
+        self.garbage_sent = np.zeros(count, dtype=np.int64)
+        self.game_over = np.zeros(count, dtype=bool)
+        self.reset(np.arange(count), seeds)
+
+    def reset(self, games, seeds):
+        """Start the given games over with new seeds"""
+        games = np.asarray(games, dtype=np.int64)
+        self.boards[games] = 0
+        self.seeds[games] = np.asarray(seeds, dtype=np.uint64)
+        self.position[games] = 0
+        self.hold[games] = -1
+        for values in (self.score, self.combo, self.lines, self.garbage_sent):
+            values[games] = 0
+        self.game_over[games] = False
+        self.spawn(games)
+
+    def next_pieces(self, game):
+        return [PIECE_TYPES[i] for i in deal([self.seeds[game]] * NEXT_COUNT,
+                                             self.position[game] + np.arange(NEXT_COUNT))]
+
+    def rows(self, game):
+        """One game's board as rows of piece letters, like engine boards' rows()"""
+        return [[CODE_PIECES[code] for code in row] for row in self.boards[game].tolist()]
+
+    def collides(self, games, piece, rotation, x, y):
+        """For each of games, whether the piece placed at (x, y) hits a wall, the floor or a filled cell"""
+        cells = CELLS[piece, rotation]
+        bx = x[:, None] + cells[..., 0]
+        by = y[:, None] + cells[..., 1]
+        outside = (bx < 0) | (bx >= GRID_WIDTH) | (by >= GRID_HEIGHT)
+        # Out-of-range cells read some in-range cell instead; outside already decides those
+        filled = self.boards[games[:, None], np.minimum(np.maximum(by, 0), GRID_HEIGHT - 1),
+                             np.minimum(np.maximum(bx, 0), GRID_WIDTH - 1)] != 0
+        return (outside | (filled & (by >= 0))).any(axis=1)
+
+    def place(self, games):
+        """Put each game's current piece at its spawn position; games where it doesn't fit are over"""
+        self.rotation[games] = 0
+        self.x[games] = SPAWN_X[self.piece[games]]
+        self.y[games] = 0
+        self.game_over[games] |= self.collides(games, self.piece[games], 0, self.x[games], self.y[games])
+
+    def spawn(self, games):
+        self.piece[games] = deal(self.seeds[games], self.position[games])
+        self.position[games] += 1
+        self.can_hold[games] = True
+        self.place(games)
+
+    def ghost_y(self, games):
+        """Row each game's piece would land on if dropped"""
+        cells = CELLS[self.piece[games], self.rotation[games]]
+        bx = self.x[games][:, None] + cells[..., 0]
+        by = self.y[games][:, None] + cells[..., 1]
+        # Only the columns under the piece's cells matter: (games, rows, cells)
+        rows = np.arange(GRID_HEIGHT)[None, :, None]
+        columns = self.boards[games[:, None, None], rows, bx[:, None, :]] != 0
+        under = columns & (rows > by[:, None, :])
+        # First filled row below each cell, or the floor
+        first = np.where(under.any(axis=1), under.argmax(axis=1), GRID_HEIGHT)
+        return self.y[games] + (first - by - 1).min(axis=1)
+
+    def lock(self, games):
+        """Fix the pieces in place, clear and score lines, spawn the next pieces; returns lines cleared"""
+        cells = CELLS[self.piece[games], self.rotation[games]]
+        bx = self.x[games][:, None] + cells[..., 0]
+        by = self.y[games][:, None] + cells[..., 1]
+        codes = np.broadcast_to(CELL_CODES[self.piece[games]][:, None], by.shape)
+        inside = by >= 0
+        self.boards[np.broadcast_to(games[:, None], by.shape)[inside], by[inside], bx[inside]] = codes[inside]
+
+        full = (self.boards[games] != 0).all(axis=2)
+        cleared = full.sum(axis=1)
+        clearing = cleared > 0
+        if clearing.any():
+            rows = games[clearing]
+            # A stable sort puts the full rows on top with the rest in order underneath; then blank the top
+            order = np.argsort(~full[clearing], axis=1, kind='stable')
+            boards = np.take_along_axis(self.boards[rows], order[:, :, None], axis=1)
+            boards[np.arange(GRID_HEIGHT)[None, :] < cleared[clearing][:, None]] = 0
+            self.boards[rows] = boards
+
+        self.combo[games] = np.where(clearing, self.combo[games] + 1, 0)
+        self.score[games] += LINE_SCORE_TABLE[cleared] * self.combo[games]
+        self.lines[games] += cleared
+        self.garbage_sent[games] += GARBAGE_TABLE[cleared]
+        self.spawn(games)
+        return cleared
+
+    def step(self, actions):
+        """Apply one action per game (codes from ACTION_CODES; games that are over ignore theirs).
+        Returns the garbage lines each game produced."""
+        actions = np.asarray(actions)
+        live = ~self.game_over
+        garbage = np.zeros(self.count, dtype=np.int64)
+        locking = []
+
+        for code, (dx, dy) in MOVE_CODES.items():
+            games = np.flatnonzero(live & (actions == code))
+            if games.size:
+                blocked = self.collides(games, self.piece[games], self.rotation[games],
+                                        self.x[games] + dx, self.y[games] + dy)
+                moved = games[~blocked]
+                self.x[moved] += dx
+                self.y[moved] += dy
+                if code == ACTION_CODES['gravity']:
+                    locking.append(games[blocked])
+
+        # Rotations try each wall kick in turn until one fits
+        pending = np.flatnonzero(live & (actions == ACTION_CODES['rotate']))
+        for dx, dy in [(0, 0)] + WALL_KICKS:
+            if not pending.size:
+                break
+            rotation = (self.rotation[pending] + 1) % 4
+            blocked = self.collides(pending, self.piece[pending], rotation, self.x[pending] + dx, self.y[pending] + dy)
+            turned = pending[~blocked]
+            self.rotation[turned] = rotation[~blocked]
+            self.x[turned] += dx
+            self.y[turned] += dy
+            pending = pending[blocked]
+
+        games = np.flatnonzero(live & (actions == ACTION_CODES['hold']) & self.can_hold)
+        if games.size:
+            empty = games[self.hold[games] < 0]
+            swap = games[self.hold[games] >= 0]
+            self.hold[empty] = self.piece[empty]
+            self.spawn(empty)
+            held = self.hold[swap]
+            self.hold[swap] = self.piece[swap]
+            self.piece[swap] = held
+            self.place(swap)
+            self.can_hold[games] = False
+
+        games = np.flatnonzero(live & (actions == ACTION_CODES['hard_drop']))
+        if games.size:
+            self.y[games] = self.ghost_y(games)
+            locking.append(games)
+
+        if locking:
+            games = np.concatenate(locking)
+            if games.size:
+                garbage[games] = GARBAGE_TABLE[self.lock(games)]
+        return garbage
@@ -0,0 +1,189 @@
+import argparse
+import random
+import sys
+import time
+
+from engine import ACTIONS, BOARD_TYPES, Game, GRID_HEIGHT, GRID_WIDTH
+from pieces import PIECE_TYPES
+
+try:
+    import numpy as np
+    from batch import BatchGame, PIECE_TYPES as BATCH_PIECES
+except ImportError:
+    BatchGame = None  # numpy isn't installed; skip the batch simulator
+
+# Headless engine benchmark. Plays the same seeded games on every board implementation, checks
+# they all end identically, and reports throughput for whole games and for the board operations
+# that dominate them:
+#   games    - a bot drops every piece at a random rotation and column, with some garbage
+#   collide  - collision tests against a half-filled board
+#   check    - the full-line check after a lock that completes nothing, which is most locks
+#   tetris   - locking a piece that completes four lines, then clearing them
+#   garbage  - pushing four garbage lines in from the bottom
+#   batch    - batch.BatchGame stepping N games at once on random actions, finished games
+#              restarted; reported as board-steps/s against single games on the first board
+
+def play(seed, board, pieces):
+    """Play one bot game of up to pieces pieces; returns (game, engine steps taken)"""
+    rng = random.Random(seed)
+    game = Game(seed, board)
+    steps = 0
+    for placed in range(pieces):
+        if game.game_over:
+            break
+        inputs = ['rotate'] * rng.randrange(4)
+        inputs += ['left' if rng.random() < 0.5 else 'right'] * rng.randrange(6)
+        inputs.append('hard_drop')
+        game.step(inputs)
+        steps += len(inputs)
+        if placed % 20 == 19:
+            game.receive_garbage(1)
+    return game, steps
+
+def fingerprint(game):
+    return ([list(row) for row in game.board.rows()], game.score, game.lines, game.piece, game.x, game.y,
+            game.rotation, game.game_over)
+
+def bench_games(board, games, pieces):
+    steps = 0
+    start = time.perf_counter()
+    for seed in range(games):
+        steps += play(seed, board, pieces)[1]
+    elapsed = time.perf_counter() - start
+    return steps / elapsed, f"{games / elapsed:.0f} games/s"
+
+def bench_collide(board, rounds):
+    rng = random.Random(1)
+    target = BOARD_TYPES[board]()
+    target.load_rows([[0] * GRID_WIDTH] * (GRID_HEIGHT // 2) +
+                     [[rng.choice([0, 'G']) for _ in range(GRID_WIDTH)] for _ in range(GRID_HEIGHT // 2)])
+    probes = [(rng.choice(PIECE_TYPES), rng.randrange(4), rng.randrange(-1, GRID_WIDTH), rng.randrange(GRID_HEIGHT))
+              for _ in range(1000)]
+    collides = target.collides
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for piece, rotation, x, y in probes:
+            collides(piece, rotation, x, y)
+    elapsed = time.perf_counter() - start
+    return rounds * len(probes) / elapsed, ""
+
+# Bottom four rows full except column 0, so a vertical I there completes all of them
+TETRIS_READY = [[0] * GRID_WIDTH] * (GRID_HEIGHT - 8) + [[0] + ['G'] * (GRID_WIDTH - 2) + [0]] * 4 + \
+    [[0] + ['G'] * (GRID_WIDTH - 1)] * 4
+
+def bench_check(board, rounds):
+    target = BOARD_TYPES[board]()
+    target.load_rows(TETRIS_READY)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        target.clear_lines()
+    elapsed = time.perf_counter() - start
+    return rounds / elapsed, ""
+
+def bench_tetris(board, rounds):
+    boards = []
+    for _ in range(rounds):
+        boards.append(BOARD_TYPES[board]())
+        boards[-1].load_rows(TETRIS_READY)
+    start = time.perf_counter()
+    for target in boards:
+        target.lock('I', 1, 0, GRID_HEIGHT - 4)
+        target.clear_lines()
+    elapsed = time.perf_counter() - start
+    if boards[0].rows() != [[0] * GRID_WIDTH] * 4 + TETRIS_READY[:-4]:
+        raise AssertionError(f"{board} board cleared the wrong lines")
+    return rounds / elapsed, ""
+
+def bench_garbage(board, rounds):
+    target = BOARD_TYPES[board]()
+    target.load_rows(TETRIS_READY)
+    holes = [0, 3, 6, 9]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        target.add_garbage(holes)
+    elapsed = time.perf_counter() - start
+    return rounds / elapsed, ""
+
+def batch_fingerprint(batch, i):
+    return (batch.rows(i), int(batch.score[i]), int(batch.lines[i]), BATCH_PIECES[batch.piece[i]], int(batch.x[i]),
+            int(batch.y[i]), int(batch.rotation[i]), bool(batch.game_over[i]))
+
+def check_batch(board, games, steps):
+    """Play random actions on a BatchGame and on one Game per seed; returns the seeds that differ"""
+    rng = random.Random(2)
+    seeds = list(range(games))
+    batch = BatchGame(seeds)
+    singles = [Game(seed, board) for seed in seeds]
+    for _ in range(steps):
+        actions = [rng.randrange(len(ACTIONS)) for _ in seeds]
+        batch.step(np.array(actions))
+        for game, action in zip(singles, actions):
+            game.step([ACTIONS[action]])
+    return [seed for i, (seed, game) in enumerate(zip(seeds, singles))
+            if fingerprint(game) != batch_fingerprint(batch, i)]
+
+def bench_batch(size, steps):
+    actions = np.random.default_rng(0).integers(len(ACTIONS), size=(steps, size))
+    batch = BatchGame(range(size))
+    next_seed = size
+    start = time.perf_counter()
+    for step in range(steps):
+        batch.step(actions[step])
+        over = np.flatnonzero(batch.game_over)
+        if over.size:
+            batch.reset(over, range(next_seed, next_seed + over.size))
+            next_seed += over.size
+    elapsed = time.perf_counter() - start
+    return size * steps / elapsed, f"{size} boards, {next_seed} games"
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the engine's board implementations")
+    parser.add_argument('--boards', nargs='+', default=list(BOARD_TYPES), choices=list(BOARD_TYPES))
+    parser.add_argument('--games', type=int, default=300)
+    parser.add_argument('--pieces', type=int, default=200, help="Most pieces per game")
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--batch', type=int, nargs='*', default=[256, 4096], help="Batch sizes to time")
+    parser.add_argument('--batch-steps', type=int, default=100)
+    args = parser.parse_args()
+
+    # Every implementation has to play exactly the same games before its speed means anything
+    errors = []
+    for seed in range(min(args.games, 100)):
+        expected = fingerprint(play(seed, args.boards[0], args.pieces)[0])
+        for board in args.boards[1:]:
+            if fingerprint(play(seed, board, args.pieces)[0]) != expected:
+                errors.append(f"{board} board diverges from {args.boards[0]} on seed {seed}")
+    if BatchGame is not None and args.batch:
+        errors.extend(f"Batch game diverges from a single game on seed {seed}"
+                      for seed in check_batch(args.boards[0], 100, 300))
+
+    benchmarks = [
+        ('games', 'steps/s', lambda board: bench_games(board, args.games, args.pieces)),
+        ('collide', 'tests/s', lambda board: bench_collide(board, args.rounds)),
+        ('check', 'checks/s', lambda board: bench_check(board, args.rounds * 500)),
+        ('tetris', 'clears/s', lambda board: bench_tetris(board, args.rounds * 50)),
+        ('garbage', 'pushes/s', lambda board: bench_garbage(board, args.rounds * 50)),
+    ]
+    single_game_rate = None
+    for name, unit, run in benchmarks:
+        baseline = None
+        for board in args.boards:
+            rate, extra = run(board)
+            baseline = baseline or rate
+            single_game_rate = single_game_rate or rate
+            print(f"{name:8} {board:6} {rate:12,.0f} {unit:9} x{rate / baseline:5.2f}  {extra}")
+    if BatchGame is None:
+        print("batch    skipped, numpy is not installed")
+    else:
+        for size in args.batch:
+            rate, extra = bench_batch(size, args.batch_steps)
+            print(f"{'batch':8} {size:<6} {rate:12,.0f} {'steps/s':9} x{rate / single_game_rate:5.2f}  {extra}")
+
+    for error in errors[:20]:
+        print(f"FAIL: {error}")
+    if errors:
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
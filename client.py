@@ -3,10 +3,18 @@ import cv2
 import sys
 import glob
 import socket
-import json
 import threading
 import time
 import random
+import queue
+import base64
+from collections import deque
+
+from engine import Game, FALL_SPEED, GRID_WIDTH, GRID_HEIGHT
+from pieces import ROTATIONS
+from protocol import (FrameDecoder, UpdateEncoder, UpdateDecoder, ProtocolError, PROTOCOL_VERSION, UDP_BIND, UDP_DATA,
+                      MAX_DATAGRAM_SIZE, encode_message, encode_frame, decode_message, encode_game_update,
+                      encode_input, decode_input)
 
 # Initialize Pygame
 pygame.init()
@@ -19,6 +27,19 @@ CYAN = (0, 255, 255)
 DARK_BG = (0, 0, 0)
 FONT_PATH = pygame.font.match_font('couriernew', bold=True)
 
+# Keys and the lockstep input each one sends
+KEY_ACTIONS = {
+    pygame.K_LEFT: 'left',
+    pygame.K_RIGHT: 'right',
+    pygame.K_DOWN: 'soft_drop',
+    pygame.K_UP: 'rotate',
+    pygame.K_SPACE: 'hard_drop',
+    pygame.K_c: 'hold'
+}
+
+# Server messages that belong to the match being played; LobbyScreen hands them to the game
+GAME_MESSAGES = {'game_state', 'game_update', 'input', 'keyframe_request', 'game_over'}
+
 # Network settings
 SERVER_HOST = 'localhost'
 SERVER_PORT = 5555
@@ -29,28 +50,174 @@ class Network:
         self.server = SERVER_HOST
         self.port = SERVER_PORT
         self.addr = (self.server, self.port)
+        self.decoder = FrameDecoder()
+        # The main, game-update and reader threads all send; a partial sendall must never interleave
+        self.send_lock = threading.Lock()
+        # Reader threads for the TCP stream and the UDP channel both feed one inbox
+        self.inbox = queue.Queue()
+        self.version = 1  # Protocol version agreed with the server
+        self.udp = None  # UDP socket connected to the server, once it is known to work both ways
+        self.udp_token = None
+        self.hello_received = threading.Event()
+        self.resume_token = None  # Lets us take our seat back after a dropped connection
+        self.login_token = None  # From login_ok; sent in place of our username
+        self.resume_grace = 0
         self.connect()
         
     def connect(self):
         try:
             self.client.connect(self.addr)
+            threading.Thread(target=self.read_tcp, daemon=True).start()
+            self.negotiate_version()
             return True
         except:
             return False
+
+    def negotiate_version(self):
+        """Agree on a protocol version; servers that don't answer 'hello' only speak version 1"""
+        self.send({'command': 'hello', 'version': PROTOCOL_VERSION})
+        self.hello_received.wait(2.0)
+
+    def on_hello(self, message):
+        self.version = message['version']
+        if self.udp is not None:
+            self.udp.close()  # Bound to the previous connection
+            self.udp = None
+        if 'udp_token' in message:
+            self.open_udp(message['udp_port'], bytes.fromhex(message['udp_token']))
+        self.hello_received.set()
+
+    def open_udp(self, port, token):
+        """Try the server's UDP channel; if no probe comes back (UDP blocked), game updates stay on TCP"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe = bytes([UDP_BIND]) + token
+        try:
+            sock.connect((self.server, port))
+            sock.settimeout(0.25)
+            for _ in range(8):
+                try:
+                    sock.send(probe)
+                    if sock.recv(MAX_DATAGRAM_SIZE) == probe:
+                        break
+                except OSError:
+                    continue
+            else:
+                sock.close()
+                return False
+        except OSError:
+            sock.close()
+            return False
+        sock.settimeout(None)
+        self.udp = sock
+        self.udp_token = token
+        threading.Thread(target=self.read_udp, daemon=True).start()
+        self.send({'command': 'udp_ready'})
+        return True
+
+    def read_tcp(self):
+        while True:
+            try:
+                while True:
+                    data = self.client.recv(65536)
+                    if not data:
+                        break
+                    for payload in self.decoder.feed(data):
+                        try:
+                            message = decode_message(payload)
+                        except (ProtocolError, ValueError) as e:
+                            # One bad message isn't a reason to drop a working connection
+                            print(f"Dropping malformed message: {e}")
+                            continue
+                        message_type = message.get('type')
+                        if message_type == 'hello':
+                            self.on_hello(message)
+                        elif message_type == 'session':
+                            self.resume_token = message['resume_token']
+                            self.resume_grace = message['grace']
+                        else:
+                            if message_type == 'resume_failed':
+                                self.resume_token = None
+                            self.inbox.put(message)
+            except:
+                pass
+            if not self.reconnect():
+                break
+        self.inbox.put(None)
+
+    def reconnect(self):
+        """After a drop, reconnect and ask for our seat back while the server still holds it.
+        The server answers with a 'resumed' snapshot (or 'resume_failed')."""
+        if self.resume_token is None:
+            return False
+        try:
+            self.client.close()
+        except OSError:
+            pass
+        deadline = time.time() + self.resume_grace
+        while time.time() < deadline:
+            try:
+                sock = socket.create_connection(self.addr, timeout=2.0)
+            except OSError:
+                time.sleep(0.5)
+                continue
+            sock.settimeout(None)
+            self.client = sock
+            self.decoder = FrameDecoder()
+            self.send({'command': 'hello', 'version': PROTOCOL_VERSION})
+            self.send({'command': 'resume', 'token': self.resume_token})
+            return True
+        return False
+
+    def read_udp(self):
+        while True:
+            try:
+                data = self.udp.recv(MAX_DATAGRAM_SIZE)
+            except OSError:
+                break
+            if data[:1] == bytes([UDP_DATA]):
+                # Decoded like TCP payloads, so nothing that isn't a keyframe or delta is mistaken for one
+                try:
+                    self.inbox.put(decode_message(data[1:]))
+                except (ProtocolError, ValueError) as e:
+                    print(f"Dropping malformed datagram: {e}")
             
     def send(self, data):
         try:
-            self.client.send(json.dumps(data).encode('utf-8'))
+            frame = encode_message(data)
+            with self.send_lock:
+                self.client.sendall(frame)
             return True
         except:
             return False
-            
-    def receive(self):
+
+    def send_payload(self, payload):
+        """Send an already-encoded (e.g. binary) payload"""
         try:
-            data = self.client.recv(1024).decode('utf-8')
-            return json.loads(data)
+            frame = encode_frame(payload)
+            with self.send_lock:
+                self.client.sendall(frame)
+            return True
         except:
-            return None
+            return False
+
+    def send_datagram(self, payload):
+        """Send a game update payload over UDP; returns False (and falls back to TCP for good) if it can't"""
+        if self.udp is None:
+            return False
+        try:
+            self.udp.send(bytes([UDP_DATA]) + self.udp_token + payload)
+            return True
+        except OSError:
+            self.udp = None
+            self.send({'command': 'udp_off'})
+            return False
+            
+    def receive(self):
+        # The login screen reads the inbox, then LobbyScreen's thread; None means the connection is gone
+        message = self.inbox.get()
+        if message is None:
+            self.inbox.put(None)  # Let the other reader see it too
+        return message
 
 # Set up display
 screen = pygame.display.set_mode((WIDTH, HEIGHT))
@@ -89,7 +256,7 @@ def show_loading_screen():
 
     cap.release()
 
-def run_login_screen():
+def run_login_screen(network):
     font = pygame.font.Font(FONT_PATH, 40)
     input_font = pygame.font.Font(FONT_PATH, 32)
 
@@ -119,28 +286,29 @@ def run_login_screen():
                 bg_frame_surface = pygame.surfarray.make_surface(frame.swapaxes(0, 1))
             bg_frame_timer = now
 
-    def check_credentials(username, password):
-        try:
-            with open('players.txt', 'r') as file:
-                for line in file:
-                    if line.strip() and not line.startswith('#'):
-                        stored_username, stored_password = line.strip().split(':')
-                        if stored_username == username:
-                            return stored_password == password
-            return False
-        except FileNotFoundError:
-            return False
-
-    def save_credentials(username, password):
-        try:
-            with open('players.txt', 'a') as file:
-                file.write(f"{username}:{password}\n")
-            return True
-        except Exception as e:
-            print(f"Error saving credentials: {e}")
-            return False
+    # The server checks the password, or creates the account if the name is new
+    waiting = False
 
     while not done:
+        # Answer to our login, if it has arrived
+        if waiting:
+            try:
+                message = network.inbox.get_nowait()
+            except queue.Empty:
+                message = {}
+            if message is None:
+                network.inbox.put(None)  # Connection is gone, leave the marker for other readers
+                waiting = False
+                error_message = "Lost connection to the server"
+                error_timer = pygame.time.get_ticks()
+            elif message.get('type') == 'login_ok':
+                network.login_token = message['token']
+                done = True
+            elif message.get('type') == 'login_failed':
+                waiting = False
+                error_message = message['message']
+                error_timer = pygame.time.get_ticks()
+
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 cap.release()
@@ -151,16 +319,14 @@ def run_login_screen():
                 if event.key == pygame.K_TAB:
                     input_active = "password" if input_active == "username" else "username"
                 elif event.key == pygame.K_RETURN:
-                    if username and password:
-                        if check_credentials(username, password):
-                            done = True
+                    if waiting:
+                        pass
+                    elif username and password:
+                        if network.send({'command': 'login', 'username': username, 'password': password}):
+                            waiting = True
                         else:
-                            # Try to register new user
-                            if save_credentials(username, password):
-                                done = True
-                            else:
-                                error_message = "Error creating account"
-                                error_timer = pygame.time.get_ticks()
+                            error_message = "Cannot reach the server"
+                            error_timer = pygame.time.get_ticks()
                     else:
                         error_message = "Please enter both username and password"
                         error_timer = pygame.time.get_ticks()
@@ -198,7 +364,8 @@ def run_login_screen():
         screen.blit(user_input_surface, (610, 250))
         screen.blit(pass_input_surface, (610, 320))
 
-        instruction = input_font.render("Press TAB to switch fields, ENTER to submit", True, WHITE)
+        instruction = input_font.render("Logging in..." if waiting else "Press TAB to switch fields, ENTER to submit",
+                                        True, WHITE)
         screen.blit(instruction, (WIDTH // 2 - instruction.get_width() // 2, 400))
 
         # Display error message if any
@@ -210,7 +377,7 @@ def run_login_screen():
         clock.tick(FPS)
 
     cap.release()
-    return username, password
+    return username
 
 def get_font(size):
     return pygame.font.Font(FONT_PATH, size)
@@ -287,12 +454,12 @@ class Button:
         )
 
 class LobbyScreen:
-    def __init__(self):
+    def __init__(self, network):
         self.cap = cv2.VideoCapture(r"TETRISBG2.mp4")
         self.bg_frame_timer = 0
         self.bg_fps = 15
         self.bg_frame_surface = None
-        self.network = Network()
+        self.network = network
         self.current_lobby = None
         self.lobby_list = []
         self.receive_thread = None
@@ -303,6 +470,11 @@ class LobbyScreen:
         self.lobby_ready = {}
         self.chat_messages = []
         self.max_chat_messages = 10  # Maximum number of messages to display
+        self.game_seed = None  # Piece seed and sync mode from the server's game_start
+        self.sync_mode = 'state'
+        self.game_inbox = queue.Queue()  # Match traffic, held here until the MultiplayerGame takes it
+        self.leaderboard_page = {'offset': 0, 'total': 0, 'entries': []}  # Latest rows from get_leaderboard
+        self.own_rank = None
 
         self.buttons = [
             Button("Create Lobby", 500, 250, 280, 50, self.create_lobby),
@@ -317,13 +489,23 @@ class LobbyScreen:
         self.receive_thread.start()
 
     def receive_messages(self):
+        # The one reader of the network inbox. Messages for the match go to game_inbox, where they
+        # wait through the countdown until the game starts reading them.
         while True:
-            try:
-                message = self.network.receive()
-                if message:
-                    self.handle_server_message(message)
-            except:
+            message = self.network.receive()
+            if message is None:
+                self.game_inbox.put(None)  # Connection is gone
                 break
+            if message.get('type') in GAME_MESSAGES:
+                self.game_inbox.put(message)
+                continue
+            if message.get('type') == 'resumed':
+                # The lobby takes our seat back from it, the match catches up on what it missed
+                self.game_inbox.put(message)
+            try:
+                self.handle_server_message(message)
+            except (KeyError, TypeError) as e:
+                print(f"Ignoring malformed {message.get('type')} message: {e}")
 
     def handle_server_message(self, message):
         message_type = message.get('type')
@@ -343,10 +525,31 @@ class LobbyScreen:
             self.lobby_players = message['players']
             self.lobby_roles = message['roles']
             self.lobby_ready = message['ready']
+            self.game_seed = message.get('seed')
+            self.sync_mode = message.get('sync', 'state')
+            # Everything after game_start is for the new match, never for the one before
+            self.game_inbox = queue.Queue()
             # Start the game with the assigned roles
             print(f"Game starting! You are {self.player_role}")
+        elif message_type == 'resumed':
+            # Back in our seat after a dropped connection
+            self.current_lobby = message['lobby_id']
+            self.player_role = message['role']
+            self.lobby_players = message['players']
+            self.lobby_roles = message['roles']
+            self.lobby_ready = message['ready']
+        elif message_type == 'player_disconnected':
+            self.chat_messages.append(f"{message['username']} lost connection, holding their seat for {message['grace']:.0f}s")
+        elif message_type == 'player_reconnected':
+            self.chat_messages.append(f"{message['username']} reconnected")
         elif message_type == 'lobby_list':
             self.lobby_list = message['lobbies']
+        elif message_type == 'login_required':
+            print(f"Server refused the request: {message['message']}")
+        elif message_type in ('leaderboard', 'search_results'):
+            self.leaderboard_page = message
+        elif message_type == 'rank':
+            self.own_rank = message
         elif message_type == 'chat_message':
             # Add new message to chat history
             self.chat_messages.append(f"{message['username']}: {message['message']}")
@@ -380,7 +583,7 @@ class LobbyScreen:
     def create_lobby(self):
         if self.network.send({
             'command': 'create_lobby',
-            'username': self.username
+            'token': self.network.login_token
         }):
             self.current_lobby = None  # Will be set when server responds
             self.show_lobby_waiting_screen()
@@ -435,7 +638,7 @@ class LobbyScreen:
         if self.network.send({
             'command': 'join_lobby',
             'lobby_id': lobby_id,
-            'username': self.username
+            'token': self.network.login_token
         }):
             self.current_lobby = lobby_id
             self.player_role = 'player2'  # Joining player is always player2
@@ -455,7 +658,7 @@ class LobbyScreen:
             self.network.send({
                 'command': 'ready',
                 'lobby_id': self.current_lobby,
-                'username': self.username
+                'token': self.network.login_token
             })
 
         def send_chat_message():
@@ -464,7 +667,7 @@ class LobbyScreen:
                 self.network.send({
                     'command': 'chat',
                     'lobby_id': self.current_lobby,
-                    'username': self.username,
+                    'token': self.network.login_token,
                     'message': chat_input.strip()
                 })
                 chat_input = ""
@@ -489,7 +692,8 @@ class LobbyScreen:
                 elapsed = (current_time - countdown_start) / 1000  # Convert to seconds
                 if elapsed >= countdown_time:
                     # Start the game
-                    game = MultiplayerGame(screen, self.network, self.username, self.player_role, self.lobby_players)
+                    game = MultiplayerGame(screen, self.network, self.game_inbox, self.username, self.player_role,
+                                           self.lobby_players, self.game_seed, self.sync_mode)
                     result = game.run()
                     if result == "menu":
                         return
@@ -596,7 +800,7 @@ class LobbyScreen:
             self.network.send({
                 'command': 'leave_lobby',
                 'lobby_id': self.current_lobby,
-                'username': self.username
+                'token': self.network.login_token
             })
             self.current_lobby = None
 
@@ -612,16 +816,29 @@ class LobbyScreen:
                     button.callback()
 
     def leaderboard(self):
-        leaderboard_data = [
-            ("Alice", 1500), ("Bob", 1200), ("Charlie", 1100),
-            ("Dave", 1050), ("Eve", 950), ("Frank", 900),
-            ("Grace", 850), ("Heidi", 800), ("Ivan", 750),
-            ("Judy", 700), ("Mallory", 650), ("Niaj", 600)
-        ]
+        # The server owns the leaderboard and searches it; we keep a window of fetch_rows rows
+        # around the visible ones and only ask for another when scrolling leaves it or the
+        # search changes
+        visible_rows = 10
+        fetch_rows = 50
+        self.leaderboard_page = {'offset': 0, 'total': 0, 'entries': []}
+        self.own_rank = None
+        requested = None  # (query, offset) of the last window asked for
+        search_query = ""
 
-        leaderboard = sorted(leaderboard_data, key=lambda x: x[1], reverse=True)
+        def request_rows(offset):
+            nonlocal requested
+            if (search_query, offset) != requested:
+                requested = (search_query, offset)
+                if search_query:
+                    self.network.send({'command': 'search_leaderboard', 'query': search_query,
+                                       'offset': offset, 'limit': fetch_rows})
+                else:
+                    self.network.send({'command': 'get_leaderboard', 'offset': offset, 'limit': fetch_rows})
+
+        request_rows(0)
+        self.network.send({'command': 'get_rank', 'username': self.username})
         
-        search_query = ""
         input_active = True
         scroll_offset = 0
 
@@ -659,10 +876,12 @@ class LobbyScreen:
                     if input_active:
                         if event.key == pygame.K_BACKSPACE:
                             search_query = search_query[:-1]
+                            scroll_offset = 0
                         elif event.key == pygame.K_RETURN:
                             scroll_offset = 0
-                        else:
+                        elif event.unicode.isprintable() and event.unicode:
                             search_query += event.unicode
+                            scroll_offset = 0
                     if event.key == pygame.K_ESCAPE:
                         running = False
                 elif event.type == pygame.MOUSEBUTTONDOWN:
@@ -690,8 +909,15 @@ class LobbyScreen:
             search_text = small_font.render(placeholder + ("|" if input_active else ""), True, color)
             screen.blit(search_text, (410, 120))
 
-            # Filter leaderboard entries
-            filtered = [(name, score) for name, score in leaderboard if search_query.lower() in name.lower()]
+            # Rows of the fetched window that are on screen, fetching a new window when needed
+            page = self.leaderboard_page
+            stale = page.get('query', '') != search_query  # Still showing an earlier search
+            total = page['total']
+            first = scroll_offset - page['offset']
+            loaded_end = page['offset'] + len(page['entries'])
+            if stale or first < 0 or (first + visible_rows > len(page['entries']) and loaded_end < total):
+                request_rows(max(0, scroll_offset - (fetch_rows - visible_rows) // 2))
+            rows = page['entries'][first:first + visible_rows] if first >= 0 and not stale else []
 
             # Draw leaderboard entries
             start_y = 190
@@ -701,16 +927,13 @@ class LobbyScreen:
                 header_text = header_font.render(title, True, CYAN)
                 screen.blit(header_text, (x, start_y - 30))
 
-            # Table entries
-            for i, (name, score) in enumerate(filtered[scroll_offset:scroll_offset + 10]):
+            # Table entries, ranked by the server
+            for i, entry in enumerate(rows):
                 y = start_y + i * 35
 
-                # Get the real rank from the full sorted leaderboard
-                actual_rank = next(idx for idx, (n, s) in enumerate(leaderboard) if n == name and s == score) + 1
-
-                rank_surface = small_font.render(str(actual_rank), True, WHITE)
-                name_surface = small_font.render(name, True, WHITE)
-                score_surface = small_font.render(str(score), True, WHITE)
+                rank_surface = small_font.render(str(entry['rank']), True, WHITE)
+                name_surface = small_font.render(entry['username'], True, WHITE)
+                score_surface = small_font.render(str(entry['score']), True, WHITE)
 
                 screen.blit(rank_surface, (380, y))
                 screen.blit(name_surface, (470, y))
@@ -718,11 +941,17 @@ class LobbyScreen:
 
             # Scroll if needed (mouse wheel)
             keys = pygame.key.get_pressed()
-            if keys[pygame.K_DOWN] and scroll_offset < len(filtered) - 10:
+            if keys[pygame.K_DOWN] and scroll_offset < total - visible_rows:
                 scroll_offset += 1
             elif keys[pygame.K_UP] and scroll_offset > 0:
                 scroll_offset -= 1
 
+            # Our own standing, wherever it is on the board
+            if self.own_rank and self.own_rank.get('rank'):
+                own_text = small_font.render(f"Your rank: #{self.own_rank['rank']} of {self.own_rank['total']} "
+                                             f"({self.own_rank['score']})", True, CYAN)
+                screen.blit(own_text, (400, 590))
+
             # Draw back button
             back_button.draw(screen)
 
@@ -732,62 +961,40 @@ class LobbyScreen:
         cap.release()
 
 class MultiplayerGame:
-    def __init__(self, screen, network, username, player_role, lobby_players):
+    def __init__(self, screen, network, inbox, username, player_role, lobby_players, seed=None, sync='state'):
         self.screen = screen
         self.network = network
+        self.inbox = inbox  # Our match's messages, from LobbyScreen.receive_messages
         self.username = username
         self.player_role = player_role
         self.lobby_players = lobby_players
+        self.local_player = 'p1' if player_role == 'player1' else 'p2'
+        self.opponent = 'p2' if player_role == 'player1' else 'p1'
+        
+        # 'state' relays snapshots of each board; 'lockstep' relays only inputs and replays the
+        # opponent's game locally, which needs both sides to deal the same pieces from the shared seed
+        self.sync = sync
+        # Both players get the same piece sequence, each game dealing from its own bag. Online
+        # games don't exchange garbage; line clears only score.
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.games = {'p1': Game(seed), 'p2': Game(seed)}
+        self.input_seq = 0
+        self.sent_inputs = []  # Our input payloads, resent if the server missed some while we were disconnected
+        self.remote_inputs = deque()  # Opponent inputs waiting to be replayed on the game thread
+        self.remote_input_seq = 0  # Last opponent input queued for replay
+        self.early_inputs = {}  # {seq: input} that arrived ahead of a missing one
+        self.input_resync_requested = False
+        self.start_time = time.time()
         
         # Game state
-        self.score_p1 = 0
-        self.score_p2 = 0
         self.paused = False
         self.show_help = False
         self.game_over = False
-        self.p1_game_over = False  # Track individual player game over states
-        self.p2_game_over = False
-        
-        # Initialize game boards and pieces
-        self.p1_board = [[0 for _ in range(10)] for _ in range(20)]
-        self.p2_board = [[0 for _ in range(10)] for _ in range(20)]
-        
-        # Initialize piece states
-        self.p1_current_piece = None
-        self.p2_current_piece = None
-        self.p1_next_pieces = []  # Changed to list for three pieces
-        self.p2_next_pieces = []  # Changed to list for three pieces
-        self.p1_hold_piece = None
-        self.p2_hold_piece = None
-        self.p1_piece_pos = [0, 0]
-        self.p2_piece_pos = [0, 0]
-        
-        # Add hold flags
-        self.p1_has_held = False
-        self.p2_has_held = False
         
-        # Store current piece shapes separately from the template
-        self.p1_current_shape = None
-        self.p2_current_shape = None
-        
-        # Game timing
+        # Game timing; gravity is a local input so lockstep can replay it
         self.last_fall_time = time.time()
-        self.fall_speed = 1.0  # Time in seconds between piece falls
-        
-        # Combo tracking
-        self.p1_combo = 0
-        self.p2_combo = 0
-        
-        # Tetromino shapes (templates)
-        self.SHAPES = {
-            'I': [[1, 1, 1, 1]],
-            'O': [[1, 1], [1, 1]],
-            'T': [[0, 1, 0], [1, 1, 1]],
-            'S': [[0, 1, 1], [1, 1, 0]],
-            'Z': [[1, 1, 0], [0, 1, 1]],
-            'J': [[1, 0, 0], [1, 1, 1]],
-            'L': [[0, 0, 1], [1, 1, 1]]
-        }
+        self.fall_speed = FALL_SPEED
 
         # Vibrant colors for each tetromino
         self.COLORS = {
@@ -800,9 +1007,11 @@ class MultiplayerGame:
             'L': (255, 165, 0)     # Orange
         }
         
-        # Start with new pieces for both players
-        self.new_piece('p1')
-        self.new_piece('p2')
+        # Delta-encoded game updates: our outgoing stream and our copy of the opponent's board.
+        # Over UDP every update is a keyframe, so a lost datagram never leaves the opponent stuck.
+        self.update_encoder = UpdateEncoder(keyframe_interval=0 if network.udp else 20)
+        self.opponent_updates = UpdateDecoder()
+        self.keyframe_requested = False
         
         # Start receiving thread for game updates
         self.receive_thread = threading.Thread(target=self.receive_game_updates)
@@ -838,112 +1047,31 @@ class MultiplayerGame:
         self.bg_fps = 15
         self.bg_frame_surface = None
 
-    def new_piece(self, player):
-        """Generate a new piece for the specified player"""
-        shapes = list(self.SHAPES.keys())
-        if player == 'p1':
-            if not self.p1_next_pieces:  # Initialize next pieces if empty
-                self.p1_next_pieces = [random.choice(shapes) for _ in range(3)]
-            self.p1_current_piece = self.p1_next_pieces.pop(0)  # Get first piece
-            self.p1_current_shape = [row[:] for row in self.SHAPES[self.p1_current_piece]]  # Create a copy
-            self.p1_next_pieces.append(random.choice(shapes))  # Add new piece to end
-            self.p1_piece_pos = [3, 0]  # Start position
-            self.p1_has_held = False  # Reset hold flag for new piece
-            
-            # Check if the new piece can be placed
-            if not self.is_valid_move(self.p1_current_shape, self.p1_board, self.p1_piece_pos):
-                self.p1_game_over = True
-                # Send game over status to server
-                self.network.send({
-                    'command': 'game_over',
-                    'player': 'p1',
-                    'score': self.score_p1
-                })
-        else:
-            if not self.p2_next_pieces:  # Initialize next pieces if empty
-                self.p2_next_pieces = [random.choice(shapes) for _ in range(3)]
-            self.p2_current_piece = self.p2_next_pieces.pop(0)  # Get first piece
-            self.p2_current_shape = [row[:] for row in self.SHAPES[self.p2_current_piece]]  # Create a copy
-            self.p2_next_pieces.append(random.choice(shapes))  # Add new piece to end
-            self.p2_piece_pos = [3, 0]  # Start position
-            self.p2_has_held = False  # Reset hold flag for new piece
-            
-            # Check if the new piece can be placed
-            if not self.is_valid_move(self.p2_current_shape, self.p2_board, self.p2_piece_pos):
-                self.p2_game_over = True
-                # Send game over status to server
-                self.network.send({
-                    'command': 'game_over',
-                    'player': 'p2',
-                    'score': self.score_p2
-                })
-
-    def is_valid_move(self, shape, board, pos):
-        """Check if a move is valid"""
-        for y, row in enumerate(shape):
-            for x, cell in enumerate(row):
-                if cell:
-                    board_x = pos[0] + x
-                    board_y = pos[1] + y
-                    if (board_x < 0 or board_x >= 10 or 
-                        board_y >= 20 or 
-                        (board_y >= 0 and board[board_y][board_x])):
-                        return False
-        return True
+    def apply_action(self, player, action):
+        """Apply one input to a player's game. Local keys and replayed opponent inputs both come
+        through here, so the same inputs always produce the same game."""
+        self.games[player].step([action])
 
-    def merge_piece(self, shape, board, pos, piece_type):
-        """Merge the current piece into the board"""
-        for y, row in enumerate(shape):
-            for x, cell in enumerate(row):
-                if cell:
-                    board_y = pos[1] + y
-                    board_x = pos[0] + x
-                    if 0 <= board_y < 20 and 0 <= board_x < 10:
-                        board[board_y][board_x] = piece_type  # Store piece type instead of just 1
-
-    def clear_lines(self, board):
-        """Clear completed lines and return number of lines cleared"""
-        lines_cleared = 0
-        y = 19
-        while y >= 0:
-            if all(board[y]):
-                lines_cleared += 1
-                # Move all lines above down
-                for y2 in range(y, 0, -1):
-                    board[y2] = board[y2-1][:]
-                board[0] = [0] * 10
-            else:
-                y -= 1
-        return lines_cleared
-
-    def hold_piece(self, player):
-        """Handle holding a piece"""
-        if player == 'p1':
-            if not self.p1_has_held:  # Only allow hold if hasn't held this turn
-                if not self.p1_hold_piece:
-                    self.p1_hold_piece = self.p1_current_piece
-                    self.p1_current_piece = self.p1_next_pieces.pop(0)  # Get first piece
-                    self.p1_current_shape = [row[:] for row in self.SHAPES[self.p1_current_piece]]  # Update current shape
-                    self.p1_next_pieces.append(random.choice(list(self.SHAPES.keys())))  # Add new piece to end
-                    self.p1_piece_pos = [3, 0]
-                else:
-                    self.p1_hold_piece, self.p1_current_piece = self.p1_current_piece, self.p1_hold_piece
-                    self.p1_current_shape = [row[:] for row in self.SHAPES[self.p1_current_piece]]  # Update current shape
-                    self.p1_piece_pos = [3, 0]
-                self.p1_has_held = True  # Mark that piece has been held this turn
-        else:
-            if not self.p2_has_held:  # Only allow hold if hasn't held this turn
-                if not self.p2_hold_piece:
-                    self.p2_hold_piece = self.p2_current_piece
-                    self.p2_current_piece = self.p2_next_pieces.pop(0)  # Get first piece
-                    self.p2_current_shape = [row[:] for row in self.SHAPES[self.p2_current_piece]]  # Update current shape
-                    self.p2_next_pieces.append(random.choice(list(self.SHAPES.keys())))  # Add new piece to end
-                    self.p2_piece_pos = [3, 0]
-                else:
-                    self.p2_hold_piece, self.p2_current_piece = self.p2_current_piece, self.p2_hold_piece
-                    self.p2_current_shape = [row[:] for row in self.SHAPES[self.p2_current_piece]]  # Update current shape
-                    self.p2_piece_pos = [3, 0]
-                self.p2_has_held = True  # Mark that piece has been held this turn
+    def local_action(self, action):
+        """Apply one of our own inputs, and in lockstep mode send it to the opponent"""
+        game = self.games[self.local_player]
+        if game.game_over:
+            return
+        self.apply_action(self.local_player, action)
+        if self.sync == 'lockstep':
+            # Sent before any game_over, so the opponent's replay includes the input that topped us out
+            self.input_seq += 1
+            elapsed_ms = int((time.time() - self.start_time) * 1000)
+            payload = encode_input(self.input_seq, elapsed_ms, action)
+            self.sent_inputs.append(payload)
+            self.network.send_payload(payload)
+        if game.game_over:
+            # Our piece topped out; a replayed opponent's own client reports theirs
+            self.network.send({
+                'command': 'game_over',
+                'player': self.local_player,
+                'score': game.score
+            })
 
     def draw_text(self, text, pos, font, color=WHITE, center=False):
         render = font.render(text, True, color)
@@ -960,13 +1088,6 @@ class MultiplayerGame:
         pygame.draw.rect(glow_surface, (*color, 80), glow_surface.get_rect(), border_radius=10)
         self.screen.blit(glow_surface, (rect.x - 10, rect.y - 10))
 
-    def get_shadow_position(self, shape, board, pos):
-        """Calculate where a piece will land"""
-        shadow_pos = list(pos)  # Create a copy of the current position
-        while self.is_valid_move(shape, board, [shadow_pos[0], shadow_pos[1] + 1]):
-            shadow_pos[1] += 1
-        return shadow_pos
-
     def draw_piece_cell(self, rect, color):
         """Draw a single cell of a tetromino with texture effect"""
         # Main cell
@@ -1015,15 +1136,15 @@ class MultiplayerGame:
         p2_score_box = pygame.Rect(self.p2_hold.x, self.p2_hold.bottom + 50, *score_box_size)
         p2_combo_box = pygame.Rect(p2_score_box.x, p2_score_box.bottom + 50, *combo_box_size)
 
+        p1, p2 = self.games['p1'], self.games['p2']
+
         # Draw Playfields
-        for rect, board, current_piece, current_shape, piece_pos in [
-            (self.p1_playfield, self.p1_board, self.p1_current_piece, self.p1_current_shape, self.p1_piece_pos),
-            (self.p2_playfield, self.p2_board, self.p2_current_piece, self.p2_current_shape, self.p2_piece_pos)
-        ]:
+        for rect, game in [(self.p1_playfield, p1), (self.p2_playfield, p2)]:
+            board = game.board.rows()
             # Draw grid
-            cell_size = rect.width // 10
-            for y in range(20):
-                for x in range(10):
+            cell_size = rect.width // GRID_WIDTH
+            for y in range(GRID_HEIGHT):
+                for x in range(GRID_WIDTH):
                     cell_rect = pygame.Rect(
                         rect.x + x * cell_size,
                         rect.y + y * cell_size,
@@ -1039,40 +1160,36 @@ class MultiplayerGame:
                         pygame.draw.rect(self.screen, (0, 0, 0), cell_rect)
             
             # Draw shadow
-            if current_piece and current_shape:
-                shadow_pos = self.get_shadow_position(current_shape, board, piece_pos)
-                for y, row in enumerate(current_shape):
-                    for x, cell in enumerate(row):
-                        if cell:
-                            shadow_rect = pygame.Rect(
-                                rect.x + (shadow_pos[0] + x) * cell_size,
-                                rect.y + (shadow_pos[1] + y) * cell_size,
-                                cell_size - 1,
-                                cell_size - 1
-                            )
-                            # Draw semi-transparent shadow with a consistent color
-                            shadow_surface = pygame.Surface((cell_size - 1, cell_size - 1), pygame.SRCALPHA)
-                            shadow_surface.fill((255, 255, 255, 40))  # White shadow with 15% opacity
-                            self.screen.blit(shadow_surface, shadow_rect)
+            if game.piece and not game.game_over:
+                shadow_y = game.ghost_y()
+                # Semi-transparent shadow with a consistent color
+                shadow_surface = pygame.Surface((cell_size - 1, cell_size - 1), pygame.SRCALPHA)
+                shadow_surface.fill((255, 255, 255, 40))  # White shadow with 15% opacity
+                for x, y in game.cells():
+                    shadow_rect = pygame.Rect(
+                        rect.x + (game.x + x) * cell_size,
+                        rect.y + (shadow_y + y) * cell_size,
+                        cell_size - 1,
+                        cell_size - 1
+                    )
+                    self.screen.blit(shadow_surface, shadow_rect)
             
             # Draw current piece
-            if current_piece and current_shape:
-                for y, row in enumerate(current_shape):
-                    for x, cell in enumerate(row):
-                        if cell:
-                            cell_rect = pygame.Rect(
-                                rect.x + (piece_pos[0] + x) * cell_size,
-                                rect.y + (piece_pos[1] + y) * cell_size,
-                                cell_size - 1,
-                                cell_size - 1
-                            )
-                            color = self.COLORS.get(current_piece, CYAN)
-                            self.draw_piece_cell(cell_rect, color)
+            if game.piece and not game.game_over:
+                color = self.COLORS.get(game.piece, CYAN)
+                for x, y in game.cells():
+                    cell_rect = pygame.Rect(
+                        rect.x + (game.x + x) * cell_size,
+                        rect.y + (game.y + y) * cell_size,
+                        cell_size - 1,
+                        cell_size - 1
+                    )
+                    self.draw_piece_cell(cell_rect, color)
             
             self.draw_glow_rect(rect, CYAN)
 
         # Draw Hold Boxes
-        for rect, hold_piece in [(self.p1_hold, self.p1_hold_piece), (self.p2_hold, self.p2_hold_piece)]:
+        for rect, hold_piece in [(self.p1_hold, p1.hold_piece), (self.p2_hold, p2.hold_piece)]:
             overlay = pygame.Surface(rect.size, pygame.SRCALPHA)
             overlay.fill((0, 0, 0, 120))
             self.screen.blit(overlay, rect)
@@ -1082,7 +1199,7 @@ class MultiplayerGame:
                 self.draw_piece(hold_piece, rect, 0.8)
 
         # Draw Next Boxes with three pieces
-        for rect, next_pieces in [(self.p1_next, self.p1_next_pieces), (self.p2_next, self.p2_next_pieces)]:
+        for rect, next_pieces in [(self.p1_next, p1.next_pieces), (self.p2_next, p2.next_pieces)]:
             overlay = pygame.Surface(rect.size, pygame.SRCALPHA)
             overlay.fill((0, 0, 0, 120))
             self.screen.blit(overlay, rect)
@@ -1097,10 +1214,10 @@ class MultiplayerGame:
 
         # Draw Score and Combo Boxes
         for box, label, value in [
-            (p1_score_box, "Score:", self.score_p1),
-            (p2_score_box, "Score:", self.score_p2),
-            (p1_combo_box, "Combo:", self.p1_combo),
-            (p2_combo_box, "Combo:", self.p2_combo)
+            (p1_score_box, "Score:", p1.score),
+            (p2_score_box, "Score:", p2.score),
+            (p1_combo_box, "Combo:", p1.combo),
+            (p2_combo_box, "Combo:", p2.combo)
         ]:
             self.draw_text(label, (box.x, box.y - 25), get_font(24))
             overlay = pygame.Surface(box.size, pygame.SRCALPHA)
@@ -1175,34 +1292,22 @@ class MultiplayerGame:
         self.screen.blit(game_over_text, game_over_rect)
 
         # Show appropriate message based on game state
-        if self.player_role == 'player1':
-            if self.p1_game_over and not self.p2_game_over:
-                status_text = f"Waiting for {p2_name} to finish..."
-            elif self.p1_game_over and self.p2_game_over:
-                if self.score_p1 > self.score_p2:
-                    status_text = f"You Win! {self.score_p1} - {self.score_p2}"
-                elif self.score_p2 > self.score_p1:
-                    status_text = f"You Lose! {self.score_p1} - {self.score_p2}"
-                else:
-                    status_text = f"It's a Tie! {self.score_p1} - {self.score_p2}"
-        else:  # player2
-            if self.p2_game_over and not self.p1_game_over:
-                status_text = f"Waiting for {p1_name} to finish..."
-            elif self.p2_game_over and self.p1_game_over:
-                if self.score_p2 > self.score_p1:
-                    status_text = f"You Win! {self.score_p2} - {self.score_p1}"
-                elif self.score_p1 > self.score_p2:
-                    status_text = f"You Lose! {self.score_p2} - {self.score_p1}"
-                else:
-                    status_text = f"It's a Tie! {self.score_p2} - {self.score_p1}"
+        mine, theirs = self.games[self.local_player], self.games[self.opponent]
+        if not theirs.game_over:
+            status_text = f"Waiting for {p2_name if self.local_player == 'p1' else p1_name} to finish..."
+        elif mine.score > theirs.score:
+            status_text = f"You Win! {mine.score} - {theirs.score}"
+        elif theirs.score > mine.score:
+            status_text = f"You Lose! {mine.score} - {theirs.score}"
+        else:
+            status_text = f"It's a Tie! {mine.score} - {theirs.score}"
 
         status_surface = status_font.render(status_text, True, (255, 255, 255))
         status_rect = status_surface.get_rect(center=(WIDTH // 2, 220))
         self.screen.blit(status_surface, status_rect)
 
         # Only show buttons when both players are done
-        if (self.player_role == 'player1' and self.p1_game_over and self.p2_game_over) or \
-           (self.player_role == 'player2' and self.p2_game_over and self.p1_game_over):
+        if self.both_done():
             # Draw buttons with hover effect
             button_font = get_font(28)
             mouse_pos = pygame.mouse.get_pos()
@@ -1226,92 +1331,101 @@ class MultiplayerGame:
             self.screen.blit(exit_text, exit_rect)
 
     def receive_game_updates(self):
+        caught_up = deque()  # Messages unpacked from a 'resumed' snapshot, handled before new ones
         while True:
             try:
-                message = self.network.receive()
+                message = caught_up.popleft() if caught_up else self.inbox.get()
+                if message is None:
+                    break  # Connection gone, or the match is over
+                if message and message.get('type') == 'resumed':
+                    caught_up.extend(self.catch_up(message))
+                    continue
+                if message and message.get('type') == 'game_state':
+                    message = self.apply_game_state(message['payload'])
                 if message:
-                    if message.get('type') == 'player_joined':
-                        # Update opponent's name when they join
-                        if self.player_role == 'player1':
-                            self.player2_name = message.get('username')
-                        else:
-                            self.player1_name = message.get('username')
-                    elif message.get('type') == 'lobby_info':
-                        # Update player names from lobby info
-                        players = message.get('players', [])
-                        roles = message.get('roles', {})
-                        for player in players:
-                            if player != self.username:
-                                if roles.get(player) == 'player1':
-                                    self.player1_name = player
-                                else:
-                                    self.player2_name = player
-                    elif message.get('type') == 'game_update':
+                    if message.get('type') == 'game_update':
                         # Update opponent's game state
                         if message.get('sender') != self.username:
-                            if self.player_role == 'player1':
-                                self.p2_board = message.get('board', self.p2_board)
-                                self.score_p2 = message.get('score', self.score_p2)
-                                self.p2_combo = message.get('combo', self.p2_combo)
-                                self.p2_current_piece = message.get('current_piece', self.p2_current_piece)
-                                self.p2_next_pieces = message.get('next_pieces', self.p2_next_pieces)
-                                self.p2_hold_piece = message.get('hold_piece', self.p2_hold_piece)
-                                self.p2_piece_pos = message.get('piece_pos', self.p2_piece_pos)
-                                # Update the current shape when piece changes
-                                if self.p2_current_piece:
-                                    self.p2_current_shape = [row[:] for row in self.SHAPES[self.p2_current_piece]]
-                            else:
-                                self.p1_board = message.get('board', self.p1_board)
-                                self.score_p1 = message.get('score', self.score_p1)
-                                self.p1_combo = message.get('combo', self.p1_combo)
-                                self.p1_current_piece = message.get('current_piece', self.p1_current_piece)
-                                self.p1_next_pieces = message.get('next_pieces', self.p1_next_pieces)
-                                self.p1_hold_piece = message.get('hold_piece', self.p1_hold_piece)
-                                self.p1_piece_pos = message.get('piece_pos', self.p1_piece_pos)
-                                # Update the current shape when piece changes
-                                if self.p1_current_piece:
-                                    self.p1_current_shape = [row[:] for row in self.SHAPES[self.p1_current_piece]]
-                    elif message.get('type') == 'game_over':
-                        # Update game over status for the other player
-                        if message.get('player') == 'p1':
-                            self.p1_game_over = True
-                        elif message.get('player') == 'p2':
-                            self.p2_game_over = True
-            except:
-                break
+                            self.games[self.opponent].load_state(message)
+                    elif message.get('type') == 'input':
+                        self.queue_remote_input(message)
+                    elif message.get('type') == 'keyframe_request':
+                        # Opponent (or the server) lost track of our board
+                        self.update_encoder.request_keyframe()
+                    elif message.get('type') == 'game_over' and self.sync != 'lockstep':
+                        # Update game over status for the other player. In lockstep the replayed
+                        # game tops out by itself once its queued inputs have run; ending it here,
+                        # on this thread, would drop those and leave a different final board.
+                        if message.get('player') in self.games:
+                            self.games[message['player']].game_over = True
+            except (ProtocolError, ValueError, KeyError, TypeError) as e:
+                # Skip just this message (bad base64 in a catch-up, a missing field, ...); the thread
+                # has to outlive it or the opponent's board freezes
+                print(f"Skipping malformed game message: {e!r}")
+
+    def queue_remote_input(self, message):
+        """Queue an opponent input (lockstep mode) for replay on the game thread, strictly in sequence.
+        A catch-up after a reconnect can repeat inputs we already have."""
+        if message['seq'] <= self.remote_input_seq:
+            return
+        self.early_inputs[message['seq']] = message
+        while self.remote_input_seq + 1 in self.early_inputs:
+            self.remote_input_seq += 1
+            self.remote_inputs.append(self.early_inputs.pop(self.remote_input_seq))
+        if not self.early_inputs:
+            self.input_resync_requested = False
+        elif not self.input_resync_requested:
+            # Replaying past a lost input would desync the opponent's game for good; ask once per gap
+            self.input_resync_requested = True
+            self.network.send({'command': 'resync_inputs', 'after': self.remote_input_seq})
+
+    def catch_up(self, message):
+        """Unpack a 'resumed' snapshot into the update and input messages we missed while disconnected"""
+        messages = []
+        self.update_encoder.request_keyframe()  # The opponent may have missed our updates too
+        for username, frames in message.get('updates', {}).items():
+            if username != self.username:
+                messages.extend(decode_message(payload) for payload in FrameDecoder().feed(base64.b64decode(frames)))
+        for username, frames in message.get('inputs', {}).items():
+            inputs = [decode_input(payload) for payload in FrameDecoder().feed(base64.b64decode(frames))]
+            if username == self.username:
+                # Resend whatever of ours never reached the server, or the opponent's replay would diverge
+                for payload in self.sent_inputs[len(inputs):]:
+                    self.network.send_payload(payload)
+            else:
+                messages.extend(inputs)
+        return messages
+
+    def apply_game_state(self, payload):
+        """Apply an opponent keyframe or row delta to our copy of their board"""
+        message = self.opponent_updates.apply(payload)
+        if self.opponent_updates.needs_keyframe:
+            # Ask once per gap; the flag clears when the keyframe arrives
+            if not self.keyframe_requested:
+                self.keyframe_requested = True
+                self.network.send({'command': 'request_keyframe'})
+        else:
+            self.keyframe_requested = False
+        return message
 
     def send_game_update(self):
         """Send current game state to the server"""
-        if self.player_role == 'player1':
-            game_state = {
-                'command': 'game_update',
-                'board': self.p1_board,
-                'score': self.score_p1,
-                'combo': self.p1_combo,
-                'current_piece': self.p1_current_piece,
-                'next_pieces': self.p1_next_pieces,
-                'hold_piece': self.p1_hold_piece,
-                'piece_pos': self.p1_piece_pos
-            }
+        game_state = {'command': 'game_update', **self.games[self.local_player].state()}
+        if self.network.version >= 3:
+            payload = self.update_encoder.encode(game_state)
+            if not self.network.send_datagram(payload):
+                self.network.send_payload(payload)
+        elif self.network.version >= 2:
+            self.network.send_payload(encode_game_update(game_state))
         else:
-            game_state = {
-                'command': 'game_update',
-                'board': self.p2_board,
-                'score': self.score_p2,
-                'combo': self.p2_combo,
-                'current_piece': self.p2_current_piece,
-                'next_pieces': self.p2_next_pieces,
-                'hold_piece': self.p2_hold_piece,
-                'piece_pos': self.p2_piece_pos
-            }
-        self.network.send(game_state)
+            self.network.send(game_state)
 
     def draw_piece(self, piece, rect, scale=1.0):
         """Draw a tetromino piece in the specified rectangle"""
         if not piece:
             return
             
-        shape = self.SHAPES[piece]
+        cells = ROTATIONS[piece][0]
         cell_size = min(rect.width // 4, rect.height // 4) * scale
         
         # Calculate center position
@@ -1319,39 +1433,21 @@ class MultiplayerGame:
         center_y = rect.y + rect.height // 2
         
         # Calculate offset to center the piece
-        offset_x = center_x - (len(shape[0]) * cell_size) // 2
-        offset_y = center_y - (len(shape) * cell_size) // 2
+        offset_x = center_x - ((1 + max(x for x, _ in cells)) * cell_size) // 2
+        offset_y = center_y - ((1 + max(y for _, y in cells)) * cell_size) // 2
         
-        for y, row in enumerate(shape):
-            for x, cell in enumerate(row):
-                if cell:
-                    cell_rect = pygame.Rect(
-                        offset_x + x * cell_size,
-                        offset_y + y * cell_size,
-                        cell_size - 1,
-                        cell_size - 1
-                    )
-                    color = self.COLORS.get(piece, CYAN)
-                    self.draw_piece_cell(cell_rect, color)
-
-    def rotate_piece(self, shape):
-        """Rotate a piece 90 degrees clockwise"""
-        # Create a new rotated shape without modifying the original
-        return [list(row) for row in zip(*shape[::-1])]
-
-    def is_valid_rotation(self, shape, board, pos):
-        """Check if a rotation is valid"""
-        rotated = self.rotate_piece(shape)
-        for y, row in enumerate(rotated):
-            for x, cell in enumerate(row):
-                if cell:
-                    board_x = pos[0] + x
-                    board_y = pos[1] + y
-                    if (board_x < 0 or board_x >= 10 or 
-                        board_y >= 20 or 
-                        (board_y >= 0 and board[board_y][board_x])):
-                        return False
-        return True
+        color = self.COLORS.get(piece, CYAN)
+        for x, y in cells:
+            cell_rect = pygame.Rect(
+                offset_x + x * cell_size,
+                offset_y + y * cell_size,
+                cell_size - 1,
+                cell_size - 1
+            )
+            self.draw_piece_cell(cell_rect, color)
+
+    def both_done(self):
+        return self.games['p1'].game_over and self.games['p2'].game_over
 
     def run(self):
         running = True
@@ -1361,133 +1457,29 @@ class MultiplayerGame:
         while running:
             clock.tick(60)  # Increased FPS for smoother gameplay
             
-            # Send periodic game updates
+            # Send periodic game updates (lockstep sends each input as it happens instead)
             current_time = time.time()
-            if current_time - last_update_time >= update_interval:
+            if self.sync != 'lockstep' and current_time - last_update_time >= update_interval:
                 self.send_game_update()
                 last_update_time = current_time
             
+            # Replay the opponent's inputs in the order they were made
+            while self.remote_inputs:
+                self.apply_action(self.opponent, self.remote_inputs.popleft()['action'])
+            
             # Handle piece falling
             current_time = time.time()
             if current_time - self.last_fall_time > self.fall_speed and not self.game_over:
                 self.last_fall_time = current_time
-                
-                # Move pieces down
-                if self.player_role == 'player1' and not self.p1_game_over:
-                    if self.p1_current_piece:
-                        new_pos = [self.p1_piece_pos[0], self.p1_piece_pos[1] + 1]
-                        if self.is_valid_move(self.p1_current_shape, self.p1_board, new_pos):
-                            self.p1_piece_pos = new_pos
-                        else:
-                            self.merge_piece(self.p1_current_shape, self.p1_board, self.p1_piece_pos, self.p1_current_piece)
-                            lines = self.clear_lines(self.p1_board)
-                            if lines > 0:
-                                self.p1_combo += 1
-                                self.score_p1 += lines * 100 * self.p1_combo
-                                # Immediately spawn new piece after clearing lines
-                                self.new_piece('p1')
-                                self.p1_current_shape = [row[:] for row in self.SHAPES[self.p1_current_piece]]
-                            else:
-                                self.p1_combo = 0
-                                self.new_piece('p1')
-                                self.p1_current_shape = [row[:] for row in self.SHAPES[self.p1_current_piece]]
-                elif self.player_role == 'player2' and not self.p2_game_over:
-                    if self.p2_current_piece:
-                        new_pos = [self.p2_piece_pos[0], self.p2_piece_pos[1] + 1]
-                        if self.is_valid_move(self.p2_current_shape, self.p2_board, new_pos):
-                            self.p2_piece_pos = new_pos
-                        else:
-                            self.merge_piece(self.p2_current_shape, self.p2_board, self.p2_piece_pos, self.p2_current_piece)
-                            lines = self.clear_lines(self.p2_board)
-                            if lines > 0:
-                                self.p2_combo += 1
-                                self.score_p2 += lines * 100 * self.p2_combo
-                                # Immediately spawn new piece after clearing lines
-                                self.new_piece('p2')
-                                self.p2_current_shape = [row[:] for row in self.SHAPES[self.p2_current_piece]]
-                            else:
-                                self.p2_combo = 0
-                                self.new_piece('p2')
-                                self.p2_current_shape = [row[:] for row in self.SHAPES[self.p2_current_piece]]
+                self.local_action('gravity')
 
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     running = False
 
                 if not self.game_over and not self.paused:
-                    if event.type == pygame.KEYDOWN:
-                        if self.player_role == 'player1' and not self.p1_game_over:
-                            if event.key == pygame.K_LEFT:
-                                new_pos = [self.p1_piece_pos[0] - 1, self.p1_piece_pos[1]]
-                                if self.is_valid_move(self.p1_current_shape, self.p1_board, new_pos):
-                                    self.p1_piece_pos = new_pos
-                            elif event.key == pygame.K_RIGHT:
-                                new_pos = [self.p1_piece_pos[0] + 1, self.p1_piece_pos[1]]
-                                if self.is_valid_move(self.p1_current_shape, self.p1_board, new_pos):
-                                    self.p1_piece_pos = new_pos
-                            elif event.key == pygame.K_DOWN:
-                                new_pos = [self.p1_piece_pos[0], self.p1_piece_pos[1] + 1]
-                                if self.is_valid_move(self.p1_current_shape, self.p1_board, new_pos):
-                                    self.p1_piece_pos = new_pos
-                            elif event.key == pygame.K_UP:
-                                # Rotate piece
-                                if self.is_valid_rotation(self.p1_current_shape, self.p1_board, self.p1_piece_pos):
-                                    self.p1_current_shape = self.rotate_piece(self.p1_current_shape)
-                            elif event.key == pygame.K_SPACE:
-                                # Hard drop
-                                while self.is_valid_move(self.p1_current_shape, self.p1_board, 
-                                                       [self.p1_piece_pos[0], self.p1_piece_pos[1] + 1]):
-                                    self.p1_piece_pos[1] += 1
-                                self.merge_piece(self.p1_current_shape, self.p1_board, self.p1_piece_pos, self.p1_current_piece)
-                                lines = self.clear_lines(self.p1_board)
-                                if lines > 0:
-                                    self.p1_combo += 1
-                                    self.score_p1 += lines * 100 * self.p1_combo
-                                    # Immediately spawn new piece after clearing lines
-                                    self.new_piece('p1')
-                                    self.p1_current_shape = [row[:] for row in self.SHAPES[self.p1_current_piece]]
-                                else:
-                                    self.p1_combo = 0
-                                    self.new_piece('p1')
-                                    self.p1_current_shape = [row[:] for row in self.SHAPES[self.p1_current_piece]]
-                            elif event.key == pygame.K_c:
-                                self.hold_piece('p1')
-                        elif self.player_role == 'player2' and not self.p2_game_over:
-                            if event.key == pygame.K_LEFT:
-                                new_pos = [self.p2_piece_pos[0] - 1, self.p2_piece_pos[1]]
-                                if self.is_valid_move(self.p2_current_shape, self.p2_board, new_pos):
-                                    self.p2_piece_pos = new_pos
-                            elif event.key == pygame.K_RIGHT:
-                                new_pos = [self.p2_piece_pos[0] + 1, self.p2_piece_pos[1]]
-                                if self.is_valid_move(self.p2_current_shape, self.p2_board, new_pos):
-                                    self.p2_piece_pos = new_pos
-                            elif event.key == pygame.K_DOWN:
-                                new_pos = [self.p2_piece_pos[0], self.p2_piece_pos[1] + 1]
-                                if self.is_valid_move(self.p2_current_shape, self.p2_board, new_pos):
-                                    self.p2_piece_pos = new_pos
-                            elif event.key == pygame.K_UP:
-                                # Rotate piece
-                                if self.is_valid_rotation(self.p2_current_shape, self.p2_board, self.p2_piece_pos):
-                                    self.p2_current_shape = self.rotate_piece(self.p2_current_shape)
-                            elif event.key == pygame.K_SPACE:
-                                # Hard drop
-                                while self.is_valid_move(self.p2_current_shape, self.p2_board, 
-                                                       [self.p2_piece_pos[0], self.p2_piece_pos[1] + 1]):
-                                    self.p2_piece_pos[1] += 1
-                                self.merge_piece(self.p2_current_shape, self.p2_board, self.p2_piece_pos, self.p2_current_piece)
-                                lines = self.clear_lines(self.p2_board)
-                                if lines > 0:
-                                    self.p2_combo += 1
-                                    self.score_p2 += lines * 100 * self.p2_combo
-                                    # Immediately spawn new piece after clearing lines
-                                    self.new_piece('p2')
-                                    self.p2_current_shape = [row[:] for row in self.SHAPES[self.p2_current_piece]]
-                                else:
-                                    self.p2_combo = 0
-                                    self.new_piece('p2')
-                                    self.p2_current_shape = [row[:] for row in self.SHAPES[self.p2_current_piece]]
-                            elif event.key == pygame.K_c:
-                                self.hold_piece('p2')
+                    if event.type == pygame.KEYDOWN and event.key in KEY_ACTIONS:
+                        self.local_action(KEY_ACTIONS[event.key])
 
                 if event.type == pygame.MOUSEBUTTONDOWN and self.pause_button.collidepoint(event.pos):
                     self.paused = not self.paused
@@ -1501,18 +1493,15 @@ class MultiplayerGame:
                             self.show_help = not self.show_help
                         elif event.key == pygame.K_q:
                             running = False
-                elif ((self.player_role == 'player1' and self.p1_game_over and self.p2_game_over) or 
-                      (self.player_role == 'player2' and self.p2_game_over and self.p1_game_over)) and \
-                     event.type == pygame.MOUSEBUTTONDOWN:
+                elif self.both_done() and event.type == pygame.MOUSEBUTTONDOWN:
                     if self.btn_main_menu.collidepoint(event.pos):
-                        return "menu"
+                        return self.finish("menu")
                     elif self.btn_exit_game.collidepoint(event.pos):
                         running = False
 
             self.draw_video_background()
 
-            if (self.player_role == 'player1' and self.p1_game_over) or \
-               (self.player_role == 'player2' and self.p2_game_over):
+            if self.games[self.local_player].game_over:
                 self.draw_game_over()
             else:
                 self.draw_playfield()
@@ -1521,19 +1510,25 @@ class MultiplayerGame:
 
             pygame.display.flip()
 
+        return self.finish("exit")
+
+    def finish(self, result):
+        """Leave the match screen: stop the update thread and release the background video"""
+        self.inbox.put(None)
         self.cap.release()
-        return "exit"
+        return result
 
 def main():
     # Play loading video and wait for key press
     show_loading_screen()
 
-    # Show login screen and get username and password
-    username, password = run_login_screen()
-    print(f"Username: {username}, Password: {password}")
+    # Log in through the server
+    network = Network()
+    username = run_login_screen(network)
+    print(f"Logged in as {username}")
 
     # Start lobby screen loop
-    lobby_screen = LobbyScreen()
+    lobby_screen = LobbyScreen(network)
     lobby_screen.username = username
     lobby_screen.start_receive_thread()
 
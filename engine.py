@@ -0,0 +1,373 @@
+import random
+
+from pieces import ROTATIONS, SHAPES, SevenBag
+from protocol import CODE_PIECES, PIECE_CODES
+
+try:
+    import numpy as np  # Optional; only the 'numpy' board needs it
+except ImportError:
+    np = None
+
+# Tetris rules without any pygame or cv2, shared by the local two-player game (MULTIPLAYER.py) and
+# the online client. A Game only changes through step(), so the rules can be run headlessly -
+# simulations, benchmarks, bots - and the same seed and inputs always give the same game.
+
+GRID_WIDTH = 10
+GRID_HEIGHT = 20
+NEXT_COUNT = 3  # Pieces shown in the next queue
+FALL_SPEED = 0.5  # Seconds per gravity step
+LINE_SCORES = {1: 100, 2: 300, 3: 500, 4: 800}  # Multiplied by the combo
+GARBAGE_FOR_LINES = {2: 1, 3: 2, 4: 4}  # Garbage lines sent to the opponent
+WALL_KICKS = [(1, 0), (-1, 0), (0, -1), (1, -1), (-1, -1)]  # Offsets tried when a rotation collides
+# Everything a player can do to their game; 'gravity' is one step of the fall timer
+ACTIONS = ('left', 'right', 'soft_drop', 'rotate', 'hard_drop', 'hold', 'gravity')
+MOVES = {'left': (-1, 0), 'right': (1, 0), 'soft_drop': (0, 1)}
+
+def row_masks(cells, width=GRID_WIDTH):
+    """{x: ((dy, row bitmask), ...)} for cells placed at every column x where they fit the width"""
+    masks = {}
+    for dx, dy in cells:
+        masks[dy] = masks.get(dy, 0) | 1 << dx
+    xs = [dx for dx, _ in cells]
+    return {x: tuple((dy, mask << x) for dy, mask in sorted(masks.items()))
+            for x in range(-min(xs), width - max(xs))}
+
+# PIECE_MASKS[piece][rotation][x], the bitboard form of ROTATIONS, already shifted to column x
+PIECE_MASKS = {piece: tuple(row_masks(cells) for cells in rotations) for piece, rotations in ROTATIONS.items()}
+
+class Board:
+    """Grid of cells: 0 when empty, otherwise the type of the piece that filled it ('G' for garbage)"""
+    def __init__(self, width=GRID_WIDTH, height=GRID_HEIGHT):
+        self.width = width
+        self.height = height
+        self.grid = [[0] * width for _ in range(height)]
+
+    def cell(self, x, y):
+        return self.grid[y][x]
+
+    def rows(self):
+        """The grid as a list of rows, for drawing and network updates"""
+        return self.grid
+
+    def load_rows(self, rows):
+        self.grid = [list(row) for row in rows]
+
+    def collides(self, piece, rotation, x, y):
+        """Whether the piece placed at (x, y) overlaps a wall, the floor or a filled cell. Cells
+        above the top row are allowed so pieces can spawn and rotate there."""
+        grid = self.grid
+        width, height = self.width, self.height
+        for dx, dy in ROTATIONS[piece][rotation]:
+            bx, by = x + dx, y + dy
+            if bx < 0 or bx >= width or by >= height or (by >= 0 and grid[by][bx]):
+                return True
+        return False
+
+    def lock(self, piece, rotation, x, y):
+        for dx, dy in ROTATIONS[piece][rotation]:
+            if y + dy >= 0:
+                self.grid[y + dy][x + dx] = piece
+
+    def clear_lines(self):
+        """Remove full rows, dropping the ones above; returns how many were removed"""
+        kept = [row for row in self.grid if not all(row)]
+        cleared = self.height - len(kept)
+        if cleared:
+            self.grid = [[0] * self.width for _ in range(cleared)] + kept
+        return cleared
+
+    def add_garbage(self, holes):
+        """Push one garbage row per hole column in from the bottom; the top rows fall off"""
+        garbage = [['G'] * self.width for _ in holes]
+        for row, hole in zip(garbage, holes):
+            row[hole] = 0
+        self.grid = self.grid[len(garbage):] + garbage
+
+class BitBoard:
+    """Board with each row held as an int, bit x set when column x is filled.
+
+    A piece is a few row masks shifted left by its column, so a collision test is one AND per
+    piece row, a full line is row == full, and clears and garbage are list splices. Which piece
+    filled each cell - only needed for drawing - is kept in a parallel plane of lists that is
+    spliced the same way."""
+    def __init__(self, width=GRID_WIDTH, height=GRID_HEIGHT):
+        self.width = width
+        self.height = height
+        self.full = (1 << width) - 1
+        self.bits = [0] * height
+        self.colors = [[0] * width for _ in range(height)]
+
+    def cell(self, x, y):
+        return self.colors[y][x]
+
+    def rows(self):
+        return self.colors
+
+    def load_rows(self, rows):
+        self.colors = [list(row) for row in rows]
+        self.bits = [sum(1 << x for x, filled in enumerate(row) if filled) for row in self.colors]
+
+    def collides(self, piece, rotation, x, y):
+        masks = PIECE_MASKS[piece][rotation].get(x)
+        if masks is None:
+            return True  # Sticks out through a wall
+        bits = self.bits
+        height = self.height
+        for dy, mask in masks:
+            by = y + dy
+            if by >= height or (by >= 0 and bits[by] & mask):
+                return True
+        return False
+
+    def lock(self, piece, rotation, x, y):
+        bits = self.bits
+        for dy, mask in PIECE_MASKS[piece][rotation][x]:
+            if y + dy >= 0:
+                bits[y + dy] |= mask
+        colors = self.colors
+        for dx, dy in ROTATIONS[piece][rotation]:
+            if y + dy >= 0:
+                colors[y + dy][x + dx] = piece
+
+    def clear_lines(self):
+        bits = self.bits
+        cleared = bits.count(self.full)
+        if cleared:
+            colors = self.colors
+            for _ in range(cleared):
+                y = bits.index(self.full)
+                del bits[y]
+                del colors[y]
+            bits[0:0] = [0] * cleared
+            colors[0:0] = [[0] * self.width for _ in range(cleared)]
+        return cleared
+
+    def add_garbage(self, holes):
+        count = len(holes)
+        garbage = [['G'] * self.width for _ in holes]
+        for row, hole in zip(garbage, holes):
+            row[hole] = 0
+        self.bits = self.bits[count:] + [self.full & ~(1 << hole) for hole in holes]
+        self.colors = self.colors[count:] + garbage
+
+class NumpyBoard:
+    """Board held in a uint8 array of the protocol's cell codes.
+
+    Full-row detection, compaction and garbage insertion are whole-array operations. Single-cell
+    work (collision, locking) stays a short Python loop, which beats numpy's per-call overhead
+    for four cells. rows() converts back to piece letters and is cached until the board changes."""
+    def __init__(self, width=GRID_WIDTH, height=GRID_HEIGHT):
+        self.width = width
+        self.height = height
+        self.grid = np.zeros((height, width), dtype=np.uint8)
+        self.cached_rows = None
+
+    def cell(self, x, y):
+        return CODE_PIECES[self.grid.item(y, x)]
+
+    def rows(self):
+        if self.cached_rows is None:
+            self.cached_rows = [[CODE_PIECES[code] for code in row] for row in self.grid.tolist()]
+        return self.cached_rows
+
+    def load_rows(self, rows):
+        self.grid = np.array([[PIECE_CODES[cell] for cell in row] for row in rows], dtype=np.uint8)
+        self.cached_rows = None
+
+    def collides(self, piece, rotation, x, y):
+        item = self.grid.item  # Plain ints; indexing would box every cell in a numpy scalar
+        width, height = self.width, self.height
+        for dx, dy in ROTATIONS[piece][rotation]:
+            bx, by = x + dx, y + dy
+            if bx < 0 or bx >= width or by >= height or (by >= 0 and item(by, bx)):
+                return True
+        return False
+
+    def lock(self, piece, rotation, x, y):
+        code = PIECE_CODES[piece]
+        for dx, dy in ROTATIONS[piece][rotation]:
+            if y + dy >= 0:
+                self.grid[y + dy, x + dx] = code
+        self.cached_rows = None
+
+    def clear_lines(self):
+        full = self.grid.all(axis=1)
+        if not full.any():
+            return 0
+        cleared = int(np.count_nonzero(full))
+        self.grid = np.concatenate((np.zeros((cleared, self.width), dtype=np.uint8), self.grid[~full]))
+        self.cached_rows = None
+        return cleared
+
+    def add_garbage(self, holes):
+        garbage = np.full((len(holes), self.width), PIECE_CODES['G'], dtype=np.uint8)
+        garbage[np.arange(len(holes)), holes] = 0
+        self.grid = np.concatenate((self.grid[len(holes):], garbage))
+        self.cached_rows = None
+
+# Board implementations by name; they all behave the same and differ only in speed
+BOARD_TYPES = {'list': Board, 'bits': BitBoard}
+# Opt-in, never the default: only there when numpy imports, and slower than 'bits' at 20x10
+if np is not None:
+    BOARD_TYPES['numpy'] = NumpyBoard
+DEFAULT_BOARD = 'bits'
+
+class Game:
+    """One player's game: board, falling piece, queue, hold, score"""
+    def __init__(self, seed=None, board=DEFAULT_BOARD):
+        self.bag = SevenBag(seed)  # Games given the same seed get the same pieces
+        self.garbage_rng = random.Random(f"{self.bag.seed}:garbage")  # Garbage holes, seeded too
+        self.board = BOARD_TYPES[board]()
+        self.piece = None  # Type of the falling piece
+        self.rotation = 0  # Quarter turns clockwise from the spawn orientation
+        self.x = 0
+        self.y = 0
+        self.next_pieces = []
+        self.hold_piece = None
+        self.can_hold = True
+        self.score = 0
+        self.combo = 0
+        self.lines = 0
+        self.garbage_out = 0  # Garbage produced and not yet returned by step()
+        self.garbage_sent = 0
+        self.fall_time = 0.0
+        self.game_over = False
+        self.spawn()
+
+    def cells(self):
+        """(dx, dy) offsets of the falling piece's cells in its current orientation"""
+        return ROTATIONS[self.piece][self.rotation]
+
+    def collides(self, rotation, x, y):
+        return self.board.collides(self.piece, rotation, x, y)
+
+    def step(self, inputs=(), dt=0.0):
+        """Apply inputs (action names, in order), then let dt seconds of gravity pass. Returns the
+        number of garbage lines this produced for the opponent."""
+        for action in inputs:
+            self.apply(action)
+        if dt and not self.game_over:
+            self.fall_time += dt
+            while self.fall_time >= FALL_SPEED and not self.game_over:
+                self.fall_time -= FALL_SPEED
+                self.apply('gravity')
+        garbage, self.garbage_out = self.garbage_out, 0
+        return garbage
+
+    def apply(self, action):
+        if self.game_over:
+            return
+        if action in MOVES:
+            self.move(*MOVES[action])
+        elif action == 'rotate':
+            self.rotate()
+        elif action == 'hold':
+            self.hold()
+        elif action == 'hard_drop':
+            self.y = self.ghost_y()
+            self.lock()
+        elif action == 'gravity':
+            if not self.move(0, 1):
+                self.lock()
+        else:
+            raise ValueError(f"Unknown action {action!r}")
+
+    def move(self, dx, dy):
+        if self.collides(self.rotation, self.x + dx, self.y + dy):
+            return False
+        self.x += dx
+        self.y += dy
+        return True
+
+    def rotate(self):
+        rotation = (self.rotation + 1) % 4
+        for dx, dy in [(0, 0)] + WALL_KICKS:
+            if not self.collides(rotation, self.x + dx, self.y + dy):
+                self.rotation = rotation
+                self.x += dx
+                self.y += dy
+                return True
+        return False
+
+    def ghost_y(self):
+        """Row the falling piece would land on if dropped"""
+        collides = self.board.collides
+        y = self.y
+        while not collides(self.piece, self.rotation, self.x, y + 1):
+            y += 1
+        return y
+
+    def set_piece(self, piece):
+        self.piece = piece
+        self.rotation = 0
+        self.x = GRID_WIDTH // 2 - len(SHAPES[piece][0]) // 2
+        self.y = 0
+        if self.collides(0, self.x, self.y):
+            self.game_over = True
+
+    def spawn(self):
+        if not self.next_pieces:
+            self.next_pieces = [self.bag.next() for _ in range(NEXT_COUNT)]
+        self.next_pieces.append(self.bag.next())
+        self.can_hold = True
+        self.set_piece(self.next_pieces.pop(0))
+
+    def hold(self):
+        if not self.can_hold:
+            return
+        if self.hold_piece is None:
+            self.hold_piece = self.piece
+            self.spawn()
+        else:
+            self.hold_piece, piece = self.piece, self.hold_piece
+            self.set_piece(piece)
+        self.can_hold = False
+
+    def lock(self):
+        """Fix the falling piece in place, clear and score lines, then spawn the next piece"""
+        self.board.lock(self.piece, self.rotation, self.x, self.y)
+        cleared = self.board.clear_lines()
+        if cleared:
+            self.combo += 1
+            self.lines += cleared
+            self.score += LINE_SCORES.get(cleared, 0) * self.combo
+            garbage = GARBAGE_FOR_LINES.get(cleared, 0)
+            self.garbage_out += garbage
+            self.garbage_sent += garbage
+        else:
+            self.combo = 0
+        self.fall_time = 0.0
+        self.spawn()
+
+    def receive_garbage(self, count):
+        if count <= 0 or self.game_over:
+            return
+        self.board.add_garbage([self.garbage_rng.randrange(self.board.width) for _ in range(count)])
+        if self.collides(self.rotation, self.x, self.y):
+            self.game_over = True
+
+    def state(self):
+        """Snapshot for a game_update message"""
+        return {
+            'board': self.board.rows(),
+            'score': self.score,
+            'combo': self.combo,
+            'current_piece': self.piece,
+            'next_pieces': self.next_pieces,
+            'hold_piece': self.hold_piece,
+            'piece_pos': [self.x, self.y]
+        }
+
+    def load_state(self, state):
+        """Show an opponent's game_update snapshot. Snapshots don't carry the piece's rotation, so
+        the piece is shown in its spawn orientation."""
+        if 'board' in state:
+            self.board.load_rows(state['board'])
+        self.score = state.get('score', self.score)
+        self.combo = state.get('combo', self.combo)
+        self.next_pieces = state.get('next_pieces', self.next_pieces)
+        self.hold_piece = state.get('hold_piece', self.hold_piece)
+        if state.get('current_piece'):
+            self.piece = state['current_piece']
+            self.rotation = 0
+        self.x, self.y = state.get('piece_pos', (self.x, self.y))
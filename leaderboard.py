@@ -0,0 +1,293 @@
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+# Server-side leaderboard: every player's best score, ranked. The match store's SQLite file is
+# the only copy on disk; the leaderboard loads it at startup and then tails match_players for new
+# rows, so it also picks up matches finished by other worker processes. Rank and page lookups are
+# answered from memory by RankedList in O(log n), name searches by NameIndex.
+
+MAX_PAGE = 100  # Most leaderboard rows a client can ask for at once
+SEARCH_CACHE_SIZE = 256  # Recent queries whose match sets are kept for reuse
+SORT_LIMIT = 5000  # Match sets up to this size are sorted; bigger ones are read off the ranking in order
+
+class RankedList:
+    """Sorted list with O(log n) positional access.
+
+    Items live in sorted chunks of at most 2 * load items; a Fenwick tree over the chunk lengths
+    turns "how many items come before chunk i" and "which chunk holds the k-th item" into
+    O(log n) walks, so rank() and slicing never scan the list. Chunks only split or disappear
+    once every ~load inserts/removes, which is when the tree is rebuilt."""
+    def __init__(self, items=(), load=512):
+        self.load = load
+        ordered = sorted(items)
+        self.chunks = [ordered[i:i + load] for i in range(0, len(ordered), load)]
+        self.maxes = [chunk[-1] for chunk in self.chunks]
+        self.size = len(ordered)
+        self.rebuild_index()
+
+    def __len__(self):
+        return self.size
+
+    def rebuild_index(self):
+        self.tree = [0] * (len(self.chunks) + 1)
+        for i, chunk in enumerate(self.chunks, 1):
+            self.tree[i] += len(chunk)
+            parent = i + (i & -i)
+            if parent <= len(self.chunks):
+                self.tree[parent] += self.tree[i]
+
+    def adjust(self, chunk_index, amount):
+        i = chunk_index + 1
+        while i < len(self.tree):
+            self.tree[i] += amount
+            i += i & -i
+
+    def count_before(self, chunk_index):
+        """Number of items in the chunks before chunk_index"""
+        total = 0
+        i = chunk_index
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def locate(self, position):
+        """(chunk index, index within the chunk) of the item at position"""
+        chunk_index = 0
+        step = 1 << (len(self.chunks).bit_length())
+        while step:
+            following = chunk_index + step
+            if following <= len(self.chunks) and self.tree[following] <= position:
+                chunk_index = following
+                position -= self.tree[following]
+            step >>= 1
+        return chunk_index, position
+
+    def add(self, item):
+        if not self.chunks:
+            self.chunks.append([item])
+            self.maxes.append(item)
+            self.size = 1
+            self.rebuild_index()
+            return
+        chunk_index = min(bisect_left(self.maxes, item), len(self.chunks) - 1)
+        chunk = self.chunks[chunk_index]
+        insort(chunk, item)
+        self.maxes[chunk_index] = chunk[-1]
+        self.size += 1
+        if len(chunk) > 2 * self.load:
+            self.chunks[chunk_index:chunk_index + 1] = [chunk[:self.load], chunk[self.load:]]
+            self.maxes[chunk_index:chunk_index + 1] = [chunk[self.load - 1], chunk[-1]]
+            self.rebuild_index()
+        else:
+            self.adjust(chunk_index, 1)
+
+    def remove(self, item):
+        chunk_index = bisect_left(self.maxes, item)
+        chunk = self.chunks[chunk_index]
+        del chunk[bisect_left(chunk, item)]
+        self.size -= 1
+        if chunk:
+            self.maxes[chunk_index] = chunk[-1]
+            self.adjust(chunk_index, -1)
+        else:
+            del self.chunks[chunk_index]
+            del self.maxes[chunk_index]
+            self.rebuild_index()
+
+    def count_below(self, item):
+        """Number of items that sort before item (item need not be in the list)"""
+        chunk_index = bisect_left(self.maxes, item)
+        if chunk_index == len(self.chunks):
+            return self.size
+        return self.count_before(chunk_index) + bisect_left(self.chunks[chunk_index], item)
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    def slice(self, start, count):
+        if start >= self.size or count <= 0:
+            return []
+        chunk_index, offset = self.locate(start)
+        items = []
+        while chunk_index < len(self.chunks) and len(items) < count:
+            items.extend(self.chunks[chunk_index][offset:offset + count - len(items)])
+            chunk_index += 1
+            offset = 0
+        return items
+
+class NameIndex:
+    """Case-insensitive substring search over usernames.
+
+    Every 1-, 2- and 3-gram maps to an array of the ids of the names containing it, so a query of
+    up to three characters is answered by its posting list as is. A longer query starts from the
+    shortest posting list of its trigrams and confirms each candidate with a plain substring
+    test. Those match sets are cached, and a query that extends a cached one by a character -
+    someone typing - only re-checks the previous matches when that is the smaller set."""
+    def __init__(self):
+        self.names = []  # id -> username
+        self.folded = []  # id -> lowercased username
+        self.ids = {}  # {username: id}
+        self.postings = {}  # {n-gram: array of ids}, n = 1..3
+        self.cache = OrderedDict()  # {lowercased query: set of matching ids}, least recent first
+
+    def add(self, username):
+        if username in self.ids:
+            return
+        player_id = len(self.names)
+        folded = username.lower()
+        self.names.append(username)
+        self.folded.append(folded)
+        self.ids[username] = player_id
+        for gram in {folded[i:i + n] for n in (1, 2, 3) for i in range(len(folded) - n + 1)}:
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array('I')
+            posting.append(player_id)
+        # Keep cached match sets valid instead of dropping them
+        for query, found in self.cache.items():
+            if query in folded:
+                found.add(player_id)
+
+    def matches(self, query):
+        """Ids of the names containing query; don't modify the returned collection"""
+        query = query.lower()
+        if len(query) <= 3:
+            return self.postings.get(query, ())
+        found = self.cache.get(query)
+        if found is not None:
+            self.cache.move_to_end(query)
+            return found
+        candidates = min((self.postings.get(query[i:i + 3], ()) for i in range(len(query) - 2)), key=len)
+        previous = self.cache.get(query[:-1])
+        if previous is not None and len(previous) < len(candidates):
+            candidates = previous
+        folded = self.folded
+        found = {player_id for player_id in candidates if query in folded[player_id]}
+        self.cache[query] = found
+        if len(self.cache) > SEARCH_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return found
+
+class Leaderboard:
+    """Best score per player, ranked highest first; ties share a rank"""
+    def __init__(self, path='matches.db', refresh_interval=1.0):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.best = {}  # {username: best score}
+        self.ranked = RankedList()  # (-score, username), so ascending order is leaderboard order
+        self.index = NameIndex()
+        self.last_row = 0  # rowid of the last match_players row applied
+        # Loading a big leaderboard takes a while, so the server starts without waiting for it
+        threading.Thread(target=self.refresh_loop, daemon=True).start()
+
+    def query(self, sql, args=()):
+        db = sqlite3.connect(self.path)
+        try:
+            return db.execute(sql, args).fetchall()
+        except sqlite3.OperationalError:
+            return []  # The match store hasn't created its tables yet
+        finally:
+            db.close()
+
+    def load(self):
+        rows = self.query('SELECT username, MAX(score), MAX(rowid) FROM match_players '
+                          'WHERE score IS NOT NULL GROUP BY username')
+        # Build off to the side and swap in, so queries aren't held up meanwhile
+        best = {username: score for username, score, _ in rows}
+        ranked = RankedList((-score, username) for username, score in best.items())
+        index = NameIndex()
+        for username in best:
+            index.add(username)
+        with self.lock:
+            self.best, self.ranked, self.index = best, ranked, index
+            self.last_row = max((row for _, _, row in rows), default=0)
+
+    def refresh(self):
+        """Apply match results written since the last refresh"""
+        rows = self.query('SELECT rowid, username, score FROM match_players WHERE rowid > ? ORDER BY rowid',
+                          (self.last_row,))
+        with self.lock:
+            for rowid, username, score in rows:
+                self.last_row = rowid
+                if score is not None:
+                    self.submit(username, score)
+
+    def refresh_loop(self):
+        self.load()
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except sqlite3.Error as e:
+                print(f"Error refreshing leaderboard: {e}")
+
+    def submit(self, username, score):
+        """Keep score if it beats the player's best. Call with self.lock held."""
+        previous = self.best.get(username)
+        if previous is not None:
+            if score <= previous:
+                return
+            self.ranked.remove((-previous, username))
+        else:
+            self.index.add(username)
+        self.best[username] = score
+        self.ranked.add((-score, username))
+
+    def rank_of(self, score):
+        """1 + number of players with a strictly higher score. Call with self.lock held."""
+        return self.ranked.count_below((-score, '')) + 1
+
+    def entries(self, rows):
+        """Leaderboard rows for (-score, username) items in ranked order. Call with self.lock held."""
+        entries = []
+        for negative_score, username in rows:
+            # Ties share the rank of the first player on that score
+            rank = entries[-1]['rank'] if entries and entries[-1]['score'] == -negative_score \
+                else self.rank_of(-negative_score)
+            entries.append({'rank': rank, 'username': username, 'score': -negative_score})
+        return entries
+
+    def page(self, offset, limit):
+        offset = max(0, offset)
+        limit = max(0, min(limit, MAX_PAGE))
+        with self.lock:
+            rows = self.ranked.slice(offset, limit)
+            return {'offset': offset, 'total': len(self.ranked), 'entries': self.entries(rows)}
+
+    def search(self, query, offset, limit):
+        """Page of the players whose name contains query, in leaderboard order with global ranks"""
+        offset = max(0, offset)
+        limit = max(0, min(limit, MAX_PAGE))
+        with self.lock:
+            found = self.index.matches(query)
+            if len(found) <= SORT_LIMIT:
+                names = self.index.names
+                rows = sorted((-self.best[names[i]], names[i]) for i in found)[offset:offset + limit]
+            else:
+                # Plenty of matches: walking the ranking finds a page long before the end
+                rows = []
+                skip = offset
+                folded = query.lower()
+                for item in self.ranked:
+                    if folded in item[1].lower():
+                        if skip:
+                            skip -= 1
+                            continue
+                        rows.append(item)
+                        if len(rows) == limit:
+                            break
+            return {'query': query, 'offset': offset, 'total': len(found), 'entries': self.entries(rows)}
+
+    def rank(self, username):
+        with self.lock:
+            score = self.best.get(username)
+            if score is None:
+                return {'username': username, 'rank': None, 'score': None, 'total': len(self.ranked)}
+            return {'username': username, 'rank': self.rank_of(score), 'score': score, 'total': len(self.ranked)}
@@ -0,0 +1,305 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from protocol import (FrameDecoder, UpdateDecoder, UpdateEncoder, PROTOCOL_VERSION, BOARD_WIDTH, BOARD_HEIGHT,
+                      decode_message, encode_frame, encode_message, is_binary, payload_sequence)
+from server import raise_fd_limit
+
+# Headless load generator: starts server.py locally (or targets a running one), then drives
+# thousands of scripted players through the same protocol Network speaks - hello, create/join
+# lobby, ready, chat and delta-encoded game updates - and reports relay throughput, latency and
+# the server's CPU and memory use.
+
+PIECES = ['I', 'O', 'T', 'S', 'Z', 'J', 'L']
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.chats = 0
+        self.keyframe_requests = 0
+        self.latencies = []
+        self.errors = 0
+
+class SimPlayer:
+    """One scripted player with its own connection"""
+    def __init__(self, index, stats, rng):
+        self.index = index
+        self.username = f"bot{index}"
+        self.stats = stats
+        self.rng = rng
+        self.decoder = FrameDecoder()
+        self.encoder = UpdateEncoder()
+        self.opponent_updates = UpdateDecoder()
+        self.opponent = None
+        self.sent_times = {}  # {seq: perf_counter() when sent}, read by the opponent on receipt
+        self.waiters = {}  # {message type: Future}
+        self.board = [[0] * BOARD_WIDTH for _ in range(BOARD_HEIGHT)]
+        self.piece_y = 0
+        self.reader = None
+        self.writer = None
+        self.token = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.read_task = asyncio.ensure_future(self.read_loop())
+        reply = await self.request({'command': 'hello', 'version': PROTOCOL_VERSION}, 'hello')
+        if reply['version'] < 3:
+            raise RuntimeError(f"Server only speaks protocol version {reply['version']}")
+
+    async def login(self):
+        reply = await self.request({'command': 'login', 'username': self.username, 'password': 'loadtest'},
+                                   'login_ok')
+        self.token = reply['token']
+
+    def send(self, message):
+        self.writer.write(encode_message(message))
+
+    async def request(self, message, reply_type):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[reply_type] = future
+        self.send(message)
+        return await future
+
+    def expect(self, reply_type):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[reply_type] = future
+        return future
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                for payload in self.decoder.feed(data):
+                    if is_binary(payload):
+                        self.on_game_state(payload)
+                        continue
+                    message = decode_message(payload)
+                    message_type = message.get('type')
+                    if message_type == 'game_state':
+                        self.on_game_state(message['payload'])
+                    elif message_type == 'keyframe_request':
+                        self.stats.keyframe_requests += 1
+                        self.encoder.request_keyframe()
+                    elif message_type == 'chat_message':
+                        self.stats.chats += 1
+                    future = self.waiters.pop(message_type, None)
+                    if future is not None and not future.done():
+                        future.set_result(message)
+        except (ConnectionError, OSError):
+            self.stats.errors += 1
+
+    def on_game_state(self, payload):
+        now = time.perf_counter()
+        self.stats.received += 1
+        sent_at = self.opponent.sent_times.pop(payload_sequence(payload), None) if self.opponent else None
+        if sent_at is not None:
+            self.stats.latencies.append(now - sent_at)
+        self.opponent_updates.apply(payload)
+        if self.opponent_updates.needs_keyframe:
+            self.send({'command': 'request_keyframe'})
+
+    def step_board(self):
+        # Fake a falling piece that locks into a random column, clearing the row when it fills up
+        self.piece_y += 1
+        if self.piece_y >= BOARD_HEIGHT - 1:
+            self.piece_y = 0
+            row = self.board[-1]
+            row[self.rng.randrange(BOARD_WIDTH)] = self.rng.choice(PIECES)
+            if all(row):
+                self.board.pop()
+                self.board.insert(0, [0] * BOARD_WIDTH)
+
+    async def play(self, rate, duration, chat_interval):
+        interval = 1.0 / rate
+        next_chat = time.perf_counter() + self.rng.uniform(0, chat_interval) if chat_interval else None
+        deadline = time.perf_counter() + duration
+        # Spread players across the tick so updates don't arrive in lockstep
+        await asyncio.sleep(self.rng.uniform(0, interval))
+        while time.perf_counter() < deadline:
+            self.step_board()
+            payload = self.encoder.encode({
+                'board': self.board,
+                'score': self.stats.sent % 100000,
+                'combo': 0,
+                'current_piece': 'T',
+                'next_pieces': ['I', 'O', 'S'],
+                'hold_piece': None,
+                'piece_pos': [4, self.piece_y]
+            })
+            self.sent_times[self.encoder.seq] = time.perf_counter()
+            self.writer.write(encode_frame(payload))
+            self.stats.sent += 1
+            if next_chat is not None and time.perf_counter() >= next_chat:
+                self.send({'command': 'chat', 'message': f"gg from {self.username}"})
+                next_chat += chat_interval
+            await asyncio.sleep(interval)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+async def set_up_pair(host_player, guest_player, address):
+    await host_player.connect(*address)
+    await guest_player.connect(*address)
+    await asyncio.gather(host_player.login(), guest_player.login())
+    created = await host_player.request({'command': 'create_lobby', 'token': host_player.token}, 'lobby_created')
+    joined = host_player.expect('player_joined')
+    await guest_player.request({'command': 'join_lobby', 'lobby_id': created['lobby_id'],
+                                'token': guest_player.token}, 'player_joined')
+    await joined
+    # Both players toggle ready; the second toggle starts the game
+    started = [player.expect('game_start') for player in (host_player, guest_player)]
+    host_player.send({'command': 'ready'})
+    guest_player.send({'command': 'ready'})
+    await asyncio.gather(*started)
+    host_player.opponent, guest_player.opponent = guest_player, host_player
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def process_tree(pid):
+    """pid and all of its descendants (Linux /proc), so sharded workers are measured too"""
+    pids = [pid]
+    for current in pids:
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as file:
+                pids.extend(int(child) for child in file.read().split())
+        except OSError:
+            pass
+    return pids
+
+def process_usage(pid):
+    """(CPU seconds, RSS bytes) summed over a process tree, or (None, None) where /proc is unavailable"""
+    cpu_seconds = 0.0
+    rss = 0
+    ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+    try:
+        for current in process_tree(pid):
+            with open(f"/proc/{current}/stat") as file:
+                fields = file.read().rsplit(')', 1)[1].split()
+            cpu_seconds += (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+            with open(f"/proc/{current}/status") as file:
+                for line in file:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        return None, None
+    return cpu_seconds, rss
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+async def run(args, server_pid):
+    rng = random.Random(args.seed)
+    stats = Stats()
+    address = (args.host, args.port)
+    players = [SimPlayer(i, stats, random.Random(rng.random())) for i in range(args.players - args.players % 2)]
+    pairs = list(zip(players[0::2], players[1::2]))
+
+    setup_start = time.perf_counter()
+    # Connect in batches so the listen backlog isn't flooded
+    for start in range(0, len(pairs), args.batch):
+        await asyncio.gather(*(set_up_pair(host, guest, address) for host, guest in pairs[start:start + args.batch]))
+    setup_time = time.perf_counter() - setup_start
+
+    idle = []
+    for _ in range(args.idle):
+        player = SimPlayer(-1, stats, rng)
+        await player.connect(*address)
+        idle.append(player)
+
+    cpu_before, _ = process_usage(server_pid) if server_pid else (None, None)
+    play_start = time.perf_counter()
+    await asyncio.gather(*(player.play(args.rate, args.duration, args.chat_interval) for player in players))
+    await asyncio.sleep(0.5)  # Let in-flight updates land
+    elapsed = time.perf_counter() - play_start
+    cpu_after, rss = process_usage(server_pid) if server_pid else (None, None)
+
+    for player in players + idle:
+        player.close()
+
+    return {
+        'players': len(players),
+        'idle_connections': len(idle),
+        'rate_hz': args.rate,
+        'duration_s': round(elapsed, 2),
+        'setup_s': round(setup_time, 2),
+        'updates_sent': stats.sent,
+        'updates_received': stats.received,
+        'relay_throughput_per_s': round(stats.received / elapsed, 1),
+        'delivery_ratio': round(stats.received / stats.sent, 4) if stats.sent else None,
+        'keyframe_requests': stats.keyframe_requests,
+        'chat_messages_received': stats.chats,
+        'latency_p50_ms': round(percentile(stats.latencies, 0.50) * 1000, 2) if stats.latencies else None,
+        'latency_p99_ms': round(percentile(stats.latencies, 0.99) * 1000, 2) if stats.latencies else None,
+        'latency_max_ms': round(max(stats.latencies) * 1000, 2) if stats.latencies else None,
+        'server_cpu_percent': round((cpu_after - cpu_before) / elapsed * 100, 1) if cpu_before is not None else None,
+        'server_rss_mb': round(rss / 2 ** 20, 1) if rss is not None else None,
+        'client_errors': stats.errors
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate many players against server.py and report capacity")
+    parser.add_argument('--players', type=int, default=1000, help="active players (paired into lobbies)")
+    parser.add_argument('--idle', type=int, default=0, help="extra connections that only say hello")
+    parser.add_argument('--rate', type=float, default=10.0, help="game updates per second per player")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of gameplay to measure")
+    parser.add_argument('--chat-interval', type=float, default=5.0, help="seconds between chats per player, 0 for none")
+    parser.add_argument('--batch', type=int, default=100, help="lobbies set up concurrently")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5599)
+    parser.add_argument('--external', action='store_true', help="use an already running server instead of starting one")
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='asyncio')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--json', help="also write the results to this file, for comparing releases")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    server = None
+    if not args.external:
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+                   '--host', args.host, '--port', str(args.port), '--mode', args.mode, '--workers', str(args.workers),
+                   # Registering thousands of bots would measure scrypt, not the relay, and their
+                   # matches don't belong in the caller's matches.db and leaderboard
+                   '--accounts-db', '', '--match-db', '']
+        server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        if not wait_for_port(args.host, args.port):
+            server.kill()
+            sys.exit("Server did not start")
+
+    try:
+        results = asyncio.run(run(args, server.pid if server else None))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    for key, value in results.items():
+        print(f"{key:>24}: {value}")
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    main()
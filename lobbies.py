@@ -0,0 +1,145 @@
+import threading
+
+MAX_PLAYERS = 2
+
+class Lobby:
+    """One lobby's state. Every read or write of its fields happens under self.lock."""
+    def __init__(self, lobby_id, host):
+        self.id = lobby_id
+        self.host = host
+        self.players = []  # [username1, username2]
+        self.ready = {}  # {username: False}
+        self.roles = {}  # {username: 'player1' or 'player2'}
+        self.members = set()  # Client connections to fan messages out to
+        self.closed = False  # Set once the last player leaves; a closed lobby can't be joined
+        self.seed = None  # Piece seed of the game in progress, see pieces.SevenBag
+        self.sync = None  # 'state' or 'lockstep' once a game has started
+        self.in_game = False
+        self.started_at = None
+        self.results = {}  # {username: final score, None for a player who left mid-game}
+        # What a reconnecting player needs to catch up, per sender, reset when a game starts. Updates
+        # are appended on the relay path without taking the lock (list appends are atomic); inputs
+        # under it, so none is logged outside the lockstep game it belongs to.
+        self.updates = {}  # {username: [last keyframe payload, deltas since]}
+        self.inputs = {}  # {username: [input payloads of this game]}
+        self.lock = threading.RLock()
+
+    def state(self):
+        """Copies of players/roles/ready that are safe to put in a message after the lock is released"""
+        with self.lock:
+            return {
+                'players': list(self.players),
+                'roles': dict(self.roles),
+                'ready': dict(self.ready)
+            }
+
+class LobbyRegistry:
+    """Lobbies spread over independently locked shards.
+
+    A shard lock only guards the id -> Lobby dict and is held just long enough to add, look up or
+    remove an entry; everything else locks the one Lobby involved, so unrelated lobbies never
+    contend with each other."""
+    def __init__(self, id_prefix='', shard_count=16):
+        self.id_prefix = id_prefix  # Keeps ids unique when several processes each run a registry
+        self.shards = [{} for _ in range(shard_count)]
+        self.shard_locks = [threading.Lock() for _ in range(shard_count)]
+        self.next_id = 1
+        self.id_lock = threading.Lock()
+
+    def shard_index(self, lobby_id):
+        return hash(lobby_id) % len(self.shards)
+
+    def allocate_id(self):
+        with self.id_lock:
+            lobby_id = f"{self.id_prefix}{self.next_id}"
+            self.next_id += 1
+            return lobby_id
+
+    def get(self, lobby_id):
+        index = self.shard_index(lobby_id)
+        with self.shard_locks[index]:
+            return self.shards[index].get(lobby_id)
+
+    def create(self, username, client):
+        """Create a lobby hosted by username; returns the new Lobby"""
+        lobby = Lobby(self.allocate_id(), username)
+        lobby.players.append(username)
+        lobby.ready[username] = False
+        lobby.roles[username] = 'player1'
+        lobby.members.add(client)
+
+        index = self.shard_index(lobby.id)
+        with self.shard_locks[index]:
+            self.shards[index][lobby.id] = lobby
+        return lobby
+
+    def join(self, lobby_id, username, client):
+        """Add a player as player2; returns the Lobby, or None if it is full or gone"""
+        lobby = self.get(lobby_id)
+        if lobby is None:
+            return None
+        with lobby.lock:
+            if lobby.closed or len(lobby.players) >= MAX_PLAYERS:
+                return None
+            lobby.players.append(username)
+            lobby.ready[username] = False
+            lobby.roles[username] = 'player2'
+            lobby.members.add(client)
+        return lobby
+
+    def leave(self, lobby_id, username, client):
+        """Remove a player; returns the Lobby if players remain, None if it was removed or never existed"""
+        lobby = self.get(lobby_id)
+        if lobby is None:
+            return None
+        with lobby.lock:
+            if username in lobby.players:
+                lobby.players.remove(username)
+            lobby.ready.pop(username, None)
+            lobby.roles.pop(username, None)
+            lobby.updates.pop(username, None)
+            lobby.inputs.pop(username, None)
+            lobby.members.discard(client)
+            if lobby.players:
+                return lobby
+            lobby.closed = True
+
+        index = self.shard_index(lobby_id)
+        with self.shard_locks[index]:
+            if self.shards[index].get(lobby_id) is lobby:
+                del self.shards[index][lobby_id]
+        return None
+
+    def replace_member(self, lobby_id, old_client, new_client):
+        """Swap the connection behind a seat (either may be None); returns False if the lobby is gone"""
+        lobby = self.get(lobby_id)
+        if lobby is None:
+            return False
+        with lobby.lock:
+            if lobby.closed:
+                return False
+            lobby.members.discard(old_client)
+            if new_client is not None:
+                lobby.members.add(new_client)
+        return True
+
+    def members(self, lobby_id):
+        """Snapshot of a lobby's client connections"""
+        lobby = self.get(lobby_id)
+        if lobby is None:
+            return ()
+        with lobby.lock:
+            return tuple(lobby.members)
+
+    def all(self):
+        lobbies = []
+        for index, shard in enumerate(self.shards):
+            with self.shard_locks[index]:
+                lobbies.extend(shard.values())
+        return lobbies
+
+    def __contains__(self, lobby_id):
+        return self.get(lobby_id) is not None
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
@@ -0,0 +1,105 @@
+import argparse
+import random
+import sys
+import threading
+import time
+
+from lobbies import LobbyRegistry, MAX_PLAYERS
+
+# Hammers LobbyRegistry with create/join/leave from many threads and checks its invariants:
+#   - no two lobbies ever get the same id
+#   - no lobby ever holds more than MAX_PLAYERS players
+#   - players, ready, roles and members always agree with each other
+#   - a lobby that is still registered is never empty
+#   - once every worker has left everything, the registry is empty
+
+class Worker(threading.Thread):
+    def __init__(self, registry, index, rounds, created_ids, errors):
+        super().__init__()
+        self.registry = registry
+        self.username = f"player{index}"
+        self.client = object()  # Stands in for a connection
+        self.rounds = rounds
+        self.created_ids = created_ids
+        self.errors = errors
+        self.rng = random.Random(index)
+        self.lobby_id = None
+
+    def run(self):
+        try:
+            for _ in range(self.rounds):
+                action = self.rng.random()
+                if self.lobby_id is not None and action < 0.4:
+                    self.registry.leave(self.lobby_id, self.username, self.client)
+                    self.lobby_id = None
+                elif self.lobby_id is None and action < 0.7:
+                    lobby = self.registry.create(self.username, self.client)
+                    self.created_ids.append(lobby.id)
+                    self.lobby_id = lobby.id
+                elif self.lobby_id is None:
+                    # Join a recently created lobby, which may already be full or gone
+                    recent = self.created_ids[-50:]
+                    if recent:
+                        lobby = self.registry.join(self.rng.choice(recent), self.username, self.client)
+                        if lobby is not None:
+                            self.lobby_id = lobby.id
+                check_lobbies(self.registry, self.errors)
+            if self.lobby_id is not None:
+                self.registry.leave(self.lobby_id, self.username, self.client)
+        except Exception as e:
+            self.errors.append(f"{self.username}: {e!r}")
+
+def check_lobbies(registry, errors):
+    for lobby in registry.all():
+        with lobby.lock:
+            if lobby.closed:
+                continue
+            if not lobby.players:
+                errors.append(f"Lobby {lobby.id} is registered but empty")
+            if len(lobby.players) > MAX_PLAYERS:
+                errors.append(f"Lobby {lobby.id} has {len(lobby.players)} players")
+            if len(set(lobby.players)) != len(lobby.players):
+                errors.append(f"Lobby {lobby.id} lists a player twice: {lobby.players}")
+            if set(lobby.ready) != set(lobby.players) or set(lobby.roles) != set(lobby.players):
+                errors.append(f"Lobby {lobby.id} players/ready/roles disagree")
+            if len(lobby.members) != len(lobby.players):
+                errors.append(f"Lobby {lobby.id} has {len(lobby.members)} members for {len(lobby.players)} players")
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrency stress check for LobbyRegistry")
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    # Switch threads far more often than the default so races actually get a chance to happen
+    sys.setswitchinterval(1e-6)
+
+    registry = LobbyRegistry()
+    created_ids = []
+    errors = []
+    workers = [Worker(registry, i, args.rounds, created_ids, errors) for i in range(args.threads)]
+
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    if len(set(created_ids)) != len(created_ids):
+        errors.append(f"{len(created_ids) - len(set(created_ids))} duplicate lobby ids")
+    if len(registry):
+        errors.append(f"{len(registry)} lobbies left after every player left")
+
+    operations = args.threads * args.rounds
+    print(f"{operations} operations on {args.threads} threads in {elapsed:.2f}s, "
+          f"{len(created_ids)} lobbies created")
+    for error in errors[:20]:
+        print(f"FAIL: {error}")
+    if errors:
+        print(f"{len(errors)} invariant violations")
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import queue
+import sqlite3
+import threading
+import time
+
+# Finished matches are persisted to SQLite by a single writer thread. Callers only put the result
+# on a queue, so disk I/O never runs on a relay thread or the event loop; the writer groups
+# whatever has piled up into one transaction, so there is one fsync per batch, not per match.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY,
+    lobby_id TEXT,
+    seed INTEGER,
+    sync TEXT,
+    started_at REAL,
+    finished_at REAL,
+    winner TEXT
+);
+CREATE TABLE IF NOT EXISTS match_players (
+    match_id INTEGER REFERENCES matches(id),
+    username TEXT,
+    role TEXT,
+    score INTEGER,
+    outcome TEXT  -- 'win', 'loss', 'tie' or 'forfeit'
+);
+CREATE INDEX IF NOT EXISTS match_players_username ON match_players(username);
+"""
+
+class MatchStore:
+    """Write-behind match log. record() never blocks; results reach disk within flush_interval."""
+    def __init__(self, path='matches.db', batch_size=256, flush_interval=0.5, max_pending=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = queue.Queue(max_pending)
+        self.written = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def connect(self):
+        db = sqlite3.connect(self.path)
+        # WAL lets readers (and other worker processes) keep going while a batch commits, and
+        # synchronous=NORMAL syncs at checkpoints rather than on every commit
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def record(self, result):
+        """Queue a finished match: {'lobby_id', 'seed', 'sync', 'started_at', 'finished_at', 'winner',
+        'players': [{'username', 'role', 'score', 'outcome'}]}"""
+        try:
+            self.pending.put_nowait(result)
+        except queue.Full:
+            self.dropped += 1
+            print("Match store is falling behind, dropping a result")
+
+    def write_loop(self):
+        db = self.connect()
+        db.executescript(SCHEMA)
+        while True:
+            batch = [self.pending.get()]
+            # Give a burst a moment to accumulate so it lands in one transaction
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self.pending.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            results = [result for result in batch if result is not None]
+            if results:
+                try:
+                    self.write(db, results)
+                except sqlite3.Error as e:
+                    print(f"Error writing match results: {e}")
+                    self.dropped += len(results)
+            if stopping:
+                db.close()
+                return
+
+    def write(self, db, results):
+        with db:
+            for result in results:
+                cursor = db.execute(
+                    'INSERT INTO matches (lobby_id, seed, sync, started_at, finished_at, winner) VALUES (?, ?, ?, ?, ?, ?)',
+                    (result['lobby_id'], result['seed'], result['sync'], result['started_at'],
+                     result['finished_at'], result['winner']))
+                db.executemany(
+                    'INSERT INTO match_players (match_id, username, role, score, outcome) VALUES (?, ?, ?, ?, ?)',
+                    [(cursor.lastrowid, player['username'], player['role'], player['score'], player['outcome'])
+                     for player in result['players']])
+        self.written += len(results)
+
+    def close(self):
+        """Flush everything queued so far and stop the writer"""
+        self.pending.put(None)
+        self.thread.join()
@@ -0,0 +1,159 @@
+import json
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Server metrics, kept in-process and exported over a small local HTTP endpoint:
+#   GET /metrics        JSON snapshot
+#   GET /metrics.txt    the same numbers in Prometheus text format
+# Everything is recorded under one lock, so it can be used from handler threads and the event loop alike.
+
+# Upper bounds of the handler latency buckets, in milliseconds
+LATENCY_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+RATE_WINDOW = 10  # Seconds of history used for per-second rates
+HOT_LOBBY_COUNT = 10
+
+class Histogram:
+    """Fixed-bucket latency histogram; percentiles are reported as the upper bound of their bucket"""
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last bucket is everything slower than bounds[-1]
+        self.total = 0
+        self.sum_ms = 0.0
+
+    def observe(self, ms):
+        index = 0
+        while index < len(self.bounds) and ms > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.total += 1
+        self.sum_ms += ms
+
+    def percentile(self, fraction):
+        if not self.total:
+            return None
+        target = self.total * fraction
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.bounds[index] if index < len(self.bounds) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'count': self.total,
+            'mean_ms': round(self.sum_ms / self.total, 4) if self.total else None,
+            'p50_ms': self.percentile(0.50),
+            'p99_ms': self.percentile(0.99),
+            'buckets': {str(bound): count for bound, count in zip(self.bounds + ('inf',), self.counts)}
+        }
+
+class ServerMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = Counter()  # Serialization, send and error counters
+        self.commands = Counter()  # Messages handled per command type
+        self.latency = {}  # {command: Histogram} of handler run time
+        self.recent = deque()  # [second, Counter of commands] for the last RATE_WINDOW seconds
+        self.lobby_traffic = Counter()  # Game update frames relayed per lobby, to find hot lobbies
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def record_command(self, command, seconds):
+        now = int(time.time())
+        with self.lock:
+            self.commands[command] += 1
+            histogram = self.latency.get(command)
+            if histogram is None:
+                histogram = self.latency[command] = Histogram()
+            histogram.observe(seconds * 1000)
+            if not self.recent or self.recent[-1][0] != now:
+                self.recent.append([now, Counter()])
+                while self.recent[0][0] <= now - RATE_WINDOW:
+                    self.recent.popleft()
+            self.recent[-1][1][command] += 1
+
+    def record_lobby_traffic(self, lobby_id, frames=1):
+        with self.lock:
+            self.lobby_traffic[lobby_id] += frames
+
+    def forget_lobby(self, lobby_id):
+        with self.lock:
+            self.lobby_traffic.pop(lobby_id, None)
+
+    def rates(self):
+        """Messages per second by command over the last RATE_WINDOW complete seconds"""
+        now = int(time.time())
+        totals = Counter()
+        for second, counts in self.recent:
+            if now - RATE_WINDOW <= second < now:
+                totals.update(counts)
+        return {command: round(count / RATE_WINDOW, 2) for command, count in totals.items()}
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'uptime_s': round(time.time() - self.started, 1),
+                'counters': dict(self.counters),
+                'commands': dict(self.commands),
+                'command_rates': self.rates(),
+                'handler_latency': {command: h.snapshot() for command, h in self.latency.items()},
+                'hot_lobbies': [{'id': lobby_id, 'frames_relayed': count}
+                                for lobby_id, count in self.lobby_traffic.most_common(HOT_LOBBY_COUNT)]
+            }
+
+def prometheus_text(snapshot, prefix='tetris'):
+    """Render a snapshot (plus any top-level gauges) in Prometheus text exposition format"""
+    lines = []
+    for name, value in snapshot.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"{prefix}_{name} {value}")
+    for name, value in snapshot.get('counters', {}).items():
+        lines.append(f"{prefix}_{name}_total {value}")
+    for command, value in snapshot.get('commands', {}).items():
+        lines.append(f'{prefix}_commands_total{{command="{command}"}} {value}')
+    for command, value in snapshot.get('command_rates', {}).items():
+        lines.append(f'{prefix}_command_rate{{command="{command}"}} {value}')
+    for command, histogram in snapshot.get('handler_latency', {}).items():
+        cumulative = 0
+        for bound, count in histogram['buckets'].items():
+            cumulative += count
+            le = '+Inf' if bound == 'inf' else bound
+            lines.append(f'{prefix}_handler_ms_bucket{{command="{command}",le="{le}"}} {cumulative}')
+        lines.append(f'{prefix}_handler_ms_count{{command="{command}"}} {histogram["count"]}')
+    for lobby in snapshot.get('hot_lobbies', []):
+        lines.append(f'{prefix}_lobby_frames_relayed{{lobby="{lobby["id"]}"}} {lobby["frames_relayed"]}')
+    return '\n'.join(lines) + '\n'
+
+def start_metrics_server(get_snapshot, host='127.0.0.1', port=9100):
+    """Serve get_snapshot() from a daemon thread; returns the HTTP server"""
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = json.dumps(get_snapshot(), indent=2).encode('utf-8')
+                content_type = 'application/json'
+            elif self.path == '/metrics.txt':
+                body = prometheus_text(get_snapshot()).encode('utf-8')
+                content_type = 'text/plain; version=0.0.4'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes would otherwise flood the server's output
+
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    print(f"Metrics on http://{host}:{port}/metrics")
+    return http_server
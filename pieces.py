@@ -0,0 +1,82 @@
+import random
+
+PIECE_TYPES = ['I', 'O', 'T', 'S', 'Z', 'J', 'L']
+
+# Spawn orientation of each tetromino
+SHAPES = {
+    'I': [[1, 1, 1, 1]],
+    'O': [[1, 1],
+          [1, 1]],
+    'T': [[0, 1, 0],
+          [1, 1, 1]],
+    'S': [[0, 1, 1],
+          [1, 1, 0]],
+    'Z': [[1, 1, 0],
+          [0, 1, 1]],
+    'J': [[1, 0, 0],
+          [1, 1, 1]],
+    'L': [[0, 0, 1],
+          [1, 1, 1]]
+}
+
+def shape_cells(shape):
+    """(dx, dy) offsets of a shape matrix's filled cells"""
+    return tuple((x, y) for y, row in enumerate(shape) for x, filled in enumerate(row) if filled)
+
+def orientations(shape):
+    """Cells of all four orientations, each a quarter turn clockwise from the one before"""
+    cells = []
+    for _ in range(4):
+        cells.append(shape_cells(shape))
+        shape = [list(row) for row in zip(*shape[::-1])]
+    return tuple(cells)
+
+# ROTATIONS[piece][rotation] is the tuple of cell offsets from the piece's top-left corner. Built
+# once here, so nothing rotates a shape while playing.
+ROTATIONS = {piece: orientations(shape) for piece, shape in SHAPES.items()}
+
+MASK64 = (1 << 64) - 1
+GOLDEN = 0x9E3779B97F4A7C15  # 2**64 / golden ratio, splitmix64's increment
+
+def mix(value):
+    """splitmix64 finaliser of a 64-bit integer"""
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+def bag_keys(seed, index):
+    """Sort keys that shuffle bag number index of a seed; PIECE_TYPES[i] is ordered by keys[i]"""
+    base = mix((seed * GOLDEN + index) & MASK64)
+    return [mix((base + i * GOLDEN) & MASK64) for i in range(len(PIECE_TYPES))]
+
+class SevenBag:
+    """Seeded 7-bag randomizer: pieces come in runs of seven, each run a shuffle of all seven types.
+
+    Bag n is shuffled by sorting the types on hashes of (seed, n), so any piece of the sequence can
+    be looked up directly - piece(i) - without replaying the ones before it. Two bags with the same
+    seed deal the same pieces on every machine, which is what lets clients, the server, replays and
+    bots agree on a game from the seed alone; batch.deal() computes the same shuffle for many games
+    at once."""
+    def __init__(self, seed=None):
+        self.seed = seed if seed is not None else random.getrandbits(32)
+        self.position = 0  # Index of the next piece next() deals
+        self.bags = {}  # {bag index: shuffled piece list}, filled on demand
+
+    def bag(self, index):
+        pieces = self.bags.get(index)
+        if pieces is None:
+            keys = bag_keys(self.seed, index)
+            pieces = [PIECE_TYPES[i] for i in sorted(range(len(PIECE_TYPES)), key=keys.__getitem__)]
+            self.bags[index] = pieces
+        return pieces
+
+    def piece(self, index):
+        """The index-th piece of the sequence (0-based)"""
+        return self.bag(index // len(PIECE_TYPES))[index % len(PIECE_TYPES)]
+
+    def next(self):
+        piece = self.piece(self.position)
+        self.position += 1
+        # Bags behind the deal position are only needed again for random access, so drop them
+        self.bags.pop(self.position // len(PIECE_TYPES) - 2, None)
+        return piece
@@ -0,0 +1,287 @@
+import json
+import struct
+
+# Every message on the wire is a 4-byte big-endian payload length followed by the payload
+HEADER = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 1 << 20  # Anything bigger is a broken or hostile peer
+
+# Protocol versions, agreed per connection with the 'hello' command:
+#   1 - JSON payloads only (peers that never send 'hello')
+#   2 - binary game_update payloads
+#   3 - sequenced keyframes plus row deltas, keyframe_request command
+#   4 - optional UDP channel for game updates (the hello reply carries udp_port/udp_token)
+#   5 - lockstep sync: game_start carries a seed, players send input frames instead of snapshots,
+#       resync_inputs command to get missed ones resent
+PROTOCOL_VERSION = 5
+
+BOARD_WIDTH = 10
+BOARD_HEIGHT = 20
+
+# Cell values packed into 4 bits each, two cells per byte ('G' is garbage)
+PIECE_CODES = {0: 0, None: 0, 'I': 1, 'O': 2, 'T': 3, 'S': 4, 'Z': 5, 'J': 6, 'L': 7, 'G': 8}
+CODE_PIECES = [0, 'I', 'O', 'T', 'S', 'Z', 'J', 'L', 'G']
+NIBBLE_PAIRS = [(CODE_PIECES[b >> 4] if b >> 4 < len(CODE_PIECES) else 0,
+                 CODE_PIECES[b & 0xF] if b & 0xF < len(CODE_PIECES) else 0) for b in range(256)]
+
+# JSON payloads always start with '{', so the first byte tells binary payloads apart
+GAME_UPDATE = 0x01  # Self-contained snapshot (version 2)
+KEYFRAME = 0x02     # Sequenced full snapshot (version 3)
+DELTA = 0x03        # Sequenced snapshot carrying only the rows changed since the previous one
+INPUT = 0x04        # One player input in lockstep mode (version 5)
+# Player state fields: score, combo, current piece, hold piece, piece x, piece y, three next pieces
+STATE_FORMAT = 'IHBBbbBBB'
+# tag + state
+GAME_UPDATE_HEADER = struct.Struct('!B' + STATE_FORMAT)
+# tag, sequence number + state
+KEYFRAME_HEADER = struct.Struct('!BI' + STATE_FORMAT)
+# tag, sequence number + state, bitmask of changed rows (bit y set means row y follows)
+DELTA_HEADER = struct.Struct('!BI' + STATE_FORMAT + 'I')
+# tag, sequence number, milliseconds since the game started, action index
+INPUT_FORMAT = struct.Struct('!BIIB')
+# Every change to a player's game in lockstep mode is one of these; 'gravity' is the sender's own
+# fall timer, so replaying the actions in order reproduces its game exactly
+INPUT_ACTIONS = ['left', 'right', 'soft_drop', 'rotate', 'hard_drop', 'hold', 'gravity']
+ROW_BYTES = BOARD_WIDTH // 2
+BOARD_BYTES = BOARD_HEIGHT * ROW_BYTES
+
+# UDP datagrams are a tag byte, the session token from the hello reply, then the body:
+#   UDP_BIND + token        client -> server probe, echoed back by the server once the token is bound
+#   UDP_DATA + token + p    client -> server keyframe/delta payload p
+#   UDP_DATA + p            server -> client relayed keyframe/delta payload (the client's socket is connected
+#                           to the server)
+# Payloads keep their sequence numbers, so stale or reordered datagrams are dropped by UpdateDecoder.
+UDP_BIND = 0x10
+UDP_DATA = 0x11
+UDP_TOKEN_BYTES = 8
+MAX_DATAGRAM_SIZE = 2048
+
+class ProtocolError(Exception):
+    pass
+
+def encode_frame(payload):
+    """Prefix a payload with its length"""
+    if len(payload) > MAX_MESSAGE_SIZE:
+        raise ProtocolError(f"Message too large: {len(payload)} bytes")
+    return HEADER.pack(len(payload)) + payload
+
+def encode_message(message):
+    """Serialize a message dict into a complete frame"""
+    return encode_frame(json.dumps(message).encode('utf-8'))
+
+def decode_message(payload):
+    """Turn a frame payload back into a message dict"""
+    if is_binary(payload):
+        if payload[0] == INPUT:
+            return decode_input(payload)
+        if payload[0] in (KEYFRAME, DELTA):
+            # Sequenced updates only make sense against the receiver's copy of the board,
+            # see UpdateDecoder
+            return {'type': 'game_state', 'payload': payload}
+        return decode_game_update(payload)
+    return json.loads(payload.decode('utf-8'))
+
+def is_binary(payload):
+    return payload[:1] != b'{'
+
+_row_cache = {}  # Packed bytes per distinct row; real boards reuse a handful of rows
+
+def encode_row(row):
+    key = tuple(row)
+    packed = _row_cache.get(key)
+    if packed is None:
+        codes = PIECE_CODES
+        packed = bytes((codes[row[x]] << 4) | codes[row[x + 1]] for x in range(0, BOARD_WIDTH, 2))
+        if len(_row_cache) < 65536:
+            _row_cache[key] = packed
+    return packed
+
+def encode_board(board):
+    """Pack a 20x10 board into 100 bytes"""
+    return b''.join([encode_row(row) for row in board])
+
+def decode_board(data):
+    """Unpack encode_board() output back into a list of rows"""
+    return [decode_row(data[y * ROW_BYTES:(y + 1) * ROW_BYTES]) for y in range(BOARD_HEIGHT)]
+
+def decode_row(data):
+    row = []
+    for byte in data:
+        row.extend(NIBBLE_PAIRS[byte])
+    return row
+
+def pack_state(state):
+    """State fields shared by every binary update, in STATE_FORMAT order"""
+    next_pieces = (list(state.get('next_pieces') or []) + [None] * 3)[:3]
+    piece_pos = state.get('piece_pos') or (0, 0)
+    return (
+        state.get('score') or 0,
+        state.get('combo') or 0,
+        PIECE_CODES[state.get('current_piece')],
+        PIECE_CODES[state.get('hold_piece')],
+        piece_pos[0],
+        piece_pos[1],
+        *(PIECE_CODES[piece] for piece in next_pieces)
+    )
+
+def unpack_state(fields, board):
+    score, combo, current, hold, x, y, *next_codes = fields
+    return {
+        'type': 'game_update',
+        'board': board,
+        'score': score,
+        'combo': combo,
+        'current_piece': CODE_PIECES[current] or None,
+        'next_pieces': [CODE_PIECES[code] for code in next_codes if code],
+        'hold_piece': CODE_PIECES[hold] or None,
+        'piece_pos': [x, y]
+    }
+
+def encode_game_update(state):
+    """Binary equivalent of a JSON game_update message (about 110 bytes instead of ~900)"""
+    return GAME_UPDATE_HEADER.pack(GAME_UPDATE, *pack_state(state)) + encode_board(state['board'])
+
+def decode_game_update(payload):
+    if len(payload) != GAME_UPDATE_HEADER.size + BOARD_BYTES or payload[0] != GAME_UPDATE:
+        raise ProtocolError("Malformed binary game update")
+    fields = GAME_UPDATE_HEADER.unpack_from(payload)[1:]
+    return unpack_state(fields, decode_board(payload[GAME_UPDATE_HEADER.size:]))
+
+def encode_input(seq, time_ms, action):
+    """Input frame payload: 10 bytes per keypress"""
+    return INPUT_FORMAT.pack(INPUT, seq, time_ms, INPUT_ACTIONS.index(action))
+
+def decode_input(payload):
+    if len(payload) != INPUT_FORMAT.size or payload[-1] >= len(INPUT_ACTIONS):
+        raise ProtocolError("Malformed input frame")
+    _, seq, time_ms, action = INPUT_FORMAT.unpack(payload)
+    return {'type': 'input', 'seq': seq, 'time': time_ms, 'action': INPUT_ACTIONS[action]}
+
+# Offsets of the piece codes among the STATE_FORMAT fields
+STATE_PIECE_FIELDS = (2, 3, 6, 7, 8)
+
+def valid_state(fields):
+    return all(fields[i] < len(CODE_PIECES) for i in STATE_PIECE_FIELDS)
+
+def valid_payload(payload):
+    """Whether a binary payload is a game update or input frame a peer can decode. The server
+    checks everything it relays, since a peer can't tell a bad payload from a broken stream."""
+    tag = payload[0] if payload else None
+    if tag == GAME_UPDATE:
+        return len(payload) == GAME_UPDATE_HEADER.size + BOARD_BYTES and \
+            valid_state(GAME_UPDATE_HEADER.unpack_from(payload)[1:])
+    if tag == KEYFRAME:
+        return len(payload) == KEYFRAME_HEADER.size + BOARD_BYTES and \
+            valid_state(KEYFRAME_HEADER.unpack_from(payload)[2:])
+    if tag == DELTA:
+        if len(payload) < DELTA_HEADER.size:
+            return False
+        unpacked = DELTA_HEADER.unpack_from(payload)
+        mask = unpacked[-1]
+        return mask >> BOARD_HEIGHT == 0 and len(payload) == DELTA_HEADER.size + bin(mask).count('1') * ROW_BYTES \
+            and valid_state(unpacked[2:-1])
+    if tag == INPUT:
+        return len(payload) == INPUT_FORMAT.size and payload[-1] < len(INPUT_ACTIONS)
+    return False
+
+def payload_sequence(payload):
+    """Sequence number of a keyframe, delta or input payload"""
+    return struct.unpack_from('!I', payload, 1)[0]
+
+class UpdateEncoder:
+    """Sender side of delta mode: a keyframe every keyframe_interval updates (or on request),
+    otherwise only the rows that changed since the last update"""
+    def __init__(self, keyframe_interval=20):
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self.rows = None  # Packed rows as last sent
+        self.since_keyframe = 0
+        self.keyframe_requested = True
+
+    def request_keyframe(self):
+        self.keyframe_requested = True
+
+    def encode(self, state):
+        self.seq += 1
+        rows = [encode_row(row) for row in state['board']]
+        fields = pack_state(state)
+
+        if self.keyframe_requested or self.rows is None or self.since_keyframe >= self.keyframe_interval:
+            self.keyframe_requested = False
+            self.since_keyframe = 0
+            self.rows = rows
+            return KEYFRAME_HEADER.pack(KEYFRAME, self.seq, *fields) + b''.join(rows)
+
+        mask = 0
+        changed = []
+        for y, (old, new) in enumerate(zip(self.rows, rows)):
+            if old != new:
+                mask |= 1 << y
+                changed.append(new)
+        self.since_keyframe += 1
+        self.rows = rows
+        return DELTA_HEADER.pack(DELTA, self.seq, *fields, mask) + b''.join(changed)
+
+class UpdateDecoder:
+    """Receiver side of delta mode: keeps a copy of the remote board and applies deltas to it.
+    After a gap in the sequence needs_keyframe is set until the next keyframe arrives."""
+    def __init__(self):
+        self.board = None
+        self.seq = 0
+        self.needs_keyframe = False
+
+    def apply(self, payload):
+        """Returns a game_update message, or None for stale or unusable updates"""
+        tag = payload[0]
+        seq = payload_sequence(payload)
+        if seq <= self.seq and self.board is not None:
+            return None  # Older than what we already have
+
+        if tag == KEYFRAME:
+            if len(payload) != KEYFRAME_HEADER.size + BOARD_BYTES:
+                raise ProtocolError("Malformed keyframe")
+            fields = KEYFRAME_HEADER.unpack_from(payload)[2:]
+            self.board = decode_board(payload[KEYFRAME_HEADER.size:])
+            self.needs_keyframe = False
+        elif tag == DELTA:
+            if self.board is None or seq != self.seq + 1:
+                self.needs_keyframe = True
+                return None
+            unpacked = DELTA_HEADER.unpack_from(payload)
+            fields, mask = unpacked[2:-1], unpacked[-1]
+            offset = DELTA_HEADER.size
+            # Changed rows get fresh lists so a board handed out earlier is never mutated
+            board = list(self.board)
+            for y in range(BOARD_HEIGHT):
+                if mask >> y & 1:
+                    board[y] = decode_row(payload[offset:offset + ROW_BYTES])
+                    offset += ROW_BYTES
+            if offset != len(payload):
+                raise ProtocolError("Malformed delta")
+            self.board = board
+        else:
+            raise ProtocolError(f"Unknown update type {tag}")
+
+        self.seq = seq
+        return unpack_state(fields, list(self.board))
+
+class FrameDecoder:
+    """Incremental decoder: feed it whatever recv() returned, get back zero or more complete payloads"""
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        payloads = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_MESSAGE_SIZE:
+                raise ProtocolError(f"Message too large: {length} bytes")
+            end = offset + HEADER.size + length
+            if end > len(self.buffer):
+                break  # Partial frame, wait for more data
+            payloads.append(bytes(self.buffer[offset + HEADER.size:end]))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return payloads
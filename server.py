@@ -1,92 +1,560 @@
+import os
 import socket
 import threading
-import json
 import time
+import argparse
+import asyncio
+import random
+import base64
+import secrets
+from collections import deque
+
+from lobbies import LobbyRegistry, MAX_PLAYERS
+from match_store import MatchStore
+from leaderboard import Leaderboard
+from accounts import AccountStore, valid_username
+from metrics import ServerMetrics, start_metrics_server
+from protocol import (FrameDecoder, UpdateDecoder, PROTOCOL_VERSION, GAME_UPDATE, KEYFRAME, DELTA, INPUT, UDP_BIND, UDP_DATA, UDP_TOKEN_BYTES,
+                      MAX_DATAGRAM_SIZE, encode_message, encode_frame, decode_message, decode_game_update,
+                      encode_game_update, is_binary, payload_sequence, valid_payload)
+
+def raise_fd_limit():
+    # Each connection is a file descriptor, so 10k+ players need more than the usual soft limit
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+MAX_RESUME_DELTAS = 64  # Past this, a reconnecting peer gets the newest update and asks for a keyframe
+
+class SendQueueFull(ConnectionError):
+    pass
+
+class OutboundQueue:
+    """Bounded per-connection send queue.
+
+    Frames with a coalesce_key (game updates, keyed by sender) replace any still-unsent frame
+    with the same key, so a peer that falls behind only ever gets the newest snapshot. Frames
+    without a key (lobby, chat, ...) are never dropped; if those alone overflow the queue the
+    peer is too slow to serve and put() fails."""
+    def __init__(self, max_depth=256):
+        self.max_depth = max_depth
+        self.entries = deque()  # [coalesce_key, frame]
+        self.pending = {}  # {coalesce_key: entry still waiting in self.entries}
+        self.lock = threading.Lock()
+        self.coalesced = 0
+        self.max_seen = 0
+
+    def put(self, frame, coalesce_key=None):
+        with self.lock:
+            if coalesce_key is not None:
+                entry = self.pending.get(coalesce_key)
+                if entry is not None:
+                    entry[1] = frame
+                    self.coalesced += 1
+                    return
+            if len(self.entries) >= self.max_depth:
+                raise SendQueueFull(f"{len(self.entries)} frames queued")
+            entry = [coalesce_key, frame]
+            self.entries.append(entry)
+            if coalesce_key is not None:
+                self.pending[coalesce_key] = entry
+            self.max_seen = max(self.max_seen, len(self.entries))
+
+    def take_all(self):
+        with self.lock:
+            frames = [frame for _, frame in self.entries]
+            self.entries.clear()
+            self.pending.clear()
+            return frames
+
+    def __len__(self):
+        return len(self.entries)
+
+class ThreadedClient:
+    """Socket wrapper for threaded mode: sends are queued and written by a per-connection writer thread"""
+    def __init__(self, sock, max_queue_depth=256):
+        self.sock = sock
+        self.queue = OutboundQueue(max_queue_depth)
+        self.ready = threading.Event()
+        self.closed = False
+        self.writer_thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def sendall(self, frame, coalesce_key=None):
+        if self.closed:
+            raise ConnectionError("Connection closed")
+        self.queue.put(frame, coalesce_key)
+        self.ready.set()
+
+    def write_loop(self):
+        try:
+            while True:
+                self.ready.wait()
+                self.ready.clear()
+                if self.closed:
+                    break
+                frames = self.queue.take_all()
+                if frames:
+                    self.sock.sendall(b''.join(frames))
+        except OSError:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.ready.set()
+        try:
+            # Wakes the reader thread too, which then runs the normal disconnect path
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class AsyncClient:
+    """Stream wrapper for asyncio mode: sends are queued and written by a per-connection task,
+    which waits for the transport to drain so a slow peer only ever backs up its own queue"""
+    def __init__(self, reader, writer, max_queue_depth=256):
+        self.reader = reader
+        self.writer = writer
+        self.queue = OutboundQueue(max_queue_depth)
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.writer_task = asyncio.ensure_future(self.write_loop())
+
+    def sendall(self, frame, coalesce_key=None):
+        if self.closed:
+            raise ConnectionError("Connection closed")
+        self.queue.put(frame, coalesce_key)
+        self.ready.set()
+
+    async def write_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                frames = self.queue.take_all()
+                if frames:
+                    self.writer.write(b''.join(frames))
+                    await self.writer.drain()
+        except (OSError, asyncio.CancelledError):
+            pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer_task.cancel()
+        self.writer.close()
+
+class UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, address):
+        self.server.handle_datagram(data, address)
 
 class GameServer:
-    def __init__(self, host='0.0.0.0', port=5555):
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind((host, port))
-        self.server.listen()
+    def __init__(self, host='0.0.0.0', port=5555, mode='threaded', listen=True, lobby_prefix='', udp=False,
+                 resume_grace=30.0, match_db='matches.db', accounts_db='accounts.db'):
+        self.mode = mode  # 'threaded' (one thread per socket) or 'asyncio' (single event loop)
+        self.server = None
+        self.udp_socket = None  # Optional game update channel on the same port number
+        self.udp_port = None
+        self.udp_send = None  # sendto() of the UDP socket or transport, set once serving
+        if listen:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind((host, port))
+            self.server.listen(1024)
+            if udp:
+                self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.udp_socket.bind((host, port))
+                self.udp_port = self.udp_socket.getsockname()[1]
         
-        self.lobbies = {}  # {lobby_id: {'host': username, 'players': [username1, username2], 'ready': {username1: False, username2: False}, 'roles': {'username1': 'player1', 'username2': 'player2'}}}
+        self.lobbies = LobbyRegistry(lobby_prefix)  # {lobby_id: Lobby}, safe to use from any handler thread
+        self.connections = set()  # Every open ThreadedClient/AsyncClient, in a lobby or not
         self.clients = {}  # {client_socket: {'username': username, 'lobby': lobby_id, 'role': 'player1' or 'player2'}}
-        self.next_lobby_id = 1
+        self.client_versions = {}  # {client_socket: negotiated protocol version}, 1 until the client says hello
+        self.metrics = ServerMetrics()  # Counters, per-command rates and handler latencies, see get_stats
+        self.update_mirrors = {}  # {client_socket: UpdateDecoder}, only kept to translate deltas for older peers
+        self.udp_tokens = {}  # {token: client_socket}, handed out in the hello reply
+        self.udp_sessions = {}  # {client_socket: token}
+        self.udp_addresses = {}  # {client_socket: (host, port)} the token was last bound from
+        self.udp_clients = {}  # {client_socket: (host, port)} for clients that confirmed UDP works both ways
+        # Resumable seats: a dropped player keeps their seat for resume_grace seconds (0 disables)
+        self.resume_grace = resume_grace
+        self.sessions = {}  # {resume token: {'username', 'lobby', 'role', 'client', 'timer'}}
+        self.auth_tokens = {}  # {login token: username}, checked instead of credentials after login
+        self.user_tokens = {}  # {username: login token}, so logging in again retires the old token
+        self.client_logins = {}  # {client: login token} of the connection, handed over with it (see sharding.py)
+        self.sessions_lock = threading.Lock()
+        self.match_store = MatchStore(match_db) if match_db else None  # Finished matches, written behind
+        self.leaderboard = Leaderboard(match_db) if match_db else None  # Ranked from the match store
+        self.accounts = AccountStore(accounts_db) if accounts_db else None  # None trusts any login
         
-        print(f"Server started on {host}:{port}")
+        if listen:
+            print(f"Server started on {host}:{port} ({mode}{', udp' if udp else ''})")
         
     def start(self):
+        if self.mode == 'asyncio':
+            asyncio.run(self.serve_async())
+            return
+        if self.udp_socket is not None:
+            self.udp_send = self.udp_socket.sendto
+            threading.Thread(target=self.udp_loop, daemon=True).start()
         while True:
-            client, address = self.server.accept()
-            thread = threading.Thread(target=self.handle_client, args=(client,))
+            sock, address = self.server.accept()
+            thread = threading.Thread(target=self.handle_client, args=(ThreadedClient(sock),))
             thread.start()
             
+    def close(self):
+        """Shutdown: write out the match results still queued"""
+        if self.match_store is not None:
+            self.match_store.close()
+
     def handle_client(self, client):
+        self.connections.add(client)
+        decoder = FrameDecoder()
         while True:
             try:
-                data = client.recv(1024).decode('utf-8')
+                data = client.recv(65536)
                 if not data:
                     break
+                self.count('bytes_in', len(data))
                     
-                message = json.loads(data)
-                command = message.get('command')
-                
-                if command == 'create_lobby':
-                    self.handle_create_lobby(client, message)
-                elif command == 'join_lobby':
-                    self.handle_join_lobby(client, message)
-                elif command == 'ready':
-                    self.handle_ready(client, message)
-                elif command == 'leave_lobby':
-                    self.handle_leave_lobby(client)
-                elif command == 'get_lobbies':
-                    self.send_lobby_list(client)
-                elif command == 'chat':
-                    self.handle_chat(client, message)
-                elif command == 'game_update':
-                    self.handle_game_update(client, message)
+                # A single read may hold several messages, or only part of one
+                for payload in decoder.feed(data):
+                    self.handle_payload(client, payload)
                     
             except Exception as e:
                 print(f"Error handling client: {e}")
+                self.count('connection_errors')
                 break
                 
         self.handle_disconnect(client)
+
+    def udp_loop(self):
+        while True:
+            try:
+                data, address = self.udp_socket.recvfrom(MAX_DATAGRAM_SIZE)
+                self.handle_datagram(data, address)
+            except Exception as e:
+                print(f"Error handling datagram: {e}")
+                self.count('udp_errors')
+
+    async def serve_async(self):
+        # All connections share one event loop; handlers run inline on the loop thread
+        raise_fd_limit()
+        self.server.setblocking(False)
+        if self.udp_socket is not None:
+            transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: UdpProtocol(self), sock=self.udp_socket)
+            self.udp_send = transport.sendto
+        async_server = await asyncio.start_server(self.handle_async_client, sock=self.server)
+        async with async_server:
+            await async_server.serve_forever()
+
+    async def handle_async_client(self, reader, writer, initial=b'', version=None, login=None):
+        # initial/version/login carry bytes already read, the protocol version already agreed and
+        # the [token, username] logged in with when a connection is handed over from another
+        # process (see sharding.py)
+        client = AsyncClient(reader, writer)
+        self.connections.add(client)
+        if version is not None:
+            self.client_versions[client] = version
+        if login is not None:
+            self.grant_token(*login)
+            self.client_logins[client] = login[0]
+        decoder = FrameDecoder()
+        data = initial
+        while True:
+            try:
+                if not data:
+                    data = await reader.read(65536)
+                    if not data:
+                        break
+                self.count('bytes_in', len(data))
+
+                payloads = decoder.feed(data)
+                data = b''
+                for index, payload in enumerate(payloads):
+                    if await self.intercept_payload(client, payload, payloads[index + 1:], decoder):
+                        return  # The connection now belongs to someone else
+                    self.handle_payload(client, payload)
+
+            except Exception as e:
+                print(f"Error handling client: {e}")
+                self.count('connection_errors')
+                break
+
+        self.handle_disconnect(client)
+
+    async def intercept_payload(self, client, payload, rest, decoder):
+        """Hook for subclasses that may hand a connection elsewhere before payload is handled"""
+        return False
+
+    def lobby_changed(self, lobby_id):
+        """Hook called after a lobby is created, joined or left"""
+        pass
+
+    def handle_payload(self, client, payload):
+        start = time.perf_counter()
+        command = 'binary_game_update'
+        try:
+            if is_binary(payload) and not valid_payload(payload):
+                # Never stored or relayed: the peer's decoder would choke on it
+                command = 'malformed_payload'
+                self.count('malformed_payloads')
+            elif is_binary(payload) and payload[0] == INPUT:
+                command = 'input'
+                self.handle_input(client, payload)
+            elif is_binary(payload):
+                # Binary game updates are relayed as-is without being decoded
+                self.handle_binary_game_update(client, payload)
+            else:
+                message = decode_message(payload)
+                command = str(message.get('command'))
+                self.handle_message(client, message)
+        except Exception:
+            self.count('handler_errors')
+            raise
+        finally:
+            self.metrics.record_command(command, time.perf_counter() - start)
+
+    def handle_message(self, client, message):
+        command = message.get('command')
+
+        if command == 'hello':
+            self.handle_hello(client, message)
+        elif command == 'login':
+            self.handle_login(client, message)
+        elif command == 'create_lobby':
+            self.handle_create_lobby(client, message)
+        elif command == 'join_lobby':
+            self.handle_join_lobby(client, message)
+        elif command == 'ready':
+            self.handle_ready(client, message)
+        elif command == 'leave_lobby':
+            self.handle_leave_lobby(client)
+        elif command == 'get_lobbies':
+            self.send_lobby_list(client)
+        elif command == 'get_leaderboard':
+            self.send_leaderboard(client, message)
+        elif command == 'get_rank':
+            self.send_rank(client, message)
+        elif command == 'search_leaderboard':
+            self.send_search_results(client, message)
+        elif command == 'chat':
+            self.handle_chat(client, message)
+        elif command == 'game_update':
+            self.handle_game_update(client, message)
+        elif command == 'request_keyframe':
+            self.handle_request_keyframe(client)
+        elif command == 'resync_inputs':
+            self.handle_resync_inputs(client, message)
+        elif command == 'game_over':
+            self.handle_game_over(client, message)
+        elif command == 'resume':
+            self.handle_resume(client, message)
+        elif command == 'udp_ready':
+            self.handle_udp_ready(client)
+        elif command == 'udp_off':
+            self.udp_clients.pop(client, None)
         
-    def handle_create_lobby(self, client, message):
+    def count(self, name, amount=1):
+        self.metrics.count(name, amount)
+
+    def get_stats(self):
+        stats = self.metrics.snapshot()
+        connections = list(self.connections)
+        depths = [len(client.queue) for client in connections]
+        stats['connections'] = len(connections)
+        stats['clients_in_lobbies'] = len(self.clients)
+        stats['lobbies'] = len(self.lobbies)
+        stats['send_queue_depth_total'] = sum(depths)
+        stats['send_queue_depth_max'] = max(depths, default=0)
+        stats['send_queue_high_water'] = max((client.queue.max_seen for client in connections), default=0)
+        stats['updates_coalesced'] = sum(client.queue.coalesced for client in connections)
+        if self.match_store is not None:
+            stats['matches_written'] = self.match_store.written
+            stats['matches_pending'] = self.match_store.pending.qsize()
+            stats['matches_dropped'] = self.match_store.dropped
+        return stats
+
+    def encode(self, message):
+        """Serialize a message into a frame; every JSON serialization on the send path goes through here"""
+        self.count('messages_encoded')
+        return encode_message(message)
+
+    def encode_payload(self, payload):
+        self.count('payloads_framed')
+        return encode_frame(payload)
+
+    def send_frame(self, client, frame, coalesce_key=None):
+        """Queue a frame for a client; returns False (and counts why) if it could not be queued"""
+        try:
+            client.sendall(frame, coalesce_key)
+        except SendQueueFull:
+            # Lobby/chat traffic must not be dropped, so a peer that can't keep up is cut off
+            print("Disconnecting slow client: send queue full")
+            self.count('slow_client_disconnects')
+            client.close()
+            return False
+        except (OSError, ValueError):
+            self.count('send_errors')
+            return False
+        self.count('frames_sent')
+        self.count('bytes_out', len(frame))
+        return True
+
+    def send_message(self, client, message):
+        self.send_frame(client, self.encode(message))
+
+    def handle_hello(self, client, message):
+        version = max(1, min(int(message.get('version', 1)), PROTOCOL_VERSION))
+        self.client_versions[client] = version
+        reply = {'type': 'hello', 'version': version}
+        if version >= 4 and self.udp_socket is not None:
+            # The token binds datagrams to this TCP session; the client proves it can use UDP
+            # by echoing it from its UDP socket (see handle_datagram)
+            self.forget_udp(client)
+            token = os.urandom(UDP_TOKEN_BYTES)
+            self.udp_tokens[token] = client
+            self.udp_sessions[client] = token
+            reply['udp_port'] = self.udp_port
+            reply['udp_token'] = token.hex()
+        self.send_message(client, reply)
+
+    def forget_udp(self, client):
+        token = self.udp_sessions.pop(client, None)
+        if token is not None:
+            self.udp_tokens.pop(token, None)
+        self.udp_addresses.pop(client, None)
+        self.udp_clients.pop(client, None)
+
+    def handle_datagram(self, data, address):
+        tag, token = data[0:1], data[1:1 + UDP_TOKEN_BYTES]
+        client = self.udp_tokens.get(token)
+        if client is None:
+            self.count('udp_rejected')
+            return
+        if tag == bytes([UDP_BIND]):
+            self.udp_addresses[client] = address
+            self.udp_send(data, address)  # Ack, so the client knows datagrams reach it too
+        elif tag == bytes([UDP_DATA]) and self.udp_addresses.get(client) == address:
+            payload = data[1 + UDP_TOKEN_BYTES:]
+            # Only keyframes and deltas travel over UDP, and only well-formed ones are relayed
+            if payload[:1] in (bytes([KEYFRAME]), bytes([DELTA])) and valid_payload(payload):
+                self.count('udp_in')
+                self.handle_payload(client, payload)
+            else:
+                self.count('udp_rejected')
+        else:
+            self.count('udp_rejected')
+
+    def handle_udp_ready(self, client):
+        # Only sent after the client got our ack, so datagrams work in both directions
+        address = self.udp_addresses.get(client)
+        if address is not None:
+            self.udp_clients[client] = address
+
+    def send_datagram(self, client, payload):
+        """Send a game update payload over UDP if the client has a working UDP channel"""
+        address = self.udp_clients.get(client)
+        if address is None:
+            return False
+        try:
+            self.udp_send(bytes([UDP_DATA]) + payload, address)
+        except OSError:
+            self.count('udp_errors')
+            return False
+        self.count('udp_out')
+        self.count('bytes_out', len(payload) + 1)
+        return True
+
+    def handle_login(self, client, message):
         username = message.get('username')
-        lobby_id = str(self.next_lobby_id)
-        self.next_lobby_id += 1
-        
-        self.lobbies[lobby_id] = {
-            'host': username,
-            'players': [username],
-            'ready': {username: False},
-            'roles': {username: 'player1'}
-        }
+        password = message.get('password')
+        if not valid_username(username) or not isinstance(password, str) or not password:
+            self.send_message(client, {'type': 'login_failed', 'message': 'Invalid username or password'})
+            return
+        if self.accounts is None:
+            self.finish_login(client, username, 'ok')
+            return
+        # Password hashing runs on the account store's pool, the reply comes back when it's done
+        self.when_done(self.accounts.login(username, password), self.finish_login, client, username)
+
+    def finish_login(self, client, username, outcome):
+        if outcome in ('ok', 'created'):
+            self.count('logins')
+            token = secrets.token_hex(16)
+            self.grant_token(token, username)
+            self.client_logins[client] = token
+            self.send_message(client, {'type': 'login_ok', 'username': username, 'created': outcome == 'created',
+                                       'token': token})
+        else:
+            self.count('login_failures')
+            message = 'Wrong password' if outcome == 'wrong_password' else 'Login is unavailable, try again'
+            self.send_message(client, {'type': 'login_failed', 'message': message})
+
+    def grant_token(self, token, username):
+        old_token = self.user_tokens.get(username)
+        if old_token is not None:
+            self.auth_tokens.pop(old_token, None)
+        self.auth_tokens[token] = username
+        self.user_tokens[username] = token
+
+    def authenticate(self, client, message):
+        """Username of the login token a command carries; replies and returns None if it has none"""
+        username = self.auth_tokens.get(message.get('token'))
+        if username is None:
+            self.send_message(client, {'type': 'login_required', 'message': 'Log in first'})
+        return username
+
+    def handle_create_lobby(self, client, message):
+        username = self.authenticate(client, message)
+        if username is None:
+            return
+        # A client is in at most one lobby
+        self.handle_leave_lobby(client)
+        lobby = self.lobbies.create(username, client)
         
         self.clients[client] = {
             'username': username,
-            'lobby': lobby_id,
+            'lobby': lobby.id,
             'role': 'player1'
         }
         
         response = {
             'type': 'lobby_created',
-            'lobby_id': lobby_id,
+            'lobby_id': lobby.id,
             'status': 'success',
             'role': 'player1'
         }
-        client.send(json.dumps(response).encode('utf-8'))
+        self.send_message(client, response)
+        self.start_session(client)
+        self.lobby_changed(lobby.id)
         
     def handle_join_lobby(self, client, message):
         lobby_id = message.get('lobby_id')
-        username = message.get('username')
+        username = self.authenticate(client, message)
+        if username is None:
+            return
         
-        if lobby_id in self.lobbies and len(self.lobbies[lobby_id]['players']) < 2:
-            self.lobbies[lobby_id]['players'].append(username)
-            self.lobbies[lobby_id]['ready'][username] = False
-            self.lobbies[lobby_id]['roles'][username] = 'player2'
-            
+        self.handle_leave_lobby(client)
+        lobby = self.lobbies.join(lobby_id, username, client)
+        if lobby is not None:
             self.clients[client] = {
                 'username': username,
                 'lobby': lobby_id,
@@ -97,41 +565,61 @@ class GameServer:
             self.broadcast_to_lobby(lobby_id, {
                 'type': 'player_joined',
                 'username': username,
-                'players': self.lobbies[lobby_id]['players'],
-                'roles': self.lobbies[lobby_id]['roles'],
-                'ready': self.lobbies[lobby_id]['ready']
+                **lobby.state()
             })
+            self.start_session(client)
+            self.lobby_changed(lobby_id)
         else:
             response = {
                 'type': 'join_failed',
                 'message': 'Lobby is full or does not exist'
             }
-            client.send(json.dumps(response).encode('utf-8'))
+            self.send_message(client, response)
             
+    def lobby_peers(self, lobby_id):
+        # Snapshot so a concurrent join/leave can't change the set while we iterate
+        return self.lobbies.members(lobby_id)
+
     def handle_ready(self, client, message):
         if client in self.clients:
             lobby_id = self.clients[client]['lobby']
             username = self.clients[client]['username']
             
-            if lobby_id in self.lobbies:
-                # Toggle ready status for the specific player
-                self.lobbies[lobby_id]['ready'][username] = not self.lobbies[lobby_id]['ready'][username]
+            lobby = self.lobbies.get(lobby_id)
+            if lobby is not None:
+                with lobby.lock:
+                    if username not in lobby.ready:
+                        return
+                    # Toggle ready status for the specific player
+                    lobby.ready[username] = not lobby.ready[username]
+                    all_ready = all(lobby.ready.values())
+                    if all_ready:
+                        lobby.seed = random.getrandbits(32)
+                        lobby.updates = {}
+                        lobby.inputs = {}
+                        lobby.in_game = True
+                        lobby.started_at = time.time()
+                        lobby.results = {}
+                    state = lobby.state()
                 
                 # Check if all players are ready
-                if all(self.lobbies[lobby_id]['ready'].values()):
+                if all_ready:
+                    # Both clients deal pieces from the lobby's seed (pieces.SevenBag); if everyone
+                    # can replay inputs the game runs in lockstep and only input frames are relayed
+                    lockstep = all(self.client_versions.get(peer, 1) >= 5 for peer in self.lobby_peers(lobby_id))
+                    with lobby.lock:
+                        lobby.sync = 'lockstep' if lockstep else 'state'
                     self.broadcast_to_lobby(lobby_id, {
                         'type': 'game_start',
-                        'players': self.lobbies[lobby_id]['players'],
-                        'roles': self.lobbies[lobby_id]['roles'],
-                        'ready': self.lobbies[lobby_id]['ready']
+                        'seed': lobby.seed,
+                        'sync': lobby.sync,
+                        **state
                     })
                 else:
                     # Send ready update to all players
                     self.broadcast_to_lobby(lobby_id, {
                         'type': 'ready_update',
-                        'players': self.lobbies[lobby_id]['players'],
-                        'ready': self.lobbies[lobby_id]['ready'],
-                        'roles': self.lobbies[lobby_id]['roles']
+                        **state
                     })
                     
     def handle_leave_lobby(self, client):
@@ -139,50 +627,298 @@ class GameServer:
             lobby_id = self.clients[client]['lobby']
             username = self.clients[client]['username']
             
-            if lobby_id in self.lobbies:
-                self.lobbies[lobby_id]['players'].remove(username)
-                del self.lobbies[lobby_id]['ready'][username]
-                del self.lobbies[lobby_id]['roles'][username]
-                
-                if not self.lobbies[lobby_id]['players']:
-                    del self.lobbies[lobby_id]
-                else:
-                    self.broadcast_to_lobby(lobby_id, {
-                        'type': 'player_left',
-                        'username': username,
-                        'players': self.lobbies[lobby_id]['players'],
-                        'roles': self.lobbies[lobby_id]['roles'],
-                        'ready': self.lobbies[lobby_id]['ready']
-                    })
+            self.finish_player(lobby_id, username, None)  # Leaving mid-game forfeits
+            lobby = self.lobbies.leave(lobby_id, username, client)
+            if lobby is None:
+                self.metrics.forget_lobby(lobby_id)
+            else:
+                # The leaving client is no longer a member, so it isn't told about its own departure
+                self.broadcast_to_lobby(lobby_id, {
+                    'type': 'player_left',
+                    'username': username,
+                    **lobby.state()
+                })
+            self.lobby_changed(lobby_id)
+            with self.sessions_lock:
+                self.sessions.pop(self.clients[client].get('session'), None)
                     
             del self.clients[client]
             
     def handle_disconnect(self, client):
-        self.handle_leave_lobby(client)
+        if not self.suspend_session(client):
+            self.handle_leave_lobby(client)
+        self.client_versions.pop(client, None)
+        self.client_logins.pop(client, None)
+        self.update_mirrors.pop(client, None)
+        self.forget_udp(client)
+        self.connections.discard(client)
         client.close()
         
+    def handle_game_over(self, client, message):
+        if client not in self.clients:
+            return
+        info = self.clients[client]
+        try:
+            score = int(message.get('score') or 0)
+        except (TypeError, ValueError):
+            score = 0
+        self.broadcast_to_lobby(info['lobby'], {
+            'type': 'game_over',
+            'player': 'p1' if info['role'] == 'player1' else 'p2',
+            'username': info['username'],
+            'score': score
+        })
+        self.finish_player(info['lobby'], info['username'], score)
+
+    def finish_player(self, lobby_id, username, score):
+        """Record that a player's game ended (score None if they left mid-game). Once every player
+        is done the winner is decided, announced and queued for the match store."""
+        lobby = self.lobbies.get(lobby_id)
+        if lobby is None:
+            return None
+        with lobby.lock:
+            if not lobby.in_game or username in lobby.results:
+                return None
+            lobby.results[username] = score
+            if not set(lobby.players) <= set(lobby.results):
+                return None
+            lobby.in_game = False
+            result = self.match_result(lobby)
+
+        self.broadcast_to_lobby(lobby_id, {
+            'type': 'match_result',
+            'winner': result['winner'],
+            'scores': {player['username']: player['score'] for player in result['players']}
+        })
+        if self.match_store is not None:
+            self.match_store.record(result)
+        return result
+
+    def match_result(self, lobby):
+        """Same rule as the client's game over screen: highest score wins, a tie has no winner.
+        Players who left forfeit. Call with lobby.lock held."""
+        finishers = {username: score for username, score in lobby.results.items() if score is not None}
+        best = max(finishers.values(), default=None)
+        leaders = [username for username, score in finishers.items() if score == best]
+        winner = leaders[0] if len(leaders) == 1 else None
+        players = []
+        for username, score in lobby.results.items():
+            if score is None:
+                outcome = 'forfeit'
+            elif winner is None:
+                outcome = 'tie'
+            else:
+                outcome = 'win' if username == winner else 'loss'
+            players.append({'username': username, 'role': lobby.roles.get(username), 'score': score,
+                            'outcome': outcome})
+        return {
+            'lobby_id': lobby.id,
+            'seed': lobby.seed,
+            'sync': lobby.sync,
+            'started_at': lobby.started_at,
+            'finished_at': time.time(),
+            'winner': winner,
+            'players': players
+        }
+
+    def call_later(self, delay, callback, *args):
+        """Run callback after delay seconds on the loop (asyncio) or a timer thread; returns something with cancel()"""
+        if self.mode == 'asyncio':
+            return asyncio.get_running_loop().call_later(delay, callback, *args)
+        timer = threading.Timer(delay, callback, args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def when_done(self, future, callback, *args):
+        """Call callback(*args, result) once a worker-pool future finishes, on the loop (asyncio) or the
+        pool thread; result is None if the task raised"""
+        def done(future):
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"Background task failed: {e}")
+                result = None
+            callback(*args, result)
+
+        if self.mode == 'asyncio':
+            loop = asyncio.get_running_loop()
+            future.add_done_callback(lambda future: loop.call_soon_threadsafe(done, future))
+        else:
+            future.add_done_callback(done)
+
+    def start_session(self, client):
+        """Give a client that just took a seat the token it can reclaim the seat with after a drop"""
+        if self.resume_grace <= 0:
+            return
+        info = self.clients[client]
+        # The lobby prefix keeps tokens routable to the owning worker, like lobby ids (see sharding.py)
+        token = self.lobbies.id_prefix + os.urandom(16).hex()
+        with self.sessions_lock:
+            self.sessions[token] = {
+                'username': info['username'],
+                'lobby': info['lobby'],
+                'role': info['role'],
+                'client': client,
+                'timer': None
+            }
+        info['session'] = token
+        self.send_message(client, {'type': 'session', 'resume_token': token, 'grace': self.resume_grace})
+
+    def suspend_session(self, client):
+        """Keep a dropped client's seat for the grace window; returns False if there is nothing to keep"""
+        info = self.clients.get(client)
+        if info is None:
+            return False
+        with self.sessions_lock:
+            session = self.sessions.get(info.get('session'))
+            if session is None or session['client'] is not client:
+                return False
+            if not self.lobbies.replace_member(info['lobby'], client, None):
+                return False
+            session['client'] = None
+            session['timer'] = self.call_later(self.resume_grace, self.expire_session, info['session'])
+            del self.clients[client]
+        self.broadcast_to_lobby(info['lobby'], {
+            'type': 'player_disconnected',
+            'username': info['username'],
+            'grace': self.resume_grace
+        })
+        return True
+
+    def expire_session(self, token):
+        with self.sessions_lock:
+            session = self.sessions.get(token)
+            if session is None or session['client'] is not None:
+                return  # Resumed or already gone
+            del self.sessions[token]
+        self.finish_player(session['lobby'], session['username'], None)
+        lobby = self.lobbies.leave(session['lobby'], session['username'], None)
+        if lobby is None:
+            self.metrics.forget_lobby(session['lobby'])
+        else:
+            self.broadcast_to_lobby(session['lobby'], {
+                'type': 'player_left',
+                'username': session['username'],
+                **lobby.state()
+            })
+        self.lobby_changed(session['lobby'])
+
+    def handle_resume(self, client, message):
+        token = message.get('token')
+        with self.sessions_lock:
+            session = self.sessions.get(token)
+            lobby = self.lobbies.get(session['lobby']) if session is not None else None
+            if lobby is None:
+                session = None
+            else:
+                if session['timer'] is not None:
+                    session['timer'].cancel()
+                    session['timer'] = None
+                old_client = session['client']
+                session['client'] = client
+        if session is None:
+            self.send_message(client, {'type': 'resume_failed', 'message': 'Session expired'})
+            return
+
+        if old_client is not None and old_client is not client:
+            # The old connection is half-open; retire it without giving up the seat
+            self.clients.pop(old_client, None)
+            self.lobbies.replace_member(lobby.id, old_client, None)
+            old_client.close()
+        if self.clients.get(client, {}).get('session') != token:
+            self.handle_leave_lobby(client)
+        self.clients[client] = {
+            'username': session['username'],
+            'lobby': lobby.id,
+            'role': session['role'],
+            'session': token
+        }
+        self.lobbies.replace_member(lobby.id, None, client)
+
+        # Compact catch-up: each sender's last keyframe plus the deltas since, and in lockstep the
+        # whole input log, as base64 runs of length-prefixed frames
+        with lobby.lock:
+            updates = {username: list(payloads) for username, payloads in lobby.updates.items()}
+            inputs = {username: list(payloads) for username, payloads in lobby.inputs.items()}
+            seed, sync = lobby.seed, lobby.sync
+        pack = lambda payloads: base64.b64encode(b''.join(encode_frame(p) for p in payloads)).decode('ascii')
+        self.send_message(client, {
+            'type': 'resumed',
+            'lobby_id': lobby.id,
+            'role': session['role'],
+            'seed': seed,
+            'sync': sync,
+            'updates': {username: pack(payloads) for username, payloads in updates.items()},
+            'inputs': {username: pack(payloads) for username, payloads in inputs.items()},
+            **lobby.state()
+        })
+        for other_client in self.lobby_peers(lobby.id):
+            if other_client is not client:
+                self.send_message(other_client, {'type': 'player_reconnected', 'username': session['username']})
+
     def broadcast_to_lobby(self, lobby_id, message):
-        for client, data in self.clients.items():
-            if data['lobby'] == lobby_id:
-                try:
-                    client.send(json.dumps(message).encode('utf-8'))
-                except:
-                    pass
+        # Serialize once, then write the same immutable buffer to every member
+        frame = self.encode(message)
+        for client in self.lobby_peers(lobby_id):
+            self.send_frame(client, frame)
                     
+    def lobby_summary(self, lobby_id):
+        """Lobby list entry for a lobby, or None if it no longer exists"""
+        lobby = self.lobbies.get(lobby_id)
+        if lobby is None:
+            return None
+        with lobby.lock:
+            return {
+                'id': lobby.id,
+                'host': lobby.host,
+                'players': len(lobby.players),
+                'max_players': MAX_PLAYERS
+            }
+
+    def list_lobbies(self):
+        summaries = (self.lobby_summary(lobby.id) for lobby in self.lobbies.all())
+        return [summary for summary in summaries if summary is not None]
+
     def send_lobby_list(self, client):
         lobby_list = {
             'type': 'lobby_list',
-            'lobbies': [
-                {
-                    'id': lobby_id,
-                    'host': data['host'],
-                    'players': len(data['players']),
-                    'max_players': 2
-                }
-                for lobby_id, data in self.lobbies.items()
-            ]
+            'lobbies': self.list_lobbies()
         }
-        client.send(json.dumps(lobby_list).encode('utf-8'))
+        self.send_message(client, lobby_list)
+
+    def send_leaderboard(self, client, message):
+        try:
+            offset, limit = int(message.get('offset', 0)), int(message.get('limit', 10))
+        except (TypeError, ValueError):
+            offset, limit = 0, 10
+        if self.leaderboard is not None:
+            page = self.leaderboard.page(offset, limit)
+        else:
+            page = {'offset': offset, 'total': 0, 'entries': []}
+        self.send_message(client, {'type': 'leaderboard', **page})
+
+    def send_search_results(self, client, message):
+        query = str(message.get('query', ''))[:32]
+        try:
+            offset, limit = int(message.get('offset', 0)), int(message.get('limit', 10))
+        except (TypeError, ValueError):
+            offset, limit = 0, 10
+        if self.leaderboard is not None and query:
+            results = self.leaderboard.search(query, offset, limit)
+        else:
+            results = {'query': query, 'offset': offset, 'total': 0, 'entries': []}
+        self.send_message(client, {'type': 'search_results', **results})
+
+    def send_rank(self, client, message):
+        username = message.get('username')
+        if username is None and client in self.clients:
+            username = self.clients[client]['username']
+        if self.leaderboard is not None:
+            rank = self.leaderboard.rank(username)
+        else:
+            rank = {'username': username, 'rank': None, 'score': None, 'total': 0}
+        self.send_message(client, {'type': 'rank', **rank})
 
     def handle_chat(self, client, message):
         if client in self.clients:
@@ -217,19 +953,165 @@ class GameServer:
             'score': message.get('score'),
             'combo': message.get('combo'),
             'current_piece': message.get('current_piece'),
-            'next_piece': message.get('next_piece'),
+            'next_pieces': message.get('next_pieces'),
             'hold_piece': message.get('hold_piece'),
             'piece_pos': message.get('piece_pos')
         }
         
-        # Broadcast to other player in the lobby
-        for other_client, client_data in self.clients.items():
-            if client_data['lobby'] == lobby_id and client_data['username'] != sender:
-                try:
-                    other_client.send(json.dumps(update_message).encode('utf-8'))
-                except:
-                    pass
+        # Broadcast to other player in the lobby; a newer update from the same sender supersedes this one
+        frame = self.encode(update_message)
+        coalesce_key = ('game_update', sender)
+        for other_client in self.lobby_peers(lobby_id):
+            if self.clients.get(other_client, {}).get('username') != sender:
+                self.send_frame(other_client, frame, coalesce_key)
+        self.metrics.record_lobby_traffic(lobby_id)
+
+    def handle_input(self, client, payload):
+        """Relay a lockstep input frame; inputs are never coalesced, every one is needed to replay the game"""
+        if client not in self.clients:
+            return
+
+        lobby_id = self.clients[client]['lobby']
+        sender = self.clients[client]['username']
+        lobby = self.lobbies.get(lobby_id)
+        if lobby is None:
+            return
+        with lobby.lock:
+            # Only a lockstep game in progress has an input log; it is replayed to a player who reconnects
+            if not lobby.in_game or lobby.sync != 'lockstep':
+                return
+            lobby.inputs.setdefault(sender, []).append(payload)
+        frame = self.encode_payload(payload)
+        for other_client in self.lobby_peers(lobby_id):
+            if self.clients.get(other_client, {}).get('username') != sender:
+                if self.client_versions.get(other_client, 1) >= 5:
+                    self.send_frame(other_client, frame)
+        self.metrics.record_lobby_traffic(lobby_id)
+
+    def handle_resync_inputs(self, client, message):
+        """Resend the opponents' input frames with a sequence number above 'after'; the client
+        found a gap in what it was relayed"""
+        if client not in self.clients:
+            return
+
+        lobby = self.lobbies.get(self.clients[client]['lobby'])
+        if lobby is None:
+            return
+        username = self.clients[client]['username']
+        try:
+            after = int(message.get('after', 0))
+        except (TypeError, ValueError):
+            self.count('malformed_payloads')
+            return
+        with lobby.lock:
+            missed = [payload for sender, payloads in lobby.inputs.items() if sender != username
+                      for payload in payloads if payload_sequence(payload) > after]
+        # A sender's log can be out of order when it resent inputs after a reconnect
+        for payload in sorted(missed, key=payload_sequence):
+            self.send_frame(client, self.encode_payload(payload))
+
+    def handle_binary_game_update(self, client, payload):
+        if client not in self.clients:
+            return
+
+        lobby_id = self.clients[client]['lobby']
+        lobby = self.lobbies.get(lobby_id)
+        if lobby is None:
+            return
+
+        sender = self.clients[client]['username']
+        # Keep what a reconnecting peer needs to rebuild this sender's board
+        history = lobby.updates.get(sender)
+        if payload[0] != DELTA or history is None or len(history) >= MAX_RESUME_DELTAS:
+            lobby.updates[sender] = [payload]
+        else:
+            history.append(payload)
+        frame = self.encode_payload(payload)
+        # Peers too old for this payload get it translated, at most once per version per update
+        translated = {}
+        # If a peer falls behind, only the newest update per sender is kept. Coalescing away a
+        # delta leaves a sequence gap, which the receiver repairs with a keyframe request.
+        coalesce_key = ('game_update', sender)
+
+        for other_client in self.lobby_peers(lobby_id):
+            if self.clients.get(other_client, {}).get('username') != sender:
+                version = self.client_versions.get(other_client, 1)
+                if version >= 3 or (version >= 2 and payload[0] == GAME_UPDATE):
+                    # UDP when the peer has it; a lost datagram just means a skipped snapshot. A
+                    # version 2 sender's unsequenced snapshots stay on TCP, UDP only carries
+                    # keyframes and deltas.
+                    if payload[0] == GAME_UPDATE or not self.send_datagram(other_client, payload):
+                        self.send_frame(other_client, frame, coalesce_key)
+                    continue
+                if version not in translated:
+                    translated[version] = self.translate_game_update(client, payload, sender, version)
+                if translated[version] is not None:
+                    self.send_frame(other_client, translated[version], coalesce_key)
+        self.metrics.record_lobby_traffic(lobby_id)
+
+    def translate_game_update(self, client, payload, sender, version):
+        """Re-encode a binary update for a peer that only speaks an older protocol version"""
+        if payload[0] == GAME_UPDATE:
+            update_message = decode_game_update(payload)
+        else:
+            # Deltas are only meaningful against the sender's previous board, so mirror it
+            mirror = self.update_mirrors.setdefault(client, UpdateDecoder())
+            update_message = mirror.apply(payload)
+            if mirror.needs_keyframe:
+                self.send_message(client, {'type': 'keyframe_request'})
+            if update_message is None:
+                return None
+
+        if version >= 2:
+            return self.encode_payload(encode_game_update(update_message))
+        update_message['sender'] = sender
+        return self.encode(update_message)
+
+    def handle_request_keyframe(self, client):
+        if client not in self.clients:
+            return
+
+        lobby_id = self.clients[client]['lobby']
+        sender = self.clients[client]['username']
+        frame = self.encode({'type': 'keyframe_request'})
+        for other_client in self.lobby_peers(lobby_id):
+            if self.clients.get(other_client, {}).get('username') != sender:
+                self.send_frame(other_client, frame)
 
 if __name__ == "__main__":
-    server = GameServer()
-    server.start() 
+    parser = argparse.ArgumentParser(description="Tetris lobby/relay server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='threaded',
+                        help="asyncio serves every connection from a single event loop")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="run N asyncio worker processes that each own a share of the lobbies (Unix only)")
+    parser.add_argument('--udp', action='store_true',
+                        help="also relay game updates over UDP on the same port for clients that can use it")
+    parser.add_argument('--resume-grace', type=float, default=30.0,
+                        help="seconds a dropped player's seat is kept for them to reconnect (0 disables)")
+    parser.add_argument('--match-db', default='matches.db',
+                        help="SQLite file finished matches and the leaderboard are kept in, empty to disable")
+    parser.add_argument('--accounts-db', default='accounts.db',
+                        help="SQLite file player accounts are kept in, empty to accept any login")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve metrics on http://127.0.0.1:PORT/metrics (worker N of a sharded server uses PORT+N)")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        from sharding import run_sharded
+        if args.udp:
+            print("--udp is not supported with --workers, game updates stay on TCP")
+        run_sharded(args.host, args.port, args.workers, args.metrics_port, args.resume_grace, args.match_db,
+                    args.accounts_db)
+    else:
+        server = GameServer(args.host, args.port, args.mode, udp=args.udp, resume_grace=args.resume_grace,
+                            match_db=args.match_db, accounts_db=args.accounts_db)
+        if args.metrics_port:
+            start_metrics_server(server.get_stats, port=args.metrics_port)
+        try:
+            server.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
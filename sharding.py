@@ -0,0 +1,303 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+
+from protocol import (FrameDecoder, HEADER, PROTOCOL_VERSION, ProtocolError, decode_message, encode_frame,
+                      encode_message, is_binary)
+from metrics import start_metrics_server
+from server import GameServer, raise_fd_limit
+
+# Multi-process deployment: a thin router process owns the public port and N worker processes
+# each run an asyncio GameServer for their own share of the lobbies.
+#
+# The router answers 'hello' and 'get_lobbies' itself. On the first command that needs a lobby
+# it passes the client's socket (SCM_RIGHTS over a Unix socketpair) to a worker: the one owning
+# the lobby for join_lobby, the least loaded one otherwise. From then on the client talks to that
+# worker directly and the router is out of the data path, so relay throughput scales with the
+# number of workers. Lobby ids and resume tokens are prefixed with the owning worker ("2-17") so
+# any process can route a join or resume. A worker asked to join or resume into another worker's
+# lobby hands the socket back to the router.
+#
+# Control packets on the socketpairs are SOCK_SEQPACKET: a length-prefixed JSON header, followed
+# for handoffs by the raw bytes already read from the client, with the client's fd attached. A
+# handoff also carries the client's login, so whichever worker ends up with the connection
+# accepts its token.
+#   {'op': 'handoff', 'version': n, 'login': [token, username] or None}
+#                                            router <-> worker, fd attached
+#   {'op': 'lobby', 'id': ..., 'summary': s} worker -> router -> other workers; s is None once closed
+
+MAX_PACKET = 256 * 1024
+
+def pack_control(header, data=b''):
+    return encode_message(header) + data
+
+def unpack_control(packet):
+    (length,) = HEADER.unpack_from(packet)
+    header = decode_message(packet[HEADER.size:HEADER.size + length])
+    return header, packet[HEADER.size + length:]
+
+def shard_of(lobby_id):
+    """Worker index encoded in a lobby id, or None for ids no worker could have issued"""
+    try:
+        return int(str(lobby_id).split('-', 1)[0])
+    except ValueError:
+        return None
+
+def target_shard(message):
+    """Worker a join_lobby or resume has to go to, or None if any worker will do"""
+    if message.get('command') == 'join_lobby':
+        return shard_of(message.get('lobby_id'))
+    if message.get('command') == 'resume':
+        return shard_of(message.get('token'))
+    return None
+
+def receive_control(channel):
+    """Read every control packet currently waiting on a non-blocking channel"""
+    packets = []
+    while True:
+        try:
+            packet, fds, _, _ = socket.recv_fds(channel, MAX_PACKET, 1)
+        except (BlockingIOError, InterruptedError):
+            return packets, False
+        if not packet:
+            return packets, True  # Other side is gone
+        header, data = unpack_control(packet)
+        packets.append((header, data, fds[0] if fds else None))
+
+class ShardWorkerServer(GameServer):
+    """GameServer running inside a worker process, owning the lobbies whose ids start with its index"""
+    def __init__(self, index, channel, resume_grace=30.0, match_db='matches.db', accounts_db='accounts.db'):
+        super().__init__(mode='asyncio', listen=False, lobby_prefix=f"{index}-", resume_grace=resume_grace,
+                         match_db=match_db, accounts_db=accounts_db)
+        self.index = index
+        self.channel = channel
+        self.remote_lobbies = {}  # {lobby_id: summary} for lobbies owned by other workers
+
+    async def run(self):
+        raise_fd_limit()
+        self.channel.setblocking(False)
+        self.stopped = asyncio.Event()
+        asyncio.get_running_loop().add_reader(self.channel.fileno(), self.on_control)
+        await self.stopped.wait()
+
+    def on_control(self):
+        packets, closed = receive_control(self.channel)
+        for header, data, fd in packets:
+            if header['op'] == 'handoff':
+                asyncio.ensure_future(self.adopt(fd, data, header['version'], header.get('login')))
+            elif header['op'] == 'lobby':
+                if header['summary'] is None:
+                    self.remote_lobbies.pop(header['id'], None)
+                else:
+                    self.remote_lobbies[header['id']] = header['summary']
+        if closed:
+            self.stopped.set()  # Router exited
+
+    async def adopt(self, fd, data, version, login):
+        sock = socket.socket(fileno=fd)
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await self.handle_async_client(reader, writer, initial=data, version=version, login=login)
+
+    def lobby_changed(self, lobby_id):
+        packet = pack_control({'op': 'lobby', 'id': lobby_id, 'summary': self.lobby_summary(lobby_id)})
+        self.channel.send(packet)
+
+    def list_lobbies(self):
+        return super().list_lobbies() + list(self.remote_lobbies.values())
+
+    async def intercept_payload(self, client, payload, rest, decoder):
+        # Cheap byte check first; only join_lobby and resume can need another worker
+        if is_binary(payload) or (b'join_lobby' not in payload and b'resume' not in payload):
+            return False
+        if target_shard(decode_message(payload)) in (self.index, None):
+            return False
+
+        # Leave any lobby here, flush what we owe the client, then give the socket back to the router
+        version = self.client_versions.get(client, 1)
+        token = self.client_logins.pop(client, None)
+        login = [token, self.auth_tokens[token]] if token in self.auth_tokens else None
+        self.handle_leave_lobby(client)
+        self.client_versions.pop(client, None)
+        self.update_mirrors.pop(client, None)
+        self.connections.discard(client)
+        frames = client.queue.take_all()
+        client.writer_task.cancel()
+        if frames:
+            client.writer.write(b''.join(frames))
+        await client.writer.drain()
+
+        pending = b''.join(encode_frame(p) for p in [payload] + rest) + bytes(decoder.buffer)
+        sock = client.writer.get_extra_info('socket')
+        packet = pack_control({'op': 'handoff', 'version': version, 'login': login}, pending)
+        socket.send_fds(self.channel, [packet], [sock.fileno()])
+        client.closed = True
+        client.writer.close()  # Closes only this process's copy of the socket
+        return True
+
+def run_worker(index, channel, inherited, metrics_port=None, resume_grace=30.0, match_db='matches.db',
+               accounts_db='accounts.db'):
+    # Drop the router's ends of the socketpairs inherited through fork, so that the router
+    # exiting is seen as EOF on our channel
+    for sock in inherited:
+        sock.close()
+    # Every worker writes to the same SQLite files; WAL mode lets their writes interleave
+    server = ShardWorkerServer(index, channel, resume_grace, match_db, accounts_db)
+    if metrics_port:
+        start_metrics_server(server.get_stats, port=metrics_port + index)
+    # The router stops workers with terminate(); exit normally so queued match results get written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        asyncio.run(server.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+class RouterConnection(asyncio.Protocol):
+    """A client connection the router holds until it knows which worker should get it"""
+    def __init__(self, router, version=1, initial=b'', login=None):
+        self.router = router
+        self.version = version
+        self.initial = initial
+        self.login = login  # Passed on untouched; workers check tokens
+        self.decoder = FrameDecoder()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.initial:
+            self.data_received(self.initial)
+
+    def send(self, message):
+        self.transport.write(encode_message(message))
+
+    def data_received(self, data):
+        try:
+            payloads = self.decoder.feed(data)
+        except ProtocolError:
+            self.transport.close()
+            return
+
+        for index, payload in enumerate(payloads):
+            if is_binary(payload):
+                continue  # Game traffic from a client that isn't in any lobby goes nowhere
+            message = decode_message(payload)
+            command = message.get('command')
+            if command == 'hello':
+                self.version = max(1, min(int(message.get('version', 1)), PROTOCOL_VERSION))
+                self.send({'type': 'hello', 'version': self.version})
+            elif command == 'get_lobbies':
+                self.send({'type': 'lobby_list', 'lobbies': list(self.router.lobbies.values())})
+            else:
+                worker = self.router.pick_worker(message)
+                if worker is None and command == 'resume':
+                    self.send({'type': 'resume_failed', 'message': 'Session expired'})
+                    continue
+                if worker is None:
+                    self.send({'type': 'join_failed', 'message': 'Lobby is full or does not exist'})
+                    continue
+                pending = b''.join(encode_frame(p) for p in payloads[index:]) + bytes(self.decoder.buffer)
+                self.transport.pause_reading()
+                self.router.hand_off(self, worker, pending)
+                return
+
+class ShardRouter:
+    def __init__(self, host, port, worker_count, metrics_port=None, resume_grace=30.0, match_db='matches.db',
+                 accounts_db='accounts.db'):
+        self.host = host
+        self.port = port
+        self.channels = []
+        self.processes = []
+        self.lobbies = {}  # Merged {lobby_id: summary} across all workers
+
+        context = multiprocessing.get_context('fork')
+        for index in range(worker_count):
+            parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            process = context.Process(target=run_worker,
+                                      args=(index, child_end, self.channels + [parent_end], metrics_port,
+                                            resume_grace, match_db, accounts_db),
+                                      daemon=True)
+            process.start()
+            child_end.close()
+            self.channels.append(parent_end)
+            self.processes.append(process)
+
+    def pick_worker(self, message):
+        if message.get('command') in ('join_lobby', 'resume'):
+            worker = target_shard(message)
+            if worker is None or not 0 <= worker < len(self.channels):
+                return None
+            return worker
+        # Anything else (creating a lobby, ...) goes to the worker owning the fewest lobbies
+        counts = [0] * len(self.channels)
+        for lobby_id in self.lobbies:
+            worker = shard_of(lobby_id)
+            if worker is not None and 0 <= worker < len(counts):
+                counts[worker] += 1
+        return counts.index(min(counts))
+
+    def hand_off(self, connection, worker, pending):
+        transport = connection.transport
+        if transport.is_closing():
+            return
+        if transport.get_write_buffer_size():
+            # Our replies must reach the client before anything the worker sends
+            asyncio.get_running_loop().call_later(0.005, self.hand_off, connection, worker, pending)
+            return
+        sock = transport.get_extra_info('socket')
+        packet = pack_control({'op': 'handoff', 'version': connection.version, 'login': connection.login}, pending)
+        socket.send_fds(self.channels[worker], [packet], [sock.fileno()])
+        transport.close()  # The worker now holds its own copy of the socket
+
+    def on_control(self, worker):
+        packets, closed = receive_control(self.channels[worker])
+        for header, data, fd in packets:
+            if header['op'] == 'handoff':
+                # A worker gave a client back, re-route it as if it had just connected
+                sock = socket.socket(fileno=fd)
+                asyncio.ensure_future(asyncio.get_running_loop().connect_accepted_socket(
+                    lambda: RouterConnection(self, header['version'], data, header.get('login')), sock=sock))
+            elif header['op'] == 'lobby':
+                if header['summary'] is None:
+                    self.lobbies.pop(header['id'], None)
+                else:
+                    self.lobbies[header['id']] = header['summary']
+                # Every worker keeps the global list so it can answer get_lobbies itself
+                packet = pack_control(header)
+                for other, channel in enumerate(self.channels):
+                    if other != worker:
+                        channel.send(packet)
+        if closed:
+            print(f"Worker {worker} exited")
+            asyncio.get_running_loop().remove_reader(self.channels[worker].fileno())
+
+    async def serve(self):
+        raise_fd_limit()
+        loop = asyncio.get_running_loop()
+        for worker, channel in enumerate(self.channels):
+            channel.setblocking(False)
+            loop.add_reader(channel.fileno(), self.on_control, worker)
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(1024)
+        listener.setblocking(False)
+        server = await loop.create_server(lambda: RouterConnection(self), sock=listener)
+        print(f"Server started on {self.host}:{self.port} (router + {len(self.channels)} workers, pid {os.getpid()})")
+        async with server:
+            await server.serve_forever()
+
+def run_sharded(host, port, worker_count, metrics_port=None, resume_grace=30.0, match_db='matches.db',
+                accounts_db='accounts.db'):
+    router = ShardRouter(host, port, worker_count, metrics_port, resume_grace, match_db, accounts_db)
+    try:
+        asyncio.run(router.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in router.processes:
+            process.terminate()